@@ -1,6 +1,25 @@
 import os, re
-import shutil
-from pydub import AudioSegment
+import multiprocessing
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from src.cache.artifact_cache import artifact_cache, file_digest, link_or_copy, make_key
+from src.pipeline.scheduler import Cancelled
+from src.tracing.tracer import tracer
+
+CACHE_VERSION = 2
+MUSIC_NAME = "music"  # 取り込んだ音源は music.<拡張子> になる
+
+# ffmpegでそのままデコードできるので、変換せずに取り込む形式
+AUDIO_EXTENSIONS = {".mp3", ".wav", ".ogg", ".flac", ".m4a", ".aac", ".opus", ".webm"}
+# 取り込めるが、音声だけをflacに変換してから使う形式(動画など)
+CONVERT_EXTENSIONS = {".wma", ".aif", ".aiff", ".mp4", ".m4v", ".mov", ".mkv", ".avi"}
+
+# ingest の結果。duplicate_of は内容が同じで先に取り込んだファイルのパス
+IngestItem = namedtuple(
+    "IngestItem", ["input_path", "output_path", "digest", "duplicate_of"]
+)
 
 
 def sanitize_filename(filename):
@@ -11,32 +30,207 @@ def sanitize_filename(filename):
     return filename
 
 
+def find_music(names):
+    # ファイル名の一覧から music.<拡張子> を探す
+    for name in sorted(names):
+        if os.path.splitext(name)[0] == MUSIC_NAME:
+            return name
+    return None
+
+
+def output_dir_for(title, cached_path, source):
+    # data/output/<曲名> を返す。同じ曲名のフォルダに別の内容の音源が置かれていたら、
+    # 別の曲として <曲名>-<ハッシュの先頭8文字> にする(別のフォルダの同名ファイルを上書きしない)
+    name = sanitize_filename(title)
+    output_dir = os.path.join("data", "output", name)
+    if os.path.isdir(output_dir):
+        existing = find_music(os.listdir(output_dir))
+        if existing and file_digest(os.path.join(output_dir, existing)) != file_digest(
+            cached_path
+        ):
+            output_dir = os.path.join("data", "output", f"{name}-{source[:8]}")
+    return output_dir
+
+
+def place_music(cached_path, output_path):
+    # キャッシュ上の音源を data/output/<曲名>/ に置く
+    # 同名の別の曲が置かれていたら差し替える
+    if os.path.exists(output_path):
+        if file_digest(output_path) == file_digest(cached_path):
+            return output_path
+        print(f"同名の別の音源を置き換えます: {output_path}")
+    return link_or_copy(cached_path, output_path)
+
+
+def collect_audio_files(paths):
+    # ファイルとディレクトリ(再帰的にたどる)から取り込める音源を集める
+    extensions = AUDIO_EXTENSIONS | CONVERT_EXTENSIONS
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if os.path.splitext(name)[1].lower() in extensions:
+                        files.append(os.path.join(root, name))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            print(f"見つかりません: {path}")
+    return files
+
+
+def convert_audio(input_path, output_path):
+    # 音声だけを取り出してflacにする(これ以上劣化させない)。プロセスプールからも呼ぶ
+    from pydub import AudioSegment
+
+    sound = AudioSegment.from_file(input_path)
+    sound.export(output_path, format="flac")
+    return output_path
+
+
 class Copy:
-    def __init__(self):
-        pass
+    def __init__(self, cache=None, max_workers=None):
+        self.cache = cache or artifact_cache
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self._place_lock = (
+            threading.Lock()
+        )  # 同名の曲を同時に取り込んでも同じフォルダにしない
 
+    @tracer.traced("copy")
     def copy_music(self, input_path):
         try:
-            filename, ext = os.path.splitext(os.path.basename(input_path))
-            output_dir = os.path.join("data", "output", sanitize_filename(filename))
-            os.makedirs(output_dir, exist_ok=True)
+            return self._ingest_file(input_path)
 
-            output_path = os.path.join(output_dir, "music.mp3")
+        except Exception as e:
+            print(f"コピーエラー: {e}")
+            tracer.fail(e)
 
-            if os.path.exists(output_path):
-                print(f"コピー済みのファイルが存在: {output_path}")
-            else:
-                if ext.lower() == "mp3":
-                    shutil.copy2(input_path, output_path)
+    def _ingest_file(self, input_path, source=None, convert=convert_audio):
+        filename, ext = os.path.splitext(os.path.basename(input_path))
+        ext = ext.lower()
+        if filename == MUSIC_NAME:
+            # 取り込み済みの data/output/<曲名>/music.<拡張子> ならフォルダ名を曲名にする
+            filename = os.path.basename(os.path.dirname(os.path.abspath(input_path)))
+
+        # 曲名ではなく音源の内容でキャッシュを引く
+        source = source or file_digest(input_path)
+        key = make_key("ingest", source, version=CACHE_VERSION)
+        cached = self.cache.lookup("ingest", key)
+        if cached:
+            print(f"コピー済みのファイルが存在: {input_path}")
+        else:
+            with self.cache.write(
+                "ingest",
+                key,
+                source=source,
+                version=CACHE_VERSION,
+                meta={"title": filename, "input_path": input_path},
+            ) as tmp_dir:
+                if ext in AUDIO_EXTENSIONS:
+                    # そのままデコードできるので、変換せずにリンク(できなければコピー)する
+                    link_or_copy(input_path, os.path.join(tmp_dir, MUSIC_NAME + ext))
                 else:
                     try:
-                        sound = AudioSegment.from_file(input_path)
-                        sound.export(output_path, format="mp3")
+                        convert(input_path, os.path.join(tmp_dir, f"{MUSIC_NAME}.flac"))
                     except Exception as e:
                         print(f"変換エラー(copy.py): {e}")
-                        return None
-                print(f"ファイルをコピーしました: {input_path}, {output_path}")
-            return output_path
+                        raise
+            cached = self.cache.lookup("ingest", key)
+            print(f"ファイルをコピーしました: {input_path}")
+        name = find_music(cached)
+        with self._place_lock:
+            output_dir = output_dir_for(filename, cached[name], source)
+            os.makedirs(output_dir, exist_ok=True)
+            return place_music(cached[name], os.path.join(output_dir, name))
 
-        except Exception as e:
-            print(f"コピーエラー: {e}")
+    @tracer.traced("ingest")
+    def ingest(self, paths, on_progress=None, check_cancelled=None):
+        # 複数のファイル・ディレクトリをまとめて取り込む
+        # 内容のハッシュが同じファイルは1回だけ取り込み、変換が必要なものはプロセスプールで並列に変換する
+        # 戻り値は入力ファイルごとの IngestItem のリスト(失敗したものは output_path=None)
+        files = collect_audio_files(paths)
+        total = len(files) * 2  # ハッシュの計算と取り込みで1回ずつ進める
+        done = [0]
+        lock = threading.Lock()
+
+        def advance():
+            with lock:
+                done[0] += 1
+                if on_progress:
+                    on_progress(done[0] / total)
+
+        def digest(path):
+            try:
+                return file_digest(path)
+            except OSError as e:
+                print(f"読み込めません: {path}: {e}")
+            finally:
+                advance()
+
+        pool = None
+        pool_lock = threading.Lock()
+
+        def convert_in_pool(input_path, output_path):
+            # 変換は重いので、GILに縛られないよう別のプロセスで行う
+            nonlocal pool
+            with pool_lock:
+                if pool is None:
+                    # TensorFlowはforkと相性が悪いのでspawnで起動する
+                    pool = ProcessPoolExecutor(
+                        max_workers=self.max_workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+            return pool.submit(convert_audio, input_path, output_path).result()
+
+        def ingest_one(path, source):
+            try:
+                return self._ingest_file(path, source, convert=convert_in_pool)
+            except Exception as e:
+                print(f"コピーエラー: {path}: {e}")
+            finally:
+                advance()
+
+        outputs = {}
+        first = {}  # ハッシュ -> 最初に見つかったファイル
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as threads:
+                digests = list(threads.map(digest, files))
+                if check_cancelled:
+                    check_cancelled()
+
+                futures = {}
+                for path, source in zip(files, digests):
+                    if source is not None and source not in first:
+                        first[source] = path
+                        futures[threads.submit(ingest_one, path, source)] = path
+                    else:
+                        if source is not None:
+                            print(f"同じ内容のファイルをスキップします: {path}")
+                        advance()
+                try:
+                    for future in as_completed(futures):
+                        outputs[futures[future]] = future.result()
+                        if check_cancelled:
+                            check_cancelled()
+                except Cancelled:
+                    # まだ始まっていないものは取りやめる(実行中のものは終わるまで待つ)
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        items = []
+        owners = {}  # output_path -> ハッシュ
+        for path, source in zip(files, digests):
+            original = first.get(source)
+            duplicate_of = original if original != path else None
+            output_path = outputs.get(original)
+            if output_path and owners.setdefault(output_path, source) != source:
+                # 内容の違う音源が同じ場所を指していたら、後の方は取り込み失敗にする
+                print(f"別の音源と出力先が重なりました: {path}: {output_path}")
+                output_path = None
+            items.append(IngestItem(path, output_path, source, duplicate_of))
+        return items
@@ -1,6 +1,23 @@
-from youtube_search import YoutubeSearch
-import yt_dlp
 import os, re
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.audio.copy import MUSIC_NAME, find_music, place_music
+from src.cache.artifact_cache import artifact_cache, make_key
+from src.pipeline.scheduler import (
+    CANCELLED,
+    FAILED,
+    FINISHED,
+    PENDING,
+    RUNNING,
+    CancelToken,
+    Cancelled,
+)
+from src.tracing.tracer import tracer
+
+CACHE_VERSION = 1
 
 
 def sanitize_filename(filename):
@@ -11,50 +28,285 @@ def sanitize_filename(filename):
     return filename
 
 
+def transcode(path, codec, quality="192"):
+    # ffmpegで別の形式に変換し、元のファイルは消す
+    output_path = f"{os.path.splitext(path)[0]}.{codec}"
+    cmd = ["ffmpeg", "-nostdin", "-v", "error", "-y", "-i", path, "-vn"]
+    cmd += ["-b:a", f"{quality}k", output_path]
+    result = subprocess.run(cmd, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"変換に失敗しました: {result.stderr.decode(errors='replace').strip()}"
+        )
+    os.remove(path)
+    return output_path
+
+
+class YoutubeExtractor:
+    # youtube-search で検索して、yt-dlp で音声をダウンロードする
+    def search(self, query):
+        # 起動を速くするため、検索とダウンロードのライブラリは使うときにimportする
+        from youtube_search import YoutubeSearch
+
+        results = YoutubeSearch(query, max_results=1).to_dict()
+        if not results:
+            return None
+        return {
+            "url": "https://youtube.com" + results[0]["url_suffix"],
+            "title": results[0]["title"],
+        }
+
+    def download(
+        self,
+        url,
+        output_dir,
+        codec=None,
+        quality="192",
+        on_progress=None,
+        check_cancelled=None,
+    ):
+        # codec=None なら配信されている形式(webm/m4aなど)のまま保存する
+        import yt_dlp
+
+        def hook(status):
+            if check_cancelled:
+                try:
+                    check_cancelled()
+                except Cancelled:
+                    raise yt_dlp.utils.DownloadCancelled()
+            if on_progress and status["status"] == "downloading":
+                total = status.get("total_bytes") or status.get("total_bytes_estimate")
+                if total:
+                    on_progress(min(status.get("downloaded_bytes", 0) / total, 1.0))
+
+        ydl_ops = {
+            "format": "bestaudio/best",
+            # yt_dlpが拡張子をくっつける
+            "outtmpl": os.path.join(output_dir, f"{MUSIC_NAME}.%(ext)s"),
+            "progress_hooks": [hook],
+        }
+        if codec:
+            ydl_ops["postprocessors"] = [
+                {
+                    "key": "FFmpegExtractAudio",
+                    "preferredcodec": codec,
+                    "preferredquality": quality,
+                }
+            ]
+        try:
+            with yt_dlp.YoutubeDL(ydl_ops) as ydl:
+                ydl.download([url])
+        except yt_dlp.utils.DownloadCancelled:
+            raise Cancelled()
+
+        name = find_music(os.listdir(output_dir))
+        if name is None:
+            raise RuntimeError(f"ダウンロードしたファイルが見つかりません: {url}")
+        return os.path.join(output_dir, name)
+
+
+class LocalExtractor:
+    # ネットワークを使わずに試すための代わり。ディレクトリ内の音源ファイルを検索・ダウンロードする
+    # bytes_per_second を指定すると、回線の遅さを真似て少しずつコピーする
+    def __init__(self, root, chunk_size=256 * 1024, bytes_per_second=None):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.bytes_per_second = bytes_per_second
+
+    def search(self, query):
+        # 検索語をすべて含むファイル名のうち、最初のものを返す
+        words = query.lower().split()
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name)
+            title = os.path.splitext(name)[0]
+            if os.path.isfile(path) and all(word in title.lower() for word in words):
+                return {"url": "file://" + os.path.abspath(path), "title": title}
+        return None
+
+    def download(
+        self,
+        url,
+        output_dir,
+        codec=None,
+        quality="192",
+        on_progress=None,
+        check_cancelled=None,
+    ):
+        path = url[len("file://") :]
+        output_path = os.path.join(
+            output_dir, MUSIC_NAME + os.path.splitext(path)[1].lower()
+        )
+        total = os.path.getsize(path)
+        copied = 0
+        with open(path, "rb") as src, open(output_path, "wb") as dst:
+            while True:
+                if check_cancelled:
+                    check_cancelled()
+                chunk = src.read(self.chunk_size)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                copied += len(chunk)
+                if on_progress:
+                    on_progress(copied / total)
+                if self.bytes_per_second:
+                    time.sleep(len(chunk) / self.bytes_per_second)
+        if codec and not output_path.endswith(f".{codec}"):
+            output_path = transcode(output_path, codec, quality)
+        return output_path
+
+
 class Downloader:
-    def __init__(self):
-        pass
+    # codec=None なら配信されている音声をそのまま保存し、分離や認識のときにffmpegで直接デコードする
+    # (mp3に変換すると時間がかかり、分離の前に音質も落ちる)。codec="mp3" なら従来どおり変換する
+    def __init__(self, cache=None, extractor=None, codec=None, quality="192"):
+        self.cache = cache or artifact_cache
+        self.extractor = extractor or YoutubeExtractor()
+        self.codec = codec
+        self.quality = quality
+
+    def _params(self):
+        if self.codec:
+            # 以前のmp3のキャッシュと同じキーになる
+            return {
+                "format": "bestaudio/best",
+                "codec": self.codec,
+                "quality": self.quality,
+            }
+        return {"format": "bestaudio/best", "codec": "native"}
 
-    def download_music(self, query):
+    @tracer.traced("download")
+    def download_music(self, query, on_progress=None, check_cancelled=None):
         try:
-            results = YoutubeSearch(query, max_results=1).to_dict()
+            result = self.extractor.search(query)
 
-            if not results:
+            if not result:
                 print(f"youtubeで見つかりませんでした: {query}")
                 return
 
-            video_url = "https://youtube.com" + results[0]["url_suffix"]
-            video_title = sanitize_filename(results[0]["title"])
+            video_url = result["url"]
+            video_title = sanitize_filename(result["title"])
 
             output_dir = os.path.join("data", "output", video_title)
             os.makedirs(output_dir, exist_ok=True)
-            output_file = os.path.join(output_dir, "music")
 
-            if os.path.exists(output_file + ".mp3"):
-                print(f"ダウンロード済みのファイルが存在します: {output_file}")
-                return output_file + ".mp3"
+            # 曲名ではなく動画のURLとダウンロード設定でキャッシュを引く
+            params = self._params()
+            key = make_key("download", video_url, params, CACHE_VERSION)
+            cached = self.cache.lookup("download", key)
+            if cached:
+                name = find_music(cached)
+                output_path = os.path.join(output_dir, name)
+                print(f"ダウンロード済みのファイルが存在します: {output_path}")
+                return place_music(cached[name], output_path)
 
             print(f"'{video_title}' のダウンロードを開始します")
+            tracer.annotate(video_url=video_url, params=params)
 
-            ydl_ops = {
-                "format": "bestaudio/best",
-                "postprocessors": [
-                    {
-                        "key": "FFmpegExtractAudio",
-                        "preferredcodec": "mp3",
-                        "preferredquality": "192",
-                    }
-                ],
-                "outtmpl": output_file,
-            }
-
-            with yt_dlp.YoutubeDL(ydl_ops) as ydl:
-                ydl.download([video_url])
+            with self.cache.write(
+                "download",
+                key,
+                source=video_url,
+                params=params,
+                version=CACHE_VERSION,
+                meta={"title": result["title"], "query": query},
+            ) as tmp_dir:
+                self.extractor.download(
+                    video_url,
+                    tmp_dir,
+                    codec=self.codec,
+                    quality=self.quality,
+                    on_progress=on_progress,
+                    check_cancelled=check_cancelled,
+                )
 
             print(f"'{video_title}' のダウンロードが完了")
 
-            # yt_dlpでmp3がくっついちゃうのかな..?
-            return output_file + ".mp3"
+            cached = self.cache.lookup("download", key)
+            name = find_music(cached)
+            return place_music(cached[name], os.path.join(output_dir, name))
 
+        except Cancelled:
+            raise
         except Exception as e:
             print(f"ダウンロードエラー: {e}")
+            tracer.fail(e)
+
+
+class DownloadTask:
+    # DownloadQueue.submit の戻り値。進捗の確認、キャンセル、完了待ちができる
+    def __init__(self, query, on_progress=None):
+        self.query = query
+        self.on_progress = on_progress
+        self.state = PENDING
+        self.progress = 0.0
+        self.result = None  # ダウンロードした音源のパス
+        self.error = None
+        self.cancel_token = CancelToken()
+        self._done = threading.Event()
+
+    def _set_progress(self, fraction):
+        self.progress = fraction
+        if self.on_progress:
+            self.on_progress(fraction)
+
+    def cancel(self):
+        self.cancel_token.cancel()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+
+class DownloadQueue:
+    # ダウンロードを max_workers 件ずつ並行して実行する(それ以上は順番待ち)
+    def __init__(self, downloader=None, max_workers=2):
+        self.downloader = downloader or Downloader()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="download"
+        )
+        self.tasks = []
+
+    def submit(self, query, on_progress=None, on_done=None):
+        # on_progress(割合), on_done(task) はダウンロードのスレッドから呼ばれる
+        task = DownloadTask(query, on_progress)
+        self.tasks = [t for t in self.tasks if not t.done] + [task]
+        self.executor.submit(self._run, task, on_done)
+        return task
+
+    def _run(self, task, on_done):
+        try:
+            task.cancel_token.check()  # 順番待ちの間にキャンセルされた
+            task.state = RUNNING
+            path = self.downloader.download_music(
+                task.query,
+                on_progress=task._set_progress,
+                check_cancelled=task.cancel_token.check,
+            )
+            if not path:
+                raise RuntimeError(f"ダウンロードできませんでした: {task.query}")
+            task.result, task.state = path, FINISHED
+        except Cancelled:
+            task.state = CANCELLED
+        except Exception as e:
+            task.error, task.state = e, FAILED
+        finally:
+            task._done.set()
+        if on_done:
+            try:
+                on_done(task)
+            except Exception as e:
+                print(f"ダウンロード完了の通知でエラー: {e}")
+
+    def cancel_all(self):
+        for task in self.tasks:
+            if not task.done:
+                task.cancel()
+
+    def shutdown(self, wait=True, cancel=False):
+        if cancel:
+            self.cancel_all()
+        self.executor.shutdown(wait=wait)
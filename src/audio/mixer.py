@@ -0,0 +1,236 @@
+import threading
+import time
+import wave
+
+import numpy as np
+
+
+class Mixer:
+    # デコード済みのPCM(float32, (フレーム数, チャンネル数))を保持し、
+    # ブロックごとにステムの音量を掛けて足し合わせる
+    # 音量の変更は次のブロックから反映されるので、再エンコードは不要
+    def __init__(self, samplerate, channels=2):
+        self.samplerate = samplerate
+        self.channels = channels
+        self.stems = {}
+        self.gains = {}
+        self.length = 0  # 最も長いステムのフレーム数
+        self.position = 0  # 次に出力するフレーム
+        self.loop = None  # (開始フレーム, 終了フレーム) の区間をくり返す
+        self.paused = False
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def add_stem(self, name, pcm, gain=1.0):
+        # float32かint16の配列を受け付ける。mmapされた配列もコピーせずにそのまま使う
+        pcm = np.asarray(pcm)
+        if pcm.dtype not in (np.float32, np.int16):
+            pcm = pcm.astype(np.float32)
+        if pcm.ndim == 1:
+            pcm = pcm[:, np.newaxis]
+        if pcm.shape[1] not in (1, self.channels):
+            # チャンネル数が合わないものはモノラルにまとめる(モノラルは全チャンネルに出す)
+            pcm = pcm.mean(axis=1, keepdims=True, dtype=np.float32)
+        with self._lock:
+            self.stems[name] = pcm
+            self.gains[name] = float(gain)
+            self.length = max(len(stem) for stem in self.stems.values())
+
+    def set_gain(self, name, gain):
+        # オーディオスレッドは次のブロックでこの値を読む
+        self.gains[name] = max(0.0, float(gain))
+
+    def get_gain(self, name):
+        return self.gains.get(name, 0.0)
+
+    @property
+    def position_seconds(self):
+        return self.position / self.samplerate
+
+    @property
+    def duration(self):
+        return self.length / self.samplerate
+
+    def seek(self, frame):
+        # PCMはメモリ上にあるので、位置を変えるだけで次のブロックからそこを再生する
+        with self._lock:
+            self.position = min(max(0, int(frame)), self.length)
+            self.finished = self.position >= self.length and self.loop is None
+
+    def set_loop(self, start_frame, end_frame):
+        start_frame = min(max(0, int(start_frame)), self.length)
+        end_frame = min(max(0, int(end_frame)), self.length)
+        if end_frame <= start_frame:
+            raise ValueError("ループの終了位置は開始位置より後にしてください")
+        with self._lock:
+            self.loop = (start_frame, end_frame)
+            # 区間の外にいたら区間の先頭に移動する
+            if not start_frame <= self.position < end_frame:
+                self.position = start_frame
+            self.finished = False
+
+    def clear_loop(self):
+        with self._lock:
+            self.loop = None
+
+    def _mix(self, out, start, end):
+        for name, stem in self.stems.items():
+            gain = self.gains.get(name, 0.0)
+            if gain <= 0 or start >= len(stem):
+                continue
+            if stem.dtype == np.int16:
+                gain /= 32768.0
+            stem_end = min(end, len(stem))
+            out[: stem_end - start] += np.multiply(
+                stem[start:stem_end], np.float32(gain), dtype=np.float32
+            )
+
+    def render(self, out):
+        # out: (フレーム数, チャンネル数) のfloat32配列。オーディオのコールバックから呼ぶ
+        frames = len(out)
+        out.fill(0)
+        if self.paused or self.finished:
+            return 0
+
+        written = 0
+        with self._lock:
+            while written < frames:
+                limit = self.loop[1] if self.loop else self.length
+                count = min(frames - written, limit - self.position)
+                if count > 0:
+                    self._mix(out[written:], self.position, self.position + count)
+                    self.position += count
+                    written += count
+                if self.position >= limit:
+                    if self.loop:
+                        # ループの終わりに来たら同じブロックの中で先頭に戻る
+                        self.position = self.loop[0]
+                    else:
+                        self.finished = True
+                        break
+        np.clip(out, -1.0, 1.0, out=out)
+        return written
+
+
+class SoundDeviceSink:
+    # sounddeviceのコールバックでミキサーから音を引き出す
+    def __init__(self, blocksize=1024, device=None, latency="low"):
+        self.blocksize = blocksize
+        self.device = device
+        self.latency = latency
+        self.stream = None
+
+    def start(self, mixer):
+        import sounddevice as sd
+
+        def callback(outdata, frames, time_info, status):
+            if status:
+                print(f"オーディオ出力の警告: {status}")
+            mixer.render(outdata)
+
+        self.stream = sd.OutputStream(
+            samplerate=mixer.samplerate,
+            channels=mixer.channels,
+            dtype="float32",
+            blocksize=self.blocksize,
+            device=self.device,
+            latency=self.latency,
+            callback=callback,
+        )
+        self.stream.start()
+
+    @property
+    def output_latency(self):
+        # 出力済みのフレームが実際に鳴るまでの遅れ(秒)
+        return self.stream.latency if self.stream else 0.0
+
+    def is_active(self):
+        return self.stream is not None and self.stream.active
+
+    def stop(self):
+        if self.stream:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+
+class _ThreadSink:
+    # 別スレッドでミキサーから一定サイズのブロックを引き出す(ヘッドレス用)
+    def __init__(self, blocksize=1024, realtime=True):
+        self.blocksize = blocksize
+        self.realtime = realtime
+        self.output_latency = 0.0
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def start(self, mixer):
+        self._stop_event.clear()
+        self._open(mixer)
+        self._thread = threading.Thread(
+            target=self._run, args=(mixer,), name=type(self).__name__, daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, mixer):
+        block = np.zeros((self.blocksize, mixer.channels), dtype=np.float32)
+        block_duration = self.blocksize / mixer.samplerate
+        next_time = time.perf_counter()
+        try:
+            while not self._stop_event.is_set() and not mixer.finished:
+                count = mixer.render(block)
+                if count:
+                    self._write(block[:count])
+                if self.realtime or mixer.paused:
+                    next_time += block_duration
+                    self._stop_event.wait(max(0.0, next_time - time.perf_counter()))
+        finally:
+            self._close()
+
+    def _open(self, mixer):
+        pass
+
+    def _write(self, block):
+        pass
+
+    def _close(self):
+        pass
+
+    def is_active(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def wait(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+
+class NullSink(_ThreadSink):
+    # 音を出さずに再生だけ進める(テストやヘッドレス環境用)
+    pass
+
+
+class FileSink(_ThreadSink):
+    # ミックス結果を16bitのWAVファイルに書き出す
+    def __init__(self, path, blocksize=1024, realtime=False):
+        super().__init__(blocksize=blocksize, realtime=realtime)
+        self.path = path
+        self._wave = None
+
+    def _open(self, mixer):
+        self._wave = wave.open(self.path, "wb")
+        self._wave.setnchannels(mixer.channels)
+        self._wave.setsampwidth(2)
+        self._wave.setframerate(mixer.samplerate)
+
+    def _write(self, block):
+        self._wave.writeframes((block * 32767).astype("<i2").tobytes())
+
+    def _close(self):
+        if self._wave:
+            self._wave.close()
+            self._wave = None
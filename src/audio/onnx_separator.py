@@ -0,0 +1,202 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+# Spleeter (2stems) のU-NetだけをONNXに書き出し、STFTとマスク処理はnumpyで行う
+# TensorFlowは書き出しのときに一度使うだけで、分離のときには読み込まない
+
+MODEL_DIR = os.path.join("data", "models")
+DEFAULT_MODEL_PATH = os.path.join(MODEL_DIR, "spleeter-2stems.onnx")
+
+# spleeter:2stems の設定 (configs/2stems/base_config.json) と同じ値
+FRAME_LENGTH = 4096
+FRAME_STEP = 1024
+T = 512  # U-Netに一度に入れるフレーム数
+F = 1024  # U-Netに入れる周波数ビン数(それより上はマスク0)
+INSTRUMENTS = ("vocals", "accompaniment")
+SEPARATION_EXPONENT = 2
+EPSILON = 1e-10
+WINDOW_COMPENSATION_FACTOR = 2.0 / 3.0  # hann窓を2回掛けて1/4ずつずらすと1.5倍になる分
+
+# 周期的なハン窓 (tf.signal.hann_window(periodic=True))
+WINDOW = (
+    0.5 - 0.5 * np.cos(2 * np.pi * np.arange(FRAME_LENGTH) / FRAME_LENGTH)
+).astype(np.float32)
+
+
+def quantized_path(model_path):
+    root, ext = os.path.splitext(model_path)
+    return f"{root}-int8{ext}"
+
+
+def stft(waveform):
+    # tf.signal.stft(pad_end=True) と同じ。(フレーム数, 2049, チャンネル数) の複素数
+    n_frames = -(-len(waveform) // FRAME_STEP)
+    padded = np.zeros(
+        ((n_frames - 1) * FRAME_STEP + FRAME_LENGTH, waveform.shape[1]),
+        dtype=np.float32,
+    )
+    padded[: len(waveform)] = waveform
+    frames = np.lib.stride_tricks.sliding_window_view(padded, FRAME_LENGTH, axis=0)
+    frames = frames[::FRAME_STEP]  # (フレーム数, チャンネル数, FRAME_LENGTH)
+    spectrum = np.fft.rfft(frames * WINDOW, axis=-1)
+    return spectrum.transpose(0, 2, 1).astype(np.complex64)
+
+
+def istft(spectrum):
+    # tf.signal.inverse_stft(hann窓) * 2/3 と同じ。(サンプル数, チャンネル数)
+    frames = np.fft.irfft(spectrum.transpose(0, 2, 1), n=FRAME_LENGTH, axis=-1)
+    frames = (frames * WINDOW).astype(np.float32)
+    n_frames, channels = frames.shape[:2]
+    output = np.zeros(
+        ((n_frames - 1) * FRAME_STEP + FRAME_LENGTH, channels), np.float32
+    )
+    for i in range(FRAME_LENGTH // FRAME_STEP):
+        # 重ならないフレームごとにまとめて足す
+        block = frames[i::4].transpose(0, 2, 1).reshape(-1, channels)
+        start = i * FRAME_STEP
+        output[start : start + len(block)] += block[: len(output) - start]
+    return output * WINDOW_COMPENSATION_FACTOR
+
+
+class OnnxSeparationModel:
+    # spleeter.separator.Separator.separate と同じく、波形 -> {楽器名: 波形} を返す
+    def __init__(
+        self,
+        model_path=DEFAULT_MODEL_PATH,
+        intra_op_threads=0,
+        inter_op_threads=0,
+        quantized=False,
+    ):
+        import onnxruntime as ort
+
+        if quantized:
+            model_path = quantized_path(model_path)
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(
+                f"ONNXモデルがありません: {model_path} "
+                "(python -m src.audio.onnx_separator export で作成してください)"
+            )
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads  # 0はCPUのコア数に合わせる
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            model_path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [output.name for output in self.session.get_outputs()]
+
+    def separate(self, waveform):
+        waveform = np.asarray(waveform, dtype=np.float32)
+        if waveform.ndim == 1:
+            waveform = np.repeat(waveform[:, None], 2, axis=1)
+        # Spleeterと同じく先頭に FRAME_LENGTH サンプルの無音を足してから変換する
+        padded = np.concatenate([np.zeros((FRAME_LENGTH, 2), np.float32), waveform])
+        spectrum = stft(padded)
+        n_frames = len(spectrum)
+
+        # T フレームずつに区切ってU-Netに入れる
+        magnitude = np.abs(spectrum[:, :F, :])
+        n_patches = -(-n_frames // T)
+        patches = np.zeros((n_patches * T, F, 2), dtype=np.float32)
+        patches[:n_frames] = magnitude
+        outputs = self.session.run(
+            self.output_names, {self.input_name: patches.reshape(n_patches, T, F, 2)}
+        )
+        outputs = [output.reshape(-1, F, 2)[:n_frames] for output in outputs]
+
+        # Spleeterと同じ比率マスク(F より上の周波数は0)
+        powers = [output**SEPARATION_EXPONENT for output in outputs]
+        total = np.sum(powers, axis=0) + EPSILON
+        prediction = {}
+        for instrument, power in zip(INSTRUMENTS, powers):
+            mask = np.zeros(spectrum.shape, dtype=np.float32)
+            mask[:, :F, :] = (power + EPSILON / len(powers)) / total
+            restored = istft(spectrum * mask)
+            prediction[instrument] = restored[
+                FRAME_LENGTH : FRAME_LENGTH + len(waveform)
+            ]
+        return prediction
+
+
+def export_model(output_path=DEFAULT_MODEL_PATH, model="spleeter:2stems", opset=13):
+    # Spleeterの学習済みU-Netを読み込み、ONNXに書き出す(最初に一度だけ)
+    import tensorflow as tf
+    import tf2onnx
+    from spleeter.model.functions import get_model_function
+    from spleeter.model.provider import ModelProvider
+    from spleeter.utils.configuration import load_configuration
+
+    params = load_configuration(model)
+    tf.compat.v1.disable_eager_execution()
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.compat.v1.keras.backend.set_learning_phase(0)
+        mix = tf.compat.v1.placeholder(
+            tf.float32,
+            shape=(None, params["T"], params["F"], params["n_channels"]),
+            name="mix_spectrogram",
+        )
+        model_fn = get_model_function(params["model"]["type"])
+        outputs = model_fn(mix, params["instrument_list"], params["model"]["params"])
+        output_names = [
+            tf.identity(outputs[f"{instrument}_spectrogram"], name=instrument).name
+            for instrument in params["instrument_list"]
+        ]
+        with tf.compat.v1.Session(graph=graph) as session:
+            model_dir = ModelProvider.default().get(params["model_dir"])
+            tf.compat.v1.train.Saver().restore(
+                session, tf.train.latest_checkpoint(model_dir)
+            )
+            graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
+                session,
+                graph.as_graph_def(),
+                [name.split(":")[0] for name in output_names],
+            )
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    tf2onnx.convert.from_graph_def(
+        graph_def,
+        input_names=["mix_spectrogram:0"],
+        output_names=output_names,
+        opset=opset,
+        output_path=output_path,
+    )
+    print(f"ONNXモデルを書き出しました: {output_path}")
+    return output_path
+
+
+def quantize_model(model_path=DEFAULT_MODEL_PATH):
+    # 重みをint8にする(動的量子化)。精度と速度は compare で確認する
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    output_path = quantized_path(model_path)
+    quantize_dynamic(model_path, output_path, weight_type=QuantType.QInt8)
+    print(f"int8モデルを書き出しました: {output_path}")
+    return output_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="音源分離のONNXモデル")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="SpleeterのモデルをONNXに変換")
+    export_parser.add_argument("--output", default=DEFAULT_MODEL_PATH)
+    export_parser.add_argument(
+        "--quantize", action="store_true", help="int8モデルも書き出す"
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "export":
+        start_time = time.time()
+        export_model(args.output)
+        if args.quantize:
+            quantize_model(args.output)
+        print(f"変換時間: {time.time() - start_time:.2f}秒")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import json
+import os
+import subprocess
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from src.cache.artifact_cache import artifact_cache, file_digest, make_key
+from src.tracing.tracer import tracer
+
+CACHE_VERSION = 1
+
+# デコード済みPCM。data は (フレーム数, チャンネル数) のmmap(読み取り専用)
+PCM = namedtuple("PCM", ["data", "samplerate"])
+
+# よく使う形式
+PLAYBACK = {"samplerate": None, "channels": 2, "dtype": "int16"}  # 元のレートのステレオ
+ANALYSIS = {
+    "samplerate": 16000,
+    "channels": 1,
+    "dtype": "float32",
+}  # 認識・ピッチ解析用
+
+SEPARATION = {"samplerate": 44100, "channels": 2, "dtype": "float32"}  # 音源分離用
+
+_FFMPEG_FORMATS = {"float32": "f32le", "int16": "s16le"}
+
+
+def probe_samplerate(path):
+    result = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "a:0",
+            "-show_entries",
+            "stream=sample_rate",
+            "-of",
+            "json",
+            path,
+        ],
+        capture_output=True,
+        check=True,
+    )
+    return int(json.loads(result.stdout)["streams"][0]["sample_rate"])
+
+
+def decode_to_file(path, output_path, samplerate, channels, dtype):
+    # ffmpegで生のPCMをファイルに直接書き出す(曲の長さに関係なくメモリを使わない)
+    fmt = _FFMPEG_FORMATS[dtype]
+    cmd = ["ffmpeg", "-nostdin", "-v", "error", "-y", "-i", path]
+    cmd += ["-f", fmt, "-acodec", f"pcm_{fmt}", "-ac", str(channels)]
+    cmd += ["-ar", str(samplerate), output_path]
+    result = subprocess.run(cmd, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"デコードに失敗しました: {path}: {result.stderr.decode(errors='ignore')}"
+        )
+
+
+def open_encoder(output_path, samplerate, channels, bitrate="128k"):
+    # float32のPCMを標準入力に書き込むと、少しずつエンコードしてファイルに書き出すffmpeg
+    cmd = ["ffmpeg", "-nostdin", "-v", "error", "-y"]
+    cmd += ["-f", "f32le", "-ar", str(samplerate), "-ac", str(channels), "-i", "pipe:0"]
+    cmd += ["-b:a", bitrate, output_path]
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def close_encoder(process, abort=False):
+    if abort:
+        process.kill()
+        process.wait()
+        return
+    process.stdin.close()
+    stderr = process.stderr.read()
+    if process.wait() != 0:
+        raise RuntimeError(
+            f"エンコードに失敗しました: {stderr.decode(errors='ignore')}"
+        )
+
+
+class PCMCache:
+    # 音源ファイルを形式ごとに一度だけデコードし、キャッシュ上の生PCMをmmapで渡す
+    # 同じプロセス内では同じ配列(ビュー)を使い回す
+    def __init__(self, cache=None):
+        self.cache = cache or artifact_cache
+        self._lock = threading.Lock()
+        self._loaded = {}  # キー -> PCM
+        self._decoding = {}  # キー -> Lock (同じファイルの同時デコードを防ぐ)
+
+    @tracer.traced("decode")
+    def get(self, path, samplerate=None, channels=1, dtype="float32"):
+        source = file_digest(path)
+        params = {"samplerate": samplerate, "channels": channels, "dtype": dtype}
+        key = make_key("pcm", source, params, CACHE_VERSION)
+        tracer.annotate(params=params)
+
+        with self._lock:
+            pcm = self._loaded.get(key)
+            if pcm is not None:
+                tracer.annotate(cache="memory")
+                return pcm
+            decode_lock = self._decoding.setdefault(key, threading.Lock())
+
+        with decode_lock:
+            with self._lock:
+                pcm = self._loaded.get(key)
+            if pcm is not None:
+                return pcm
+
+            cached = self.cache.lookup("pcm", key)
+            if not cached:
+                print(f"デコードします: {path} ({params})")
+                actual_samplerate = samplerate or probe_samplerate(path)
+                with self.cache.write(
+                    "pcm",
+                    key,
+                    source=source,
+                    params=params,
+                    version=CACHE_VERSION,
+                    meta={"samplerate": actual_samplerate},
+                ) as tmp_dir:
+                    decode_to_file(
+                        path,
+                        os.path.join(tmp_dir, "pcm.raw"),
+                        actual_samplerate,
+                        channels,
+                        dtype,
+                    )
+                cached = self.cache.lookup("pcm", key)
+
+            manifest = self.cache.get_manifest("pcm", key)
+            pcm = PCM(
+                self._map(cached["pcm.raw"], channels, dtype),
+                manifest["meta"]["samplerate"],
+            )
+            with self._lock:
+                self._loaded[key] = pcm
+                self._decoding.pop(key, None)
+            return pcm
+
+    def _map(self, path, channels, dtype):
+        itemsize = np.dtype(dtype).itemsize
+        frames = os.path.getsize(path) // (itemsize * channels)
+        if frames == 0:
+            return np.zeros((0, channels), dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(frames, channels))
+
+    def separation(self, path):
+        # Spleeterの入力と同じ44.1kHzステレオのfloat32
+        return self.get(path, **SEPARATION)
+
+    def playback(self, path):
+        return self.get(path, **PLAYBACK)
+
+    def analysis(self, path):
+        # whisperと同じ16kHzモノラル。(フレーム数,) の1次元ビューを返す
+        pcm = self.get(path, **ANALYSIS)
+        return PCM(pcm.data[:, 0], pcm.samplerate)
+
+    def release(self):
+        # mmapの参照を手放す(ファイル自体はキャッシュに残る)
+        with self._lock:
+            self._loaded.clear()
+
+
+# プロセス全体で共有するキャッシュ
+pcm_cache = PCMCache()
@@ -1,12 +1,242 @@
+import threading
+import time
+import wave
+from collections import namedtuple
+
+import numpy as np
+
+from src.pitch.yin import yin
+
+# 歌声のピッチ。time は録音開始からの秒数(フレームの中心), pitch はMIDIノート番号(無声は0)
+PitchFrame = namedtuple("PitchFrame", ["time", "pitch", "confidence"])
+
+
+class RingBuffer:
+    # 書き込み1スレッド・読み出し1スレッド用のリングバッファ
+    # 書き込み側は書き込んだ後に位置を進めるだけで、ロックを取らない
+    # (オーディオのコールバックを待たせない)
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=np.float32)
+        self.write_position = 0  # これまでに書き込んだサンプル数
+        self.overflows = 0
+
+    def write(self, samples):
+        samples = np.asarray(samples, dtype=np.float32).reshape(-1)
+        if len(samples) > self.capacity:
+            samples = samples[-self.capacity :]
+        start = self.write_position % self.capacity
+        first = min(len(samples), self.capacity - start)
+        self.buffer[start : start + first] = samples[:first]
+        self.buffer[: len(samples) - first] = samples[first:]
+        self.write_position += len(samples)
+
+    def read(self, end_position, length):
+        # end_position の直前 length サンプルを取り出す
+        if self.write_position - end_position + length > self.capacity:
+            self.overflows += 1
+            raise BufferError("リングバッファの読み出しが間に合いませんでした")
+        indices = np.arange(end_position - length, end_position) % self.capacity
+        return self.buffer[indices]
+
+
 class Recorder:
-    def start_recording(self):
-        # 録音開始処理を実装
-        pass
+    # マイク(またはWAVファイル)の音を取り込み、少しずつ歌声のピッチを推定する
+    def __init__(
+        self,
+        samplerate=16000,
+        frame_length=512,  # 32ms (fmin=100Hzの周期の2倍以上)
+        hop_length=160,  # 10ms ごとにピッチを出す
+        blocksize=128,  # オーディオのコールバック1回分(8ms)
+        fmin=80,
+        fmax=1000,
+        volume_threshold=0.01,
+        confidence_threshold=0.5,
+        device=None,
+    ):
+        self.samplerate = samplerate
+        self.frame_length = frame_length
+        self.hop_length = hop_length
+        self.blocksize = blocksize
+        self.fmin = fmin
+        self.fmax = fmax
+        self.volume_threshold = volume_threshold
+        self.confidence_threshold = confidence_threshold
+        self.device = device
+
+        self.ring = None
+        self.stream = None
+        self.listeners = []
+        self.pitch_frames = []
+        self._new_data = threading.Event()
+        self._stop_event = threading.Event()
+        self._worker = None
+        self._file_thread = None
+        self._analyzed_position = 0
+        self._file_finished = False
+        self.error = None  # WAVファイルを読み込めなかったときの例外
+
+    def add_listener(self, callback):
+        # callback(PitchFrame) はワーカースレッドから呼ばれる
+        self.listeners.append(callback)
+
+    def start_recording(self, input_path=None, realtime=True):
+        # input_path を指定するとマイクの代わりにWAVファイルを流し込む(テスト用)
+        self.stop_recording()
+        self.ring = RingBuffer(self.samplerate * 2)
+        self.pitch_frames = []
+        self._stop_event.clear()
+        self._new_data.clear()
+        # どちらのスレッドも読むので、スレッドを起動する前に初期化する
+        self._analyzed_position = self.frame_length
+        self._file_finished = False
+        self.error = None
+
+        self._worker = threading.Thread(
+            target=self._analyze, name="recorder-pitch", daemon=True
+        )
+        self._worker.start()
+
+        if input_path:
+            self._file_thread = threading.Thread(
+                target=self._feed_file,
+                args=(input_path, realtime),
+                name="recorder-file",
+                daemon=True,
+            )
+            self._file_thread.start()
+        else:
+            import sounddevice as sd
+
+            self.stream = sd.InputStream(
+                samplerate=self.samplerate,
+                channels=1,
+                dtype="float32",
+                blocksize=self.blocksize,
+                device=self.device,
+                latency="low",
+                callback=self._on_audio,
+            )
+            self.stream.start()
+
+    def _on_audio(self, indata, frames, time_info, status):
+        # オーディオスレッド: バッファに書いて知らせるだけ
+        self.ring.write(indata[:, 0])
+        self._new_data.set()
+
+    def _feed_file(self, input_path, realtime):
+        try:
+            self._read_file(input_path, realtime)
+        except Exception as e:
+            print(f"WAVファイルを読み込めませんでした: {input_path}: {e}")
+            self.error = e
+        finally:
+            # 失敗しても解析スレッドを終わらせる(wait が戻らなくならないように)
+            self._file_finished = True
+            self._new_data.set()
+
+    def _read_file(self, input_path, realtime):
+        with wave.open(input_path, "rb") as wav:
+            if wav.getframerate() != self.samplerate:
+                raise ValueError(
+                    f"WAVのサンプリングレートが違います: {wav.getframerate()} (必要: {self.samplerate})"
+                )
+            channels = wav.getnchannels()
+            sample_width = wav.getsampwidth()
+            dtype = {1: np.uint8, 2: "<i2", 4: "<i4"}.get(sample_width)
+            if dtype is None:
+                raise ValueError(
+                    f"対応していないWAVのビット数です: {sample_width * 8}bit (8/16/32bitのみ)"
+                )
+            block_duration = self.blocksize / self.samplerate
+            next_time = time.perf_counter()
+            while not self._stop_event.is_set():
+                data = wav.readframes(self.blocksize)
+                if not data:
+                    break
+                samples = np.frombuffer(data, dtype=dtype).astype(np.float32)
+                if sample_width == 1:
+                    samples = (samples - 128) / 128
+                else:
+                    samples /= float(1 << (8 * sample_width - 1))
+                samples = samples.reshape(-1, channels).mean(axis=1)
+                self.ring.write(samples)
+                self._new_data.set()
+                if realtime:
+                    next_time += block_duration
+                    self._stop_event.wait(max(0.0, next_time - time.perf_counter()))
+                else:
+                    # 解析が追いつくのを待つ(読み出しが間に合わずに取りこぼさないように)
+                    while (
+                        self.ring.write_position - self._analyzed_position
+                        > self.ring.capacity // 2
+                        and not self._stop_event.is_set()
+                    ):
+                        time.sleep(0.001)
+
+    def _analyze(self):
+        # ワーカースレッド: hop_length ごとに直近 frame_length サンプルでピッチを推定する
+        while not self._stop_event.is_set():
+            self._new_data.wait(0.1)
+            self._new_data.clear()
+            while self.ring.write_position >= self._analyzed_position:
+                end = self._analyzed_position
+                try:
+                    frame = self.ring.read(end, self.frame_length)
+                except BufferError:
+                    # 遅れすぎたら最新の位置まで飛ばす
+                    self._analyzed_position = self.ring.write_position
+                    continue
+                self._publish(end, frame)
+                self._analyzed_position += self.hop_length
+            if self._file_finished and self._file_thread is not None:
+                break
+
+    def _publish(self, end, frame):
+        frame_time = (end - self.frame_length / 2) / self.samplerate
+        pitch, confidence = 0.0, 0.0
+        if np.sqrt(np.mean(frame**2)) > self.volume_threshold:
+            f0, confidence = yin(frame, self.samplerate, self.fmin, self.fmax)
+            if f0 > 0 and confidence >= self.confidence_threshold:
+                pitch = 12 * np.log2(f0 / 440.0) + 69
+        pitch_frame = PitchFrame(frame_time, float(pitch), float(confidence))
+        self.pitch_frames.append(pitch_frame)
+        for callback in self.listeners:
+            try:
+                callback(pitch_frame)
+            except Exception as e:
+                print(f"ピッチの通知でエラー: {e}")
+
+    def current_time(self):
+        # 録音開始から取り込んだ音の長さ(秒)
+        return self.ring.write_position / self.samplerate if self.ring else 0.0
+
+    def is_recording(self):
+        return self._worker is not None and self._worker.is_alive()
+
+    def wait(self, timeout=None):
+        # WAVファイル入力の解析が終わるまで待つ。読み込めなかったときはその例外を送出する
+        if self._worker:
+            self._worker.join(timeout)
+        if self.error is not None:
+            raise self.error
 
     def stop_recording(self):
-        # 録音停止処理を実装
-        pass
+        self._stop_event.set()
+        self._new_data.set()
+        if self.stream:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+        for thread in (self._file_thread, self._worker):
+            if thread and thread is not threading.current_thread():
+                thread.join()
+        self._file_thread = None
+        self._worker = None
 
     def get_recorded_data(self):
-        # 録音データを返す処理を実装
-        return None
\ No newline at end of file
+        # これまでに推定したピッチ (time, pitch, confidence) の配列
+        return np.array(
+            [tuple(frame) for frame in self.pitch_frames],
+            dtype=[("time", "f8"), ("pitch", "f4"), ("confidence", "f4")],
+        )
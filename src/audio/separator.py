@@ -1,35 +1,210 @@
 import os
-from spleeter.separator import Separator as SpleeterSeparator
-from spleeter.audio.adapter import AudioAdapter
+import numpy as np
+
+from src.audio.pcm_cache import close_encoder, open_encoder, pcm_cache
+from src.cache.artifact_cache import (
+    artifact_cache,
+    file_digest,
+    link_or_copy,
+    make_key,
+)
+from src.models.registry import registry
+from src.tracing.tracer import tracer
+
+CACHE_VERSION = 1
+
+STEMS = ("vocals", "accompaniment")
+
+
+def crossfade(previous_tail, head):
+    # 前のチャンクの末尾から次のチャンクの先頭へ直線的につなぐ(重なり部分の和が1になる)
+    n = min(len(previous_tail), len(head))
+    fade_in = (np.arange(n, dtype=np.float32) / n)[:, None]
+    head = head.copy()
+    head[:n] = previous_tail[:n] * (1 - fade_in) + head[:n] * fade_in
+    return head
 
 
 class Separator:
-    def __init__(self, model="spleeter:2stems"):
+    def __init__(
+        self,
+        model="spleeter:2stems",
+        cache=None,
+        pcm=None,
+        chunk_seconds=30.0,
+        overlap_seconds=2.0,
+        backend="spleeter",
+        backend_options=None,
+    ):
         self.model = model
-        self.spleeter_separator = SpleeterSeparator(self.model)
-        self.audio_adapter = AudioAdapter.default()
+        self.cache = cache or artifact_cache
+        self.pcm_cache = pcm or pcm_cache
+        # chunk_seconds ごとに分離してつなぐ(曲が長くてもメモリ使用量が一定)
+        # None なら曲全体をSpleeterに渡す
+        self.chunk_seconds = chunk_seconds
+        self.overlap_seconds = overlap_seconds
+        # backend="onnx" ならTensorFlowを使わず、ONNX Runtimeで分離する
+        # (python -m src.audio.onnx_separator export で書き出したモデルを使う)
+        if backend not in ("spleeter", "onnx"):
+            raise ValueError(f"未対応の音源分離バックエンドです: {backend}")
+        if backend == "onnx" and model != "spleeter:2stems":
+            raise ValueError(f"ONNXで分離できるのは spleeter:2stems だけです: {model}")
+        self.backend = backend
+        self.backend_options = backend_options or {}
+        # Spleeterのグラフは曲ごとに作り直さず、レジストリで共有する
+        if backend == "onnx":
+            # オプション(int8・スレッド数など)が違えば別のセッションとして登録する
+            options = "".join(
+                f":{name}={value}"
+                for name, value in sorted(self.backend_options.items())
+            )
+            self.model_name = f"onnx:{self.model}{options}"
+        else:
+            self.model_name = self.model
+        registry.register(self.model_name, self._load_model)
+
+    def _load_model(self):
+        # 使う方だけを読み込む(TensorFlowの読み込みは重い)
+        if self.backend == "onnx":
+            from src.audio.onnx_separator import OnnxSeparationModel
+
+            return OnnxSeparationModel(**self.backend_options)
+
+        from spleeter.separator import Separator as SpleeterSeparator
+
+        return SpleeterSeparator(self.model)
+
+    @property
+    def spleeter_separator(self):
+        return registry.get(self.model_name)
 
-    def separate(self, input_path):
+    def preload(self, callback=None):
+        # バックグラウンドでモデルをロードしておく
+        return registry.preload(self.model_name, callback=callback)
+
+    @tracer.traced("separate")
+    def separate(self, input_path, on_progress=None, check_cancelled=None):
         # ここでは音源ファイルのpathが渡される
-        music_name = os.path.basename(os.path.dirname(input_path))
-        output_directory = os.path.join("data", "output", music_name)
-        vocals_path = os.path.join(output_directory, "vocals.mp3")
-        accompaniment_path = os.path.join(output_directory, "accompaniment.mp3")
-
-        # すでに存在するかどうか
-        if os.path.exists(vocals_path) and os.path.exists(accompaniment_path):
-            print(f"分離済みファイルが見つかりました: {output_directory}")
-            return {"vocals": vocals_path, "accompaniment": accompaniment_path}
+        # 曲名ではなく音源の内容とモデルでキャッシュを引く
+        source = file_digest(input_path)
+        params = {"model": self.model, "codec": "mp3"}
+        if self.chunk_seconds:
+            params["chunk_seconds"] = self.chunk_seconds
+            params["overlap_seconds"] = self.overlap_seconds
+        if self.backend == "onnx":
+            params["backend"] = "onnx"
+            params["quantized"] = bool(self.backend_options.get("quantized"))
+        key = make_key("separate", source, params, CACHE_VERSION)
+        tracer.annotate(params=params)
+
+        # すでに存在するかどうか(書きかけのファイルはキャッシュとして扱わない)
+        cached = self.cache.lookup("separate", key)
+        if not cached and self.backend == "spleeter" and self.chunk_seconds:
+            # 曲全体を一度に分離した結果(以前の data/output から取り込んだものなど)があればそれを使う
+            cached = self.cache.lookup("separate", self._whole_key(source))
+            if cached:
+                tracer.annotate(cache="hit")
+        if cached:
+            print(
+                f"分離済みファイルが見つかりました: {self.cache.entry_dir('separate', key)}"
+            )
         else:
             print(f"分離処理を開始します: {input_path}")
-            os.makedirs(output_directory, exist_ok=True)
 
-            self.spleeter_separator.separate_to_file(
-                input_path,
-                output_directory,
-                codec="mp3",
-                filename_format="{instrument}.{codec}",  # ファイル名を直接指定
-            )
+            with self.cache.write(
+                "separate", key, source=source, params=params, version=CACHE_VERSION
+            ) as tmp_dir:
+                if self.chunk_seconds or self.backend == "onnx":
+                    self._separate_chunks(
+                        input_path, tmp_dir, on_progress, check_cancelled
+                    )
+                else:
+                    with registry.use(self.model_name) as spleeter_separator:
+                        spleeter_separator.separate_to_file(
+                            input_path,
+                            tmp_dir,
+                            codec="mp3",
+                            filename_format="{instrument}.{codec}",  # ファイル名を直接指定
+                            synchronous=True,
+                        )
+
+            cached = self.cache.lookup("separate", key)
+            print(f"分離処理が完了しました: {self.cache.entry_dir('separate', key)}")
+
+        return {
+            "vocals": cached["vocals.mp3"],
+            "accompaniment": cached["accompaniment.mp3"],
+        }
+
+    def _whole_key(self, source):
+        # チャンクに分けずにSpleeterで曲全体を分離したときのキー (chunk_seconds=None と同じ)
+        return make_key(
+            "separate", source, {"model": self.model, "codec": "mp3"}, CACHE_VERSION
+        )
+
+    def import_stems(self, input_path, stem_paths):
+        # 以前の data/output/<曲名>/ に残っている分離結果を、音源の内容をキーにしてキャッシュに登録する
+        # (以前はチャンクに分けずに曲全体を分離していたので、そのときのパラメータで登録する)
+        source = file_digest(input_path)
+        key = self._whole_key(source)
+        if self.cache.lookup("separate", key):
+            return False
+        with self.cache.write(
+            "separate",
+            key,
+            source=source,
+            params={"model": self.model, "codec": "mp3"},
+            version=CACHE_VERSION,
+            meta={"migrated_from": "output"},
+        ) as tmp_dir:
+            for stem in STEMS:
+                link_or_copy(stem_paths[stem], os.path.join(tmp_dir, f"{stem}.mp3"))
+        return True
+
+    def _separate_chunks(self, input_path, output_dir, on_progress, check_cancelled):
+        # 重なりを持たせたチャンクごとに分離し、重なり部分をクロスフェードして
+        # ffmpegにそのまま流し込む(メモリに持つのはチャンク1つ分と重なり部分だけ)
+        pcm = self.pcm_cache.separation(input_path)
+        data, sr = pcm.data, pcm.samplerate
+        total = len(data)
+        chunk = int(self.chunk_seconds * sr) if self.chunk_seconds else total
+        overlap = int(self.overlap_seconds * sr)
+
+        encoders = {
+            stem: open_encoder(os.path.join(output_dir, f"{stem}.mp3"), sr, 2)
+            for stem in STEMS
+        }
+        tails = {}
+        try:
+            start = 0
+            while start < total:
+                if check_cancelled:
+                    check_cancelled()
+                end = min(start + chunk + overlap, total)
+                waveform = np.array(data[start:end], dtype=np.float32)
+                with registry.use(self.model_name) as separation_model:
+                    prediction = separation_model.separate(waveform)
+
+                last = end == total
+                for stem in STEMS:
+                    out = np.asarray(prediction[stem][: end - start], dtype=np.float32)
+                    if stem in tails:
+                        out = crossfade(tails[stem], out)
+                    if last:
+                        body = out
+                    else:
+                        # 重なり部分は次のチャンクとつなぐまで持っておく
+                        body, tails[stem] = out[:chunk], out[chunk:]
+                    encoders[stem].stdin.write(np.ascontiguousarray(body).tobytes())
 
-            print(f"分離処理が完了しました: {output_directory}")
-            return {"vocals": vocals_path, "accompaniment": accompaniment_path}
+                if on_progress:
+                    on_progress(end / total)
+                if last:
+                    break
+                start += chunk
+        except BaseException:
+            for encoder in encoders.values():
+                close_encoder(encoder, abort=True)
+            raise
+        for encoder in encoders.values():
+            close_encoder(encoder)
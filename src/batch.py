@@ -0,0 +1,270 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.audio.copy import collect_audio_files
+
+DEFAULT_STATE_PATH = os.path.join("data", "batch_state.jsonl")
+STAGES = ["ingest", "separate", "recognize", "pitch"]
+
+# ワーカープロセスごとに使い回す(モデルはプロセスにつき一度だけロードする)
+_worker_modules = None
+_worker_progressive = False
+
+
+def collect_items(paths, queries_file=None):
+    # ディレクトリを再帰的にたどって音源ファイルを集める
+    items = [("path", path) for path in collect_audio_files(paths)]
+
+    if queries_file:
+        with open(queries_file, "r", encoding="utf-8") as f:
+            for line in f:
+                query = line.strip()
+                if query and not query.startswith("#"):
+                    items.append(("query", query))
+    return items
+
+
+def item_id(kind, value):
+    # ファイルが差し替えられたら別物として扱う
+    if kind == "path":
+        stat = os.stat(value)
+        return f"path:{os.path.abspath(value)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return f"query:{value}"
+
+
+def load_state(state_path):
+    # 途中で落ちても完了済みの曲はやり直さない
+    done = set()
+    if not os.path.exists(state_path):
+        return done
+    with open(state_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 書きかけの行
+            if record.get("status") == "ok":
+                done.add(record["id"])
+    return done
+
+
+def append_state(state_path, record):
+    os.makedirs(os.path.dirname(state_path) or ".", exist_ok=True)
+    with open(state_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _init_worker(
+    model_size,
+    language,
+    backend,
+    separator_backend,
+    download_codec,
+    progressive=False,
+    threads=None,
+):
+    global _worker_modules, _worker_progressive
+    from src.audio.copy import Copy
+    from src.audio.download import Downloader
+    from src.audio.separator import Separator
+    from src.lyrics.recognizer import Recognizer
+    from src.pipeline.scheduler import Scheduler
+    from src.pitch.extractor import PitchExtractor
+
+    # threads を指定したら、推論のスレッド数とステージの並列数を絞る(裏で動かすとき用)
+    separator_options = {}
+    recognizer_options = {}
+    if threads and separator_backend == "onnx":
+        separator_options = {"intra_op_threads": threads, "inter_op_threads": 1}
+    if threads and backend == "faster-whisper":
+        recognizer_options = {"cpu_threads": threads}
+
+    _worker_modules = {
+        "scheduler": Scheduler(max_workers=1 if threads else 2),
+        "copy": Copy(max_workers=threads),
+        "downloader": Downloader(codec=download_codec),
+        "separator": Separator(
+            backend=separator_backend, backend_options=separator_options
+        ),
+        "recognizer": Recognizer(
+            model_size=model_size,
+            language=language,
+            backend=backend,
+            backend_options=recognizer_options,
+        ),
+        "pitch_extractor": PitchExtractor(),
+    }
+    # 音声認識のキャッシュのキーは認識の仕方で変わるので、GUIと同じ方法で認識しておく
+    _worker_progressive = progressive
+
+
+def _process_item(kind, value):
+    from src.pipeline.song import process_song
+
+    modules = dict(_worker_modules)
+    scheduler = modules.pop("scheduler")
+    start_time = time.perf_counter()
+    job = process_song(
+        path=value if kind == "path" else None,
+        query=value if kind == "query" else None,
+        scheduler=scheduler,
+        progressive=_worker_progressive,
+        **modules,
+    )
+    return {
+        "status": "ok" if job.succeeded else "error",
+        "elapsed": time.perf_counter() - start_time,
+        "timings": dict(job.timings),
+        "states": dict(job.states),
+        "errors": {name: str(error) for name, error in job.errors.items()},
+        "music_path": job.results.get("ingest"),
+    }
+
+
+def print_summary(records, skipped, elapsed):
+    ok = [r for r in records if r["status"] == "ok"]
+    failed = [r for r in records if r["status"] != "ok"]
+    print()
+    print(
+        f"処理: {len(records)}曲 (成功 {len(ok)}, 失敗 {len(failed)}, スキップ {skipped})"
+    )
+    print(f"経過時間: {elapsed:.1f}秒")
+    print(f"{'ステージ':<10}{'合計(秒)':>10}{'平均(秒)':>10}{'最大(秒)':>10}")
+    for stage in STAGES:
+        times = [r["timings"][stage] for r in records if stage in r["timings"]]
+        if times:
+            print(
+                f"{stage:<10}{sum(times):>10.1f}{sum(times) / len(times):>10.1f}{max(times):>10.1f}"
+            )
+    for record in failed:
+        print(f"失敗: {record['value']}: {record['errors']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="音源をまとめて前処理する(分離・音声認識・ピッチ解析)"
+    )
+    parser.add_argument("paths", nargs="*", help="音源ファイルまたはディレクトリ")
+    parser.add_argument(
+        "--queries", help="YouTubeの検索キーワードを1行ずつ書いたファイル"
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, default=1, help="ワーカープロセス数"
+    )
+    parser.add_argument(
+        "--state", default=DEFAULT_STATE_PATH, help="進捗の記録ファイル"
+    )
+    parser.add_argument(
+        "--restart", action="store_true", help="進捗の記録を無視して最初からやり直す"
+    )
+    parser.add_argument("--model-size", default="base", help="whisperのモデルサイズ")
+    parser.add_argument("--language", default="ja", help="音声認識の言語")
+    parser.add_argument(
+        "--backend",
+        default="whisper",
+        choices=["whisper", "faster-whisper"],
+        help="音声認識の実装 (faster-whisper はCTranslate2のint8推論)",
+    )
+    parser.add_argument(
+        "--separator-backend",
+        default="spleeter",
+        choices=["spleeter", "onnx"],
+        help="音源分離の実装 (onnx は書き出したモデルをONNX Runtimeで実行)",
+    )
+    parser.add_argument(
+        "--download-codec",
+        default=None,
+        help="ダウンロードした音声を変換する形式 (例: mp3)。指定しなければ配信されている形式のまま保存する",
+    )
+    parser.add_argument(
+        "--progressive",
+        action="store_true",
+        help="GUIと同じく、分離したボーカルで無音を飛ばしながら区間ごとに音声認識する (GUIで開いたときに認識結果のキャッシュが使われる)",
+    )
+    args = parser.parse_args(argv)
+
+    items = collect_items(args.paths, args.queries)
+    if not items:
+        parser.error("処理する音源がありません")
+
+    done = set() if args.restart else load_state(args.state)
+    pending = []
+    records = []
+    skipped = 0
+    for kind, value in items:
+        try:
+            identifier = item_id(kind, value)
+        except OSError as e:
+            # 読み込めないファイルは処理済みではなく失敗として数える
+            print(f"読み込めません: {value}: {e}")
+            records.append(
+                {
+                    "status": "error",
+                    "elapsed": 0.0,
+                    "timings": {},
+                    "states": {},
+                    "errors": {"read": str(e)},
+                    "kind": kind,
+                    "value": value,
+                }
+            )
+            continue
+        if identifier in done:
+            skipped += 1
+            continue
+        pending.append((identifier, kind, value))
+    print(
+        f"{len(items)}曲中 {len(pending)}曲を処理します (処理済み {skipped}曲, 読み込めない {len(records)}曲)"
+    )
+
+    start_time = time.perf_counter()
+    # TensorFlowはforkと相性が悪いのでspawnでワーカーを起動する
+    with ProcessPoolExecutor(
+        max_workers=max(1, args.workers),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(
+            args.model_size,
+            args.language,
+            args.backend,
+            args.separator_backend,
+            args.download_codec,
+            args.progressive,
+        ),
+    ) as executor:
+        futures = {
+            executor.submit(_process_item, kind, value): (identifier, kind, value)
+            for identifier, kind, value in pending
+        }
+        for i, future in enumerate(as_completed(futures), 1):
+            identifier, kind, value = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {
+                    "status": "error",
+                    "elapsed": 0.0,
+                    "timings": {},
+                    "states": {},
+                    "errors": {"worker": str(e)},
+                }
+            record = dict(result, id=identifier, kind=kind, value=value)
+            append_state(args.state, record)
+            records.append(record)
+            print(
+                f"[{i}/{len(pending)}] {record['status']}: {value} ({record['elapsed']:.1f}秒)"
+            )
+
+    print_summary(records, skipped, time.perf_counter() - start_time)
+    return 0 if all(r["status"] == "ok" for r in records) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,278 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from src.tracing.tracer import tracer
+
+CACHE_ROOT = os.path.join("data", "cache")
+DEFAULT_MAX_BYTES = 20 * 1024**3  # 20GB
+MANIFEST_NAME = "manifest.json"
+
+_digest_lock = threading.Lock()
+_digest_memo = {}  # (絶対パス, サイズ, 更新時刻) -> sha256
+
+
+def file_digest(path):
+    # 音源ファイルの内容ハッシュ(同じファイルは再計算しない)
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _digest_lock:
+        digest = _digest_memo.get(memo_key)
+    if digest:
+        return digest
+
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    with _digest_lock:
+        _digest_memo[memo_key] = digest
+    return digest
+
+
+def make_key(stage, source, params=None, version=1):
+    # 入力の内容 + 処理名 + パラメータ + コードのバージョンからキーを作る
+    payload = json.dumps(
+        {
+            "stage": stage,
+            "source": source,
+            "params": params or {},
+            "version": version,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def link_or_copy(src, dst):
+    # 同じファイルシステムならハードリンク、無理ならコピー
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    tmp_path = f"{dst}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+    return dst
+
+
+def write_json_atomic(path, data, **kwargs):
+    # 一時ファイルに書いてから置き換える(書きかけのファイルを残さない)
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, **kwargs)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ArtifactCache:
+    # data/cache/<stage>/<key>/ に成果物とmanifest.jsonを置く
+    # manifestにはファイルごとのサイズとハッシュを記録し、読み出し時に検証する
+    # manifestの更新時刻を最終アクセス時刻として、容量を超えたら古いものから消す
+
+    def __init__(self, root=CACHE_ROOT, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def entry_dir(self, stage, key):
+        return os.path.join(self.root, stage, key)
+
+    def _read_manifest(self, entry_dir):
+        try:
+            with open(
+                os.path.join(entry_dir, MANIFEST_NAME), "r", encoding="utf-8"
+            ) as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _verify(self, entry_dir, manifest):
+        paths = {}
+        for name, info in manifest.get("files", {}).items():
+            path = os.path.join(entry_dir, name)
+            try:
+                if os.path.getsize(path) != info["size"]:
+                    return None
+                if file_digest(path) != info["sha256"]:
+                    return None
+            except (OSError, KeyError):
+                return None
+            paths[name] = path
+        return paths
+
+    def lookup(self, stage, key):
+        # 検証に通った成果物のパス {ファイル名: パス} を返す。無ければNone
+        paths = self._lookup(stage, key)
+        # 実行中の処理のトレースに、最初に引いたときのキャッシュの当たり外れを残す
+        tracer.annotate_first(cache="hit" if paths else "miss")
+        return paths
+
+    def _lookup(self, stage, key):
+        entry_dir = self.entry_dir(stage, key)
+        if not os.path.isdir(entry_dir):
+            return None
+
+        manifest = self._read_manifest(entry_dir)
+        paths = self._verify(entry_dir, manifest) if manifest else None
+        if paths is None:
+            print(f"キャッシュが壊れているため破棄します: {entry_dir}")
+            self.invalidate(stage, key)
+            return None
+
+        # LRU用にアクセス時刻を更新
+        try:
+            os.utime(os.path.join(entry_dir, MANIFEST_NAME))
+        except OSError:
+            pass
+        return paths
+
+    def get_manifest(self, stage, key):
+        return self._read_manifest(self.entry_dir(stage, key))
+
+    @contextmanager
+    def write(self, stage, key, source=None, params=None, version=1, meta=None):
+        # 一時ディレクトリに成果物を書かせ、全部揃ってからまとめて公開する
+        tmp_root = os.path.join(self.root, ".tmp")
+        os.makedirs(tmp_root, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=f"{stage}-", dir=tmp_root)
+        try:
+            yield tmp_dir
+            self._commit(tmp_dir, stage, key, source, params, version, meta)
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def _commit(self, tmp_dir, stage, key, source, params, version, meta):
+        files = {}
+        for name in sorted(os.listdir(tmp_dir)):
+            path = os.path.join(tmp_dir, name)
+            if os.path.isfile(path):
+                files[name] = {
+                    "size": os.path.getsize(path),
+                    "sha256": file_digest(path),
+                }
+        if not files:
+            raise RuntimeError(f"キャッシュに保存する成果物がありません: {stage}")
+
+        manifest = {
+            "key": key,
+            "stage": stage,
+            "source": source,
+            "params": params or {},
+            "version": version,
+            "created": time.time(),
+            "size": sum(info["size"] for info in files.values()),
+            "files": files,
+            "meta": meta or {},
+        }
+        write_json_atomic(
+            os.path.join(tmp_dir, MANIFEST_NAME), manifest, ensure_ascii=False
+        )
+
+        entry_dir = self.entry_dir(stage, key)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        with self._lock:
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            try:
+                os.replace(tmp_dir, entry_dir)
+            except OSError:
+                # 別のプロセスが同じエントリを先に公開した
+                # (同じキーなら中身も同じなので、そちらを使って自分の分は捨てる)
+                if not os.path.exists(os.path.join(entry_dir, MANIFEST_NAME)):
+                    raise
+
+    def partial_path(self, stage, key):
+        # 少しずつ出来上がる成果物の途中経過 (JSON Lines)。完成したら write で正式に保存する
+        return os.path.join(self.root, ".partial", stage, f"{key}.jsonl")
+
+    def append_partial(self, stage, key, record):
+        path = self.partial_path(stage, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock, open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def read_partial(self, stage, key):
+        # 書き込み途中で落ちた最後の行は捨てる
+        records = []
+        try:
+            with open(self.partial_path(stage, key), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+        except OSError:
+            pass
+        return records
+
+    def clear_partial(self, stage, key):
+        try:
+            os.remove(self.partial_path(stage, key))
+        except OSError:
+            pass
+
+    def invalidate(self, stage, key):
+        entry_dir = self.entry_dir(stage, key)
+        with self._lock:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def entries(self):
+        # (最終アクセス時刻, サイズ, stage, key) の一覧
+        result = []
+        if not os.path.isdir(self.root):
+            return result
+        for stage in os.listdir(self.root):
+            stage_dir = os.path.join(self.root, stage)
+            if stage.startswith(".") or not os.path.isdir(stage_dir):
+                continue
+            for key in os.listdir(stage_dir):
+                manifest_path = os.path.join(stage_dir, key, MANIFEST_NAME)
+                try:
+                    last_access = os.path.getmtime(manifest_path)
+                    with open(manifest_path, "r", encoding="utf-8") as f:
+                        size = json.load(f).get("size", 0)
+                except (OSError, json.JSONDecodeError):
+                    continue
+                result.append((last_access, size, stage, key))
+        return result
+
+    def total_size(self):
+        return sum(size for _, size, _, _ in self.entries())
+
+    def evict(self, max_bytes=None):
+        # 容量を超えていたら最後に使われたのが古いものから削除する
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _, _ in entries)
+        evicted = []
+        for _, size, stage, key in entries:
+            if total <= max_bytes:
+                break
+            self.invalidate(stage, key)
+            total -= size
+            evicted.append((stage, key))
+        if evicted:
+            print(f"キャッシュを{len(evicted)}件削除しました")
+        return evicted
+
+
+# プロセス全体で共有するキャッシュ
+artifact_cache = ArtifactCache()
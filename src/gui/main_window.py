@@ -1,3 +1,5 @@
+import os
+
 from PyQt6.QtWidgets import (
     QMainWindow,
     QVBoxLayout,
@@ -8,8 +10,10 @@ from PyQt6.QtWidgets import (
     QMessageBox,
     QApplication,
     QSlider,
+    QListWidget,
+    QInputDialog,
 )
-from PyQt6.QtCore import pyqtSlot, QTimer, Qt, QThread, pyqtSignal
+from PyQt6.QtCore import pyqtSlot, QTimer, Qt, QObject, pyqtSignal
 from PyQt6.uic import loadUi
 from PyQt6.QtGui import QDragEnterEvent, QDropEvent
 
@@ -17,93 +21,57 @@ from PyQt6.QtGui import QDragEnterEvent, QDropEvent
 from src.gui.widgets.pitch_bar import PitchBar
 
 # モジュールをインポート
-from src.audio.copy import Copy
-from src.audio.download import Downloader
+from src.audio.pcm_cache import pcm_cache
+from src.audio.copy import AUDIO_EXTENSIONS, CONVERT_EXTENSIONS, Copy
+from src.audio.download import Downloader, DownloadQueue
 from src.audio.player import Player
 from src.audio.recorder import Recorder
 from src.audio.separator import Separator
+from src.pitch.analyzer import Analyzer
 from src.pitch.extractor import PitchExtractor
+from src.lyrics.aligner import read_lyrics, save_lyrics
 from src.lyrics.recognizer import Recognizer
 from src.lyrics.search import Search
+from src.lyrics.timeline import LyricsTimeline
+from src.pipeline.scheduler import Scheduler, Stage, PENDING, RUNNING
+from src.pipeline.prefetch import Prefetcher
+from src.pipeline.song import build_song_stages
+from src.tracing.tracer import tracer
 
+# パイプラインのステージ名と表示名
+STAGE_LABELS = {
+    "import": "音源の取り込み",
+    "ingest": "音源の準備",
+    "separate": "音源分離",
+    "recognize": "音声認識",
+    "pitch": "ピッチ解析",
+}
 
-class PitchExtractionThread(QThread):
-    finished_signal = pyqtSignal(list)
-    error_signal = pyqtSignal(str)
-
-    def __init__(self, audio_path):
-        super().__init__()
-        self.audio_path = audio_path
-        self.pitch_extractor = PitchExtractor()
-
-    def run(self):
-        try:
-            pitch_data = self.pitch_extractor.extract_pitch(self.audio_path)
-            self.finished_signal.emit(pitch_data)
-        except Exception as e:
-            self.error_signal.emit(str(e))
-
-
-class RecognitionThread(QThread):
-    finished_signal = pyqtSignal(list)
-    error_signal = pyqtSignal(str)
-    progress_signal = pyqtSignal(str)
 
-    def __init__(self, audio_path, parent=None):
-        super().__init__(parent)
-        self.audio_path = audio_path
-        self.recognizer = Recognizer()
-
-    def run(self):
-        self.progress_signal.emit("音声認識を実行中...")
-        try:
-            lyrics_data = self.recognizer.recognize_lyrics(self.audio_path)
-            if lyrics_data:
-                self.finished_signal.emit(lyrics_data)
-            else:
-                self.error_signal.emit("音声認識に失敗しました。")
-        except Exception as e:
-            self.error_signal.emit(f"音声認識エラー: {e}")
+def timed_init(name, factory):
+    # 起動時間の計測(--profile-startup)のために、各モジュールの初期化をspanで囲む
+    with tracer.span("startup.init", module=name):
+        return factory()
 
 
-class SeparationThread(QThread):
-    finished_signal = pyqtSignal(dict)
-    error_signal = pyqtSignal(str)
+def format_time(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
 
-    def __init__(self, input_path):
-        super().__init__()
-        self.input_path = input_path
-        self.separator = Separator()
 
-    def run(self):
-        try:
-            separated_paths = self.separator.separate(self.input_path)
-            self.finished_signal.emit(separated_paths)
-        except Exception as e:
-            self.error_signal.emit(str(e))
+class PipelineBridge(QObject):
+    # ワーカースレッドで発生したパイプラインのイベントをGUIスレッドに渡す
+    event_signal = pyqtSignal(object)
 
-
-class DownloadThread(QThread):
-    finished_signal = pyqtSignal(str)
-    error_signal = pyqtSignal(str)
-
-    def __init__(self, query):
-        super().__init__()
-        self.query = query
-        self.downloader = Downloader()
-
-    def run(self):
-        try:
-            output_path = self.downloader.download_music(self.query)
-            self.finished_signal.emit(output_path)
-        except Exception as e:
-            self.error_signal.emit(str(e))
+    def __call__(self, event):
+        self.event_signal.emit(event)
 
 
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
-        loadUi("src/gui/ui/main_window.ui", self)
+        with tracer.span("startup.init", module="loadUi"):
+            loadUi("src/gui/ui/main_window.ui", self)
 
         # ウィジェットの取得 (.uiのobjectName)
         self.lyrics_label = self.findChild(QLabel, "lyricsLabel")
@@ -117,6 +85,15 @@ class MainWindow(QMainWindow):
         self.score_label = self.findChild(QLabel, "scoreLabel")
         self.total_volume_slider = self.findChild(QSlider, "totalVolumeSlider")
         self.vocal_ratio_slider = self.findChild(QSlider, "vocalRatioSlider")
+        self.seek_slider = self.findChild(QSlider, "seekSlider")
+        self.time_label = self.findChild(QLabel, "timeLabel")
+        self.loop_a_button = self.findChild(QPushButton, "loopAButton")
+        self.loop_b_button = self.findChild(QPushButton, "loopBButton")
+        self.loop_clear_button = self.findChild(QPushButton, "loopClearButton")
+        self.reserve_button = self.findChild(QPushButton, "reserveButton")
+        self.next_button = self.findChild(QPushButton, "nextButton")
+        self.queue_list = self.findChild(QListWidget, "queueList")
+        self.align_button = self.findChild(QPushButton, "alignButton")
 
         # ドロップ/選択エリアの作成
         self.drop_area = QLabel("ここに音源ファイルをドロップしてください", self)
@@ -131,6 +108,7 @@ class MainWindow(QMainWindow):
         self.pause_button.clicked.connect(self.on_pause_clicked)
         self.stop_button.clicked.connect(self.on_stop_clicked)
         self.search_button.clicked.connect(self.on_search_clicked)
+        self.align_button.clicked.connect(self.on_align_clicked)
         self.drop_area.mousePressEvent = self.on_drop_area_clicked  # クリックイベント
         self.download_button.clicked.connect(self.on_download_clicked)
 
@@ -138,6 +116,17 @@ class MainWindow(QMainWindow):
         self.total_volume_slider.valueChanged.connect(self.on_total_volume_changed)
         self.vocal_ratio_slider.valueChanged.connect(self.on_vocal_ratio_changed)
 
+        # シークバーとA-Bループ
+        self.seek_slider.valueChanged.connect(self.on_seek_slider_changed)
+        self.seek_slider.sliderReleased.connect(self.on_seek_slider_released)
+        self.loop_a_button.clicked.connect(self.on_loop_a_clicked)
+        self.loop_b_button.clicked.connect(self.on_loop_b_clicked)
+        self.loop_clear_button.clicked.connect(self.on_loop_clear_clicked)
+
+        # 予約
+        self.reserve_button.clicked.connect(self.on_reserve_clicked)
+        self.next_button.clicked.connect(self.on_next_clicked)
+
         # ドロップイベントのオーバーライド
         self.drop_area.dragEnterEvent = self.dragEnterEvent
         self.drop_area.dropEvent = self.dropEvent
@@ -146,17 +135,58 @@ class MainWindow(QMainWindow):
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.update_pitch_bar)
         self.timer.timeout.connect(self.update_lyrics_display)  # 歌詞更新処理を追加
+        self.timer.timeout.connect(self.update_seek_bar)
+        self.timer.timeout.connect(self.refresh_score)
         self.timer.setInterval(50)  # 更新頻度(ms)
 
         # 他の処理系モジュールの初期化
-        self.audio_copy = Copy()
-        self.downloader = Downloader()
-        self.audio_player = Player()
-        self.audio_recorder = Recorder()
-        self.pitch_extractor = PitchExtractor()
-        self.lyric_search = Search()
-        self.recognizer = Recognizer()
-        self.recognition_thread = None
+        self.audio_copy = timed_init("Copy", Copy)
+        self.downloader = timed_init("Downloader", Downloader)
+        self.download_queue = DownloadQueue(self.downloader, max_workers=2)
+        self.audio_player = timed_init("Player", Player)
+        self.audio_recorder = timed_init("Recorder", Recorder)
+        self.pitch_extractor = timed_init("PitchExtractor", PitchExtractor)
+        self.analyzer = timed_init("Analyzer", Analyzer)
+        self.lyric_search = timed_init("Search", Search)
+        self.recognizer = timed_init("Recognizer", Recognizer)
+        self.separator = timed_init("Separator", Separator)
+
+        # モデルはウィンドウを表示してからバックグラウンドでロードする(各スレッドは同じインスタンスを使う)
+        self.warmup_bridge = PipelineBridge(self)
+        self.warmup_bridge.event_signal.connect(self.on_warmup_finished)
+        self.warmup_pending = set()
+        self.warmup_threads = []
+        QTimer.singleShot(0, self.start_warmup)
+
+        # 曲ごとの処理(準備 -> 分離 -> 認識/ピッチ解析)はスケジューラで実行する
+        self.scheduler = Scheduler(max_workers=2)
+        self.pipeline_bridge = PipelineBridge(self)
+        self.pipeline_bridge.event_signal.connect(self.on_pipeline_event)
+        self.current_job = None
+
+        # 複数の曲やフォルダをドロップしたときは、まとめて取り込んでから最初の曲を処理する
+        self.ingest_bridge = PipelineBridge(self)
+        self.ingest_bridge.event_signal.connect(self.on_ingest_event)
+        self.ingest_job = None
+
+        # 予約した曲は、今の曲を歌っている間に別のプロセスで前処理しておく
+        # (優先度を下げてスレッド数も絞るので、再生やGUIの邪魔をしない)
+        # GUIと同じ認識方法にしておかないと、音声認識のキャッシュが使われない
+        self.prefetcher = Prefetcher(progressive=True)
+        self.prefetch_bridge = PipelineBridge(self)
+        self.prefetch_bridge.event_signal.connect(self.on_prefetch_finished)
+        self.song_queue = []  # {"kind": "path"/"query", "value", "title", "state"}
+        self.waiting_entry = None  # 「次の曲」を押したが、まだ前処理中の曲
+
+        # 貼り付けた正しい歌詞を、音声認識の時刻に合わせる
+        self.align_bridge = PipelineBridge(self)
+        self.align_bridge.event_signal.connect(self.on_align_event)
+        self.align_job = None
+
+        # 録音スレッドで推定した歌声のピッチも同じ仕組みでGUIスレッドに渡す
+        self.recorder_bridge = PipelineBridge(self)
+        self.recorder_bridge.event_signal.connect(self.on_sung_pitch)
+        self.audio_recorder.add_listener(self.recorder_bridge)
 
         # 初期設定
         self.current_song_path = ""  # 現在の曲のパス
@@ -170,8 +200,10 @@ class MainWindow(QMainWindow):
         self.recognized_lyrics = []  # 音声認識された歌詞を保存するリスト
         self.current_lyric_index = 0  # 現在表示中の歌詞のインデックス
 
-        self.current_segment_index = 0  # 現在表示中のフレーズのインデックス
-        self.current_word_index = 0  # 現在色付け中の単語のインデックス
+        # 時刻から表示するフレーズと単語を引くためのタイムライン
+        self.lyrics_timeline = LyricsTimeline([])
+        self.last_lyrics_state = None  # 前回表示した状態(変化したときだけ描き直す)
+        self.loop_a = None  # A-Bループの開始位置(秒)
 
         self.lyrics_label = self.findChild(QLabel, "lyricsLabel")
         self.lyrics_label.setTextFormat(Qt.TextFormat.RichText)  # リッチテキストを有効
@@ -179,11 +211,45 @@ class MainWindow(QMainWindow):
             True
         )  # 長い歌詞がウィンドウの幅を超えないようにする
 
-        # 各種スレッドを保持する変数を初期化
-        self.download_thread = None
-        self.separation_thread = None
-        self.recognition_thread = None
-        self.pitch_extraction_thread = None
+    def start_warmup(self):
+        # 分離と認識のモデル(TensorFlow, PyTorchのimportも含む)を裏で読み込み、状況をステータスバーに出す
+        for label, module in (
+            ("音源分離", self.separator),
+            ("音声認識", self.recognizer),
+        ):
+            thread = module.preload(
+                callback=lambda name, error, label=label: self.warmup_bridge(
+                    (label, error)
+                )
+            )
+            if thread is not None:
+                self.warmup_pending.add(label)
+                self.warmup_threads.append(thread)
+        self.show_warmup_status()
+
+    def wait_warmup(self, timeout=None):
+        for thread in self.warmup_threads:
+            thread.join(timeout)
+
+    def on_warmup_finished(self, result):
+        label, error = result
+        self.warmup_pending.discard(label)
+        if error is not None:
+            self.statusBar().showMessage(
+                f"{label}のモデルを読み込めませんでした: {error}"
+            )
+        else:
+            self.show_warmup_status()
+
+    def show_warmup_status(self):
+        # 曲の処理中はその進捗を優先して表示する
+        if self.current_job is not None and not self.current_job.done:
+            return
+        if self.warmup_pending:
+            labels = "、".join(sorted(self.warmup_pending))
+            self.statusBar().showMessage(f"モデルを読み込んでいます: {labels}...")
+        else:
+            self.statusBar().showMessage("モデルの準備ができました")
 
     def dragEnterEvent(self, event: QDragEnterEvent):
         if event.mimeData().hasUrls():
@@ -191,23 +257,75 @@ class MainWindow(QMainWindow):
 
     def dropEvent(self, event: QDropEvent):
         if event.mimeData().hasUrls():
-            url = event.mimeData().urls()[0]
-            file_path = url.toLocalFile()
-            self.music_path = self.audio_copy.copy_music(file_path)
-            self.process_audio_file(self.music_path)
+            paths = [url.toLocalFile() for url in event.mimeData().urls()]
+            self.open_files(paths)
 
     def on_drop_area_clicked(self, event):
         options = QFileDialog.Option.DontUseNativeDialog
-        file_name, _ = QFileDialog.getOpenFileName(
+        extensions = " ".join(
+            f"*{ext}" for ext in sorted(AUDIO_EXTENSIONS | CONVERT_EXTENSIONS)
+        )
+        file_names, _ = QFileDialog.getOpenFileNames(
             self,
             "音源ファイルを選択してください",
             "",
-            "Audio Files (*.mp3 *.wav *.ogg)",
+            f"Audio Files ({extensions})",
             options=options,
         )
-        if file_name:
-            self.music_path = self.audio_copy.copy_music(file_name)
-            self.process_audio_file(self.music_path)
+        if file_names:
+            self.open_files(file_names)
+
+    def open_files(self, paths):
+        # 1曲ならそのまま処理し、複数の曲やフォルダならまとめて取り込む
+        if len(paths) == 1 and os.path.isfile(paths[0]):
+            if self.is_busy():
+                self.reserve_song("path", paths[0])
+            else:
+                self.process_song(path=paths[0])
+            return
+        if self.ingest_job and not self.ingest_job.done:
+            self.ingest_job.cancel()
+
+        def run(ctx):
+            return self.audio_copy.ingest(
+                paths, on_progress=ctx.progress, check_cancelled=ctx.check_cancelled
+            )
+
+        self.ingest_job = self.scheduler.submit(
+            [Stage("import", run)], name="import", listener=self.ingest_bridge
+        )
+
+    def on_ingest_event(self, event):
+        if event.job is not self.ingest_job:
+            return
+        if event.kind == "progress":
+            self.statusBar().showMessage(
+                f"音源を取り込んでいます: {event.progress * 100:.0f}%"
+            )
+        elif event.kind == "failed":
+            QMessageBox.critical(
+                self, "エラー", f"音源の取り込み中にエラーが発生しました: {event.value}"
+            )
+        elif event.kind == "done" and event.job.succeeded:
+            items = event.job.results["import"]
+            imported = [
+                item.input_path
+                for item in items
+                if item.output_path and item.duplicate_of is None
+            ]
+            duplicates = sum(1 for item in items if item.duplicate_of)
+            failed = sum(1 for item in items if not item.output_path)
+            print(
+                f"{len(imported)}曲を取り込みました (重複 {duplicates}曲, 失敗 {failed}曲)"
+            )
+            if not imported:
+                self.statusBar().showMessage("取り込める音源がありませんでした")
+                return
+            if not self.is_busy():
+                # 取り込み済みなので、ingestステージはキャッシュから一瞬で終わる
+                self.process_song(path=imported.pop(0))
+            for path in imported:
+                self.reserve_song("path", path)
 
     def on_download_clicked(self):
         self.query = self.download_input.text()
@@ -220,19 +338,88 @@ class MainWindow(QMainWindow):
             # self.download_progress_dialog.setModal(True)
             # self.download_progress_dialog.show()
 
-            self.download_thread = DownloadThread(self.query)
-            self.download_thread.finished_signal.connect(self.on_download_finished)
-            self.download_thread.error_signal.connect(self.on_download_error)
-            self.download_thread.start()
+            if self.is_busy():
+                self.reserve_song("query", self.query)
+            else:
+                self.process_song(query=self.query)
         else:
             print(f"検索キーワードが入力されていません。")
             QMessageBox.warning(self, "警告", "検索キーワードが入力されていません。")
 
-    def on_download_finished(self, output_file):
-        # self.download_progress_dialog.close()
-        self.music_path = output_file
-        # DLが完了後、処理を開始する
-        self.process_audio_file(output_file)
+    def on_reserve_clicked(self):
+        query = self.download_input.text()
+        if query:
+            self.reserve_song("query", query)
+        else:
+            QMessageBox.warning(self, "警告", "検索キーワードが入力されていません。")
+
+    def is_busy(self):
+        # 歌っている(再生中・一時停止中)なら、新しい曲は割り込ませずに予約する
+        return self.audio_player.is_playing() or self.audio_player.is_paused()
+
+    def reserve_song(self, kind, value):
+        entry = {
+            "kind": kind,
+            "value": value,
+            "title": os.path.basename(value) if kind == "path" else value,
+            "state": "前処理中",
+        }
+        self.song_queue.append(entry)
+        entry["result"] = self.prefetcher.submit(
+            kind,
+            value,
+            callback=lambda record, error: self.prefetch_bridge((entry, record, error)),
+        )
+        self.refresh_queue_list()
+        self.statusBar().showMessage(f"予約しました: {entry['title']}")
+
+    def on_prefetch_finished(self, result):
+        entry, record, error = result
+        if error is not None or record["status"] != "ok":
+            entry["state"] = "前処理に失敗"
+            print(
+                f"予約した曲の前処理に失敗しました: {entry['title']}: {error or record['errors']}"
+            )
+        else:
+            entry["state"] = "準備完了"
+            if record.get("music_path"):
+                # 検索し直さなくて済むように、取得済みの音源を使う
+                entry["kind"], entry["value"] = "path", record["music_path"]
+        self.refresh_queue_list()
+        if entry is self.waiting_entry:
+            # 前処理が終わるのを待っていた曲を始める(失敗したステージだけGUIでやり直す)
+            self.process_song(**{entry["kind"]: entry["value"]})
+
+    def refresh_queue_list(self):
+        self.queue_list.clear()
+        for i, entry in enumerate(self.song_queue, 1):
+            self.queue_list.addItem(f"{i}. {entry['title']} ({entry['state']})")
+
+    def on_next_clicked(self):
+        if not self.song_queue:
+            self.statusBar().showMessage("予約された曲がありません")
+            return
+        entry = self.song_queue.pop(0)
+        self.refresh_queue_list()
+        self.on_stop_clicked()
+        if not entry["result"].ready():
+            # 裏のプロセスと同じ曲を同時に処理しないよう、前処理が終わるのを待ってから始める
+            self.waiting_entry = entry
+            self.statusBar().showMessage(
+                f"前処理が終わったら始めます: {entry['title']}"
+            )
+            return
+        # 前処理が終わっていれば、どのステージもキャッシュからすぐに終わる
+        self.process_song(**{entry["kind"]: entry["value"]})
+
+    def closeEvent(self, event):
+        # 処理中の曲・ダウンロードを止めないと、ウィンドウを閉じてもプロセスが残る
+        if self.current_job and not self.current_job.done:
+            self.current_job.cancel()
+        self.scheduler.shutdown(wait=False, cancel=True)
+        self.download_queue.shutdown(wait=False, cancel=True)
+        self.prefetcher.shutdown()
+        super().closeEvent(event)
 
     def on_download_error(self, error_message):
         # self.download_progress_dialog.close()
@@ -240,21 +427,100 @@ class MainWindow(QMainWindow):
             self, "エラー", f"音源ダウンロード中にエラーが発生しました: {error_message}"
         )
 
-    def process_audio_file(self, file_path):
-        self.current_song_path = file_path
-        self.start_separation(file_path)
-        self.start_recognition(file_path)
-        # self.start_pitch_extraction(file_path)
+    def process_song(self, path=None, query=None):
+        self.waiting_entry = None  # 別の曲を始めたら、待っていた曲は始めない
+        # 前の曲の処理が残っていればキャンセルする
+        if self.current_job and not self.current_job.done:
+            print(f"前の曲の処理をキャンセルします: {self.current_job.name}")
+            self.current_job.cancel()
+        # 前の曲のデコード結果(mmap)を手放す(ファイルはキャッシュに残るので、また開けばすぐ読める)
+        pcm_cache.release()
 
-    def start_pitch_extraction(self, audio_path):
-        self.pitch_extraction_thread = PitchExtractionThread(audio_path)
-        self.pitch_extraction_thread.finished_signal.connect(
-            self.on_pitch_extraction_finished
+        self.current_song_path = ""
+        self.separated_song_paths = {}
+        self.accompaniment_path = None
+        self.vocals_path = None
+        self.recognized_lyrics = []
+        self.pitch_data = []
+
+        stages = build_song_stages(
+            path=path,
+            query=query,
+            copy=self.audio_copy,
+            downloader=self.downloader,
+            download_queue=self.download_queue,
+            separator=self.separator,
+            recognizer=self.recognizer,
+            pitch_extractor=self.pitch_extractor,
+            progressive=True,  # 歌詞は認識できたところから表示する
         )
-        self.pitch_extraction_thread.error_signal.connect(
-            self.on_pitch_extraction_error
+        self.current_job = self.scheduler.submit(
+            stages,
+            name=path or query,
+            params={"path": path, "query": query},
+            listener=self.pipeline_bridge,
         )
-        self.pitch_extraction_thread.start()
+
+    def on_pipeline_event(self, event):
+        # 差し替えられた曲のイベントは無視する
+        if event.job is not self.current_job:
+            return
+
+        label = STAGE_LABELS.get(event.stage, event.stage)
+        if event.kind == "started":
+            self.statusBar().showMessage(f"{label}を実行中...")
+        elif event.kind == "progress":
+            self.statusBar().showMessage(f"{label}: {event.progress * 100:.0f}%")
+        elif event.kind == "segment":
+            self.on_lyrics_segment(event.value)
+        elif event.kind == "finished":
+            if event.stage == "ingest":
+                self.on_ingest_finished(event.value)
+            elif event.stage == "separate":
+                self.on_separation_finished(event.value)
+            elif event.stage == "recognize":
+                self.on_recognition_finished(event.value)
+            elif event.stage == "pitch":
+                self.on_pitch_extraction_finished(event.value)
+        elif event.kind == "failed":
+            error_message = str(event.value)
+            if event.stage == "ingest":
+                if event.job.params.get("query"):
+                    self.on_download_error(error_message)
+                else:
+                    QMessageBox.critical(
+                        self,
+                        "エラー",
+                        f"音源の読み込み中にエラーが発生しました: {error_message}",
+                    )
+            elif event.stage == "separate":
+                self.on_separation_error(error_message)
+            elif event.stage == "recognize":
+                self.on_recognition_error(error_message)
+            elif event.stage == "pitch":
+                self.on_pitch_extraction_error(error_message)
+        elif event.kind == "done":
+            timings = self.format_timings(event.job)
+            if event.job.succeeded:
+                self.statusBar().showMessage(f"準備完了 ({timings})")
+            else:
+                self.statusBar().showMessage(f"処理が中断されました ({timings})")
+
+    def format_timings(self, job):
+        # 各ステージの時間と、キャッシュから読み込んだかどうかをトレースから集計する
+        summary = tracer.summary(job.name)
+        parts = []
+        for name, elapsed in job.timings.items():
+            text = f"{STAGE_LABELS.get(name, name)} {elapsed:.1f}秒"
+            stage = summary.get(f"stage.{name}")
+            if stage and stage["cache_hits"]:
+                text += "(キャッシュ)"
+            parts.append(text)
+        return ", ".join(parts)
+
+    def on_ingest_finished(self, music_path):
+        self.music_path = music_path
+        self.current_song_path = music_path
 
     def on_pitch_extraction_finished(self, pitch_data):
         self.pitch_data = pitch_data
@@ -262,52 +528,40 @@ class MainWindow(QMainWindow):
         # ピッチ解析が完了したら、ピッチバーウィジェットにデータを設定
         self.pitch_bar_widget.set_pitch_data(pitch_data)
         self.pitch_bar_widget.reset()
+        self.analyzer.set_target(pitch_data)
 
     def on_pitch_extraction_error(self, error_message):
         QMessageBox.critical(
             self, "エラー", f"ピッチ解析中にエラーが発生しました: {error_message}"
         )
 
-    def start_recognition(self, audio_path):
-        # self.recognition_progress_dialog = QProgressDialog(
-        #     "音声認識を実行中...", None, 0, 0, self
-        # )
-        # self.recognition_progress_dialog.setCancelButtonText(None)
-        # self.recognition_progress_dialog.setModal(True)
-        # self.recognition_progress_dialog.show()
-
-        self.recognition_thread = RecognitionThread(audio_path, self)
-        self.recognition_thread.finished_signal.connect(self.on_recognition_finished)
-        self.recognition_thread.error_signal.connect(self.on_recognition_error)
-        # self.recognition_thread.progress_signal.connect(
-        #     self.recognition_progress_dialog.setLabelText
-        # )
-        self.recognition_thread.start()
-
     def on_recognition_finished(self, lyrics_data):
         # self.recognition_progress_dialog.close()
         self.recognized_lyrics = lyrics_data
         # QMessageBox.information(self, "完了", "音声認識が完了しました。")
-        self.current_segment_index = 0  # 音声認識完了時にリセット
+        self.lyrics_timeline = LyricsTimeline(lyrics_data)
+        self.analyzer.set_segments(lyrics_data)  # フレーズごとの点数を出す
+        self.last_lyrics_state = None
         self.lyrics_label.setText("")
 
+    def on_lyrics_segment(self, segment):
+        # 区間ごとの認識結果が届いたら歌詞に追加する(再生中でもそのまま反映される)
+        self.recognized_lyrics = self.recognized_lyrics + [segment]
+        self.lyrics_timeline = LyricsTimeline(self.recognized_lyrics)
+        self.analyzer.set_segments(self.recognized_lyrics)
+        self.last_lyrics_state = None
+
+    def recognition_pending(self):
+        return self.current_job is not None and self.current_job.states.get(
+            "recognize"
+        ) in (PENDING, RUNNING)
+
     def on_recognition_error(self, error_message):
         # self.recognition_progress_dialog.close()
         QMessageBox.critical(
             self, "エラー", f"音声認識中にエラーが発生しました: {error_message}"
         )
 
-    def start_separation(self, input_path):
-        # self.progress_dialog = QProgressDialog("音源分離処理中...", None, 0, 0, self)
-        # self.progress_dialog.setCancelButtonText(None)
-        # self.progress_dialog.setModal(True)
-        # self.progress_dialog.show()
-
-        self.separation_thread = SeparationThread(input_path)
-        self.separation_thread.finished_signal.connect(self.on_separation_finished)
-        self.separation_thread.error_signal.connect(self.on_separation_error)
-        self.separation_thread.start()
-
     def on_separation_finished(self, separated_paths):
         # self.progress_dialog.close()
         self.separated_song_paths = separated_paths
@@ -325,16 +579,7 @@ class MainWindow(QMainWindow):
         #         self, "警告", "ボーカルファイルが見つかりませんでした。"
         #     )
 
-        # ピッチ解析を開始 (ボーカルに対して実行)
-        if vocals_path:
-            self.start_pitch_extraction(vocals_path)
-        else:
-            QMessageBox.warning(
-                self, "警告", "ボーカルファイルが見つかりませんでした。"
-            )
-
-        # ここにおけばOK押す前に次の処理が開始されると予想
-        # QMessageBox.information(self, "完了", "音源分離が完了しました。")
+        # ピッチ解析(ボーカルに対して実行)はスケジューラが分離の完了後に開始する
 
     def on_separation_error(self, error_message):
         # self.progress_dialog.close()
@@ -348,7 +593,7 @@ class MainWindow(QMainWindow):
             not self.current_song_path
             or not self.accompaniment_path
             or not self.vocals_path
-            or not self.recognized_lyrics
+            or not (self.recognized_lyrics or self.recognition_pending())
             or not self.pitch_data
         ):
             QMessageBox.warning(
@@ -359,9 +604,10 @@ class MainWindow(QMainWindow):
             return
 
         # 一時停止中かどうかの判定
-        if self.audio_player.pause_time:
+        if self.audio_player.is_paused():
             # 一時停止中からの再開
             self.audio_player.resume()
+            self.start_recording()
         else:
             # 新規再生
             self.audio_player.play(self.vocals_path, self.accompaniment_path)
@@ -370,8 +616,13 @@ class MainWindow(QMainWindow):
             self.pitch_bar_widget.reset()
 
             self.current_lyric_index = 0
-            self.current_word_index = 0
+            self.last_lyrics_state = None
+            self.loop_a = None
+            self.seek_slider.setMaximum(int(self.audio_player.get_duration() * 1000))
             self.update_lyrics_display()
+            self.analyzer.reset()
+            self.update_score(0)
+            self.start_recording()
 
         self.timer.start()
 
@@ -379,18 +630,35 @@ class MainWindow(QMainWindow):
     def on_pause_clicked(self):
         print("一時停止")
         self.audio_player.pause()
+        self.audio_recorder.stop_recording()
         self.timer.stop()
 
     @pyqtSlot()
     def on_stop_clicked(self):
         print("再生停止")
         self.audio_player.stop()
+        self.audio_recorder.stop_recording()
         self.timer.stop()
         self.lyrics_label.setText("")  # 停止時に歌詞表示をクリア
         self.pitch_bar_widget.reset()
 
-        self.current_segment_index = 0  # 停止時にリセット
-        self.current_word_index = 0
+        self.last_lyrics_state = None  # 停止時にリセット
+        self.loop_a = None
+        self.update_seek_bar()
+
+    def start_recording(self):
+        # マイクが無い環境でも再生は続けられるようにする
+        try:
+            self.audio_recorder.start_recording()
+        except Exception as e:
+            print(f"録音を開始できませんでした: {e}")
+
+    def on_sung_pitch(self, frame):
+        # 録音側の時刻を曲の時刻に直す (今の再生位置から、そのフレームがどれだけ前の音か)
+        delay = self.audio_recorder.current_time() - frame.time
+        song_time = self.audio_player.get_current_time() - delay
+        self.pitch_bar_widget.add_sung_pitch(song_time, frame.pitch)
+        self.analyzer.add_frame(song_time, frame.pitch)
 
     @pyqtSlot()
     def on_search_clicked(self):
@@ -400,6 +668,47 @@ class MainWindow(QMainWindow):
 
         self.lyric_search.search_lyrics(self.current_song_path)
 
+    def on_align_clicked(self):
+        if not self.current_song_path:
+            QMessageBox.warning(self, "警告", "音源ファイルが選択されていません。")
+            return
+        text, ok = QInputDialog.getMultiLineText(
+            self,
+            "歌詞を合わせる",
+            "正しい歌詞を貼り付けてください(1行が1フレーズになります)",
+            read_lyrics(self.current_song_path) or "",
+        )
+        if not ok or not text.strip():
+            return
+        # 次にこの曲を開いたときも、音声認識のあとに自動で合わせる
+        save_lyrics(self.current_song_path, text)
+        if self.recognition_pending():
+            self.statusBar().showMessage("音声認識が終わったら歌詞を合わせます")
+            return
+
+        music_path, recognized = self.current_song_path, self.recognized_lyrics
+
+        def run(ctx):
+            segments = self.recognizer.align_lyrics(
+                music_path, text, recognized=recognized
+            )
+            if not segments:
+                raise RuntimeError("歌詞を合わせられませんでした。")
+            return segments
+
+        self.align_job = self.scheduler.submit(
+            [Stage("align", run)], name=music_path, listener=self.align_bridge
+        )
+
+    def on_align_event(self, event):
+        if event.job is not self.align_job:
+            return
+        if event.kind == "finished":
+            self.on_recognition_finished(event.value)
+            self.statusBar().showMessage("歌詞を合わせました")
+        elif event.kind == "failed":
+            QMessageBox.critical(self, "エラー", str(event.value))
+
     @pyqtSlot()
     def update_pitch_bar(self):
         # 音程バーの更新処理
@@ -407,6 +716,66 @@ class MainWindow(QMainWindow):
             current_time = self.audio_player.get_current_time()
             self.pitch_bar_widget.update_position(current_time)
 
+    def update_seek_bar(self):
+        current_time = self.audio_player.get_current_time()
+        duration = self.audio_player.get_duration()
+        # ドラッグ中はユーザーの操作を優先する
+        if not self.seek_slider.isSliderDown():
+            self.seek_slider.blockSignals(True)
+            self.seek_slider.setValue(int(current_time * 1000))
+            self.seek_slider.blockSignals(False)
+        self.time_label.setText(
+            f"{format_time(current_time)} / {format_time(duration)}"
+        )
+
+    def on_seek_slider_changed(self, value):
+        # ドラッグ中は離したときに移動する(クリックやキー操作はすぐに移動)
+        if not self.seek_slider.isSliderDown():
+            self.seek_to(value / 1000)
+
+    def on_seek_slider_released(self):
+        self.seek_to(self.seek_slider.value() / 1000)
+
+    def seek_to(self, seconds):
+        if not self.audio_player.mixer:
+            return
+        self.audio_player.seek(seconds)
+        self.pitch_bar_widget.clear_sung_pitch()  # 前の位置で歌ったピッチは消す
+        # 歌詞と音程バーを新しい位置にすぐ合わせる
+        current_time = self.audio_player.get_current_time()
+        self.sync_lyrics_position(current_time)
+        self.pitch_bar_widget.update_position(current_time)
+        self.update_seek_bar()
+        if self.audio_player.is_playing() and not self.timer.isActive():
+            self.timer.start()
+
+    def on_loop_a_clicked(self):
+        if not self.audio_player.mixer:
+            return
+        self.loop_a = self.audio_player.get_current_time()
+        self.statusBar().showMessage(f"ループ開始位置: {format_time(self.loop_a)}")
+
+    def on_loop_b_clicked(self):
+        if not self.audio_player.mixer or self.loop_a is None:
+            QMessageBox.warning(self, "警告", "先にAで開始位置を指定してください。")
+            return
+        loop_b = self.audio_player.get_current_time()
+        if loop_b <= self.loop_a:
+            QMessageBox.warning(
+                self, "警告", "終了位置は開始位置より後にしてください。"
+            )
+            return
+        self.audio_player.set_loop(self.loop_a, loop_b)
+        self.statusBar().showMessage(
+            f"ループ再生: {format_time(self.loop_a)} - {format_time(loop_b)}"
+        )
+        self.seek_to(self.loop_a)
+
+    def on_loop_clear_clicked(self):
+        self.loop_a = None
+        self.audio_player.clear_loop()
+        self.statusBar().showMessage("ループを解除しました")
+
     def on_total_volume_changed(self, value):
         self.update_volumes()
 
@@ -427,77 +796,47 @@ class MainWindow(QMainWindow):
     def set_pitch_data(self, pitch_data):
         self.pitch_data = pitch_data
 
+    def sync_lyrics_position(self, current_time):
+        # シークやループで位置が飛んだら、その位置の表示にすぐ合わせる
+        self.last_lyrics_state = None
+        self.show_lyrics_at(current_time)
+
     def update_lyrics_display(self):
         if not self.audio_player.is_playing() or not self.recognized_lyrics:
             return
+        self.show_lyrics_at(self.audio_player.get_current_time())
 
-        current_time = self.audio_player.get_current_time()
-
-        if self.current_segment_index < len(self.recognized_lyrics):
-            segment = self.recognized_lyrics[self.current_segment_index]
-            next_segment = (
-                self.recognized_lyrics[self.current_segment_index + 1]
-                if self.current_segment_index + 1 < len(self.recognized_lyrics)
-                else None
-            )
-            if current_time >= round(segment["end"], 2):
-                # 現在のフレーズの終了時間を過ぎたら、次のフレーズへ
-                self.current_segment_index += 1
-                self.lyrics_label.setText("")  # 次のフレーズ表示前にクリア
-                # 次のフレーズが存在すれば、すぐに表示
-                if self.current_segment_index < len(self.recognized_lyrics):
-                    self.display_karaoke_text(
-                        self.recognized_lyrics[self.current_segment_index], next_segment
-                    )
-            elif round(segment["start"], 2) <= current_time:
-                # 現在のフレーズを表示
-                self.display_karaoke_text(segment, next_segment)
-            else:
-                # まだフレーズの開始時間になっていない
-                self.display_karaoke_text(segment, next_segment)
-                pass
-        elif (
-            self.recognized_lyrics and current_time >= self.recognized_lyrics[-1]["end"]
-        ):
-            # 全てのフレーズを表示し終えた場合
-            self.lyrics_label.setText("")
-            self.timer.stop()
+    def show_lyrics_at(self, current_time):
+        # 時刻から直接表示状態を求めるので、時間が前後に飛んでもずれない
+        state = self.lyrics_timeline.state_at(current_time)
+        if state == self.last_lyrics_state:
+            return
+        self.last_lyrics_state = state
+        self.lyrics_label.setText(self.lyrics_timeline.render_html(state))
 
-    def display_karaoke_text(self, segment, next_segment):
-        karaoke_text = ""
-        current_time = self.audio_player.get_current_time()
+    def refresh_score(self):
+        # 採点は歌声のフレームごとに進むので、表示はタイマーの間隔でまとめて更新する
+        if self.analyzer.frames:
+            self.update_score(self.analyzer.score())
 
-        for word_info in segment["words"]:
-            if round(segment["start"], 2) <= current_time < round(segment["end"], 2):
-                ratio = (
-                    (current_time - word_info["start"])
-                    / (word_info["end"] - word_info["start"])
-                    if (word_info["end"] - word_info["start"]) > 0
-                    else 0
-                )
-                highlight_length = int(len(word_info["word"]) * ratio)
-                highlighted_word = f"<span style='color: red; font-size: 20px;'>{word_info['word'][:highlight_length]}</span>{word_info['word'][highlight_length:]}"
-                karaoke_text += " " + highlighted_word
-            elif current_time >= word_info["end"]:
-                karaoke_text += (
-                    " " + f"<span style='color: red;'>{word_info['word']}</span>"
+    def update_score(self, score):
+        # 全体の点数と、最後に歌ったフレーズの点数を出す(フレーズごとの一覧はツールチップ)
+        text = f"スコア: {score:.1f}"
+        phrase_scores = self.analyzer.phrase_scores()
+        sung = [(i, s) for i, s in enumerate(phrase_scores) if s is not None]
+        if sung:
+            index, phrase_score = sung[-1]
+            text += f"  (フレーズ{index + 1}: {phrase_score:.1f})"
+        self.score_label.setText(text)
+        self.score_label.setToolTip(
+            "\n".join(
+                f"{i}. {segment['text'].strip()}: " + ("-" if s is None else f"{s:.1f}")
+                for i, (segment, s) in enumerate(
+                    zip(self.recognized_lyrics, phrase_scores), 1
                 )
-            else:
-                karaoke_text += " " + word_info["word"]
-
-        # TODO いい感じに調整
-        karaoke_text += (
-            "<br><br><span style='font-size: 10px;'>" + next_segment["text"] + "</span>"
-            if next_segment
-            else ""
+            )
         )
 
-        self.lyrics_label.setText(karaoke_text)
-
-    # TODO: さいてん、する、、？
-    def update_score(self, score):
-        self.score_label.setText(f"スコア: {score}")
-
 
 def main():
     app = QApplication([])
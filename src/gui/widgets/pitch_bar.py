@@ -1,55 +1,123 @@
 from PyQt6.QtWidgets import QWidget
-from PyQt6.QtGui import QPainter, QPen, QColor, QFont
-from PyQt6.QtCore import Qt, QRectF
-import librosa
+from PyQt6.QtGui import QPainter, QPen, QColor, QFont, QPixmap
+from PyQt6.QtCore import Qt, QRectF, QPointF
+from collections import deque
+import numpy as np
+
+from src.pitch.track import PitchTrack
+
+NOTE_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+
+
+def midi_to_note(midi_note):
+    # librosa.midi_to_note と同じ表記 (60 -> C4)
+    return f"{NOTE_NAMES[midi_note % 12]}{midi_note // 12 - 1}"
 
 
 class PitchBar(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.pitch_data = []  # 解析されたピッチデータを保持するリスト
+        self.pitch_data = PitchTrack.empty()  # 解析されたピッチデータ
         self.current_position = 0  # 現在の再生位置（秒）
         self.note_range = (36, 84)  # 表示するMIDIノートの範囲 (C2からB6)
         self.note_height = 4  # 各ノートの高さ
         self.position_line_x = 100  # 現在の再生位置を示す線のX座標
         self.scroll_offset = 0  # スクロールオフセット
+        self.pixels_per_second = 50  # 1秒あたりのピクセル数
+
+        # 描画用に前計算したデータ
+        self.note_names = {
+            midi_note: midi_to_note(midi_note)
+            for midi_note in range(self.note_range[0], self.note_range[1] + 1)
+        }
+        self.background_cache = (
+            None  # ピアノロール背景のQPixmap (サイズが変わったら作り直す)
+        )
+        # 同じ高さで連続するフレームをまとめた矩形 (開始時刻順)
+        self.rect_starts = np.zeros(0)
+        self.rect_ends = np.zeros(0)
+        self.rect_ys = np.zeros(0)
+        self.note_pen = QPen(QColor(0, 100, 255), 3)
+        # マイクから推定した歌声のピッチ (曲の時刻, MIDIノート番号)。古いものから捨てる
+        self.sung_pitch = deque(maxlen=2000)
+        self.sung_pen = QPen(QColor(255, 140, 0), 3)
+        self.position_pen = QPen(QColor(255, 0, 0), 2)
 
     def set_pitch_data(self, pitch_data):
+        # PitchTrack (mmapされた列) をそのまま使う。辞書のリストも受け付ける
+        if not isinstance(pitch_data, PitchTrack):
+            pitch_data = PitchTrack.from_records(pitch_data)
         self.pitch_data = pitch_data
+        self.build_note_rects()
         self.update()
 
+    def build_note_rects(self):
+        # 同じ行に描かれる連続したフレームを1つの矩形にまとめておく
+        start = np.asarray(self.pitch_data.start, dtype=np.float64)
+        end = np.asarray(self.pitch_data.end, dtype=np.float64)
+        pitch = np.asarray(self.pitch_data.pitch, dtype=np.float64)
+
+        voiced = pitch > 0  # 無音部分はスキップ
+        start, end, pitch = start[voiced], end[voiced], pitch[voiced]
+        if len(start) == 0:
+            self.rect_starts = self.rect_ends = self.rect_ys = np.zeros(0)
+            return
+
+        ys = np.rint(self.note_to_y(pitch))
+        new_rect = np.ones(len(start), dtype=bool)
+        new_rect[1:] = (ys[1:] != ys[:-1]) | (start[1:] - end[:-1] > 1e-3)
+        first = np.flatnonzero(new_rect)
+        last = np.append(first[1:] - 1, len(start) - 1)
+        self.rect_starts = start[first]
+        self.rect_ends = end[last]
+        self.rect_ys = ys[first]
+
     def update_position(self, current_time):
         self.current_position = current_time
         self.scroll_offset = max(
             0,
-            (self.current_position - 2) * 50,  # 1秒あたり50ピクセルのスクロールスピード
+            (self.current_position - 2)
+            * self.pixels_per_second,  # 1秒あたり50ピクセルのスクロールスピード
         )
         self.update()
 
+    def resizeEvent(self, event):
+        self.background_cache = None
+        super().resizeEvent(event)
+
     def paintEvent(self, event):
         painter = QPainter(self)
         painter.setRenderHint(QPainter.RenderHint.Antialiasing)
 
-        # 背景の描画
-        painter.fillRect(self.rect(), QColor(240, 240, 240))
-
-        # ピアノロール風の背景を描画
-        self.draw_piano_roll_background(painter)
+        # 背景とピアノロール風の背景は、サイズが変わったときだけ描き直す
+        if self.background_cache is None or self.background_cache.size() != self.size():
+            self.background_cache = self.render_background()
+        painter.drawPixmap(0, 0, self.background_cache)
 
         # 検出されたピッチの描画
         self.draw_pitch_notes(painter)
 
+        # 歌声のピッチを重ねて描画
+        self.draw_sung_pitch(painter)
+
         # 現在の再生位置を示す線を描画
-        pen = QPen(QColor(255, 0, 0), 2)
-        painter.setPen(pen)
+        painter.setPen(self.position_pen)
         painter.drawLine(self.position_line_x, 0, self.position_line_x, self.height())
 
+    def render_background(self):
+        pixmap = QPixmap(self.size())
+        pixmap.fill(QColor(240, 240, 240))
+        painter = QPainter(pixmap)
+        self.draw_piano_roll_background(painter)
+        painter.end()
+        return pixmap
+
     def draw_piano_roll_background(self, painter):
         pen = QPen(QColor(200, 200, 200), 1)
         painter.setPen(pen)
         for midi_note in range(self.note_range[0], self.note_range[1] + 1):
             y = self.note_to_y(midi_note)
-            if librosa.midi_to_note(midi_note).endswith("#"):
+            if "#" in self.note_names[midi_note]:
                 # シャープが付いているノートをグレーで塗りつぶし
                 painter.fillRect(
                     0, y, self.width(), self.note_height, QColor(220, 220, 220)
@@ -68,39 +136,67 @@ class PitchBar(QWidget):
         font = QFont("Arial", 8)
         painter.setFont(font)
         for midi_note in range(self.note_range[0], self.note_range[1] + 1):
-            if not librosa.midi_to_note(midi_note).endswith("#"):
-                note_name = librosa.midi_to_note(midi_note)
+            note_name = self.note_names[midi_note]
+            if "#" not in note_name:
                 y = self.note_to_y(midi_note)
                 painter.drawText(
                     5, y + self.note_height - 1, f"{note_name}"
                 )  # 5はテキストの左マージン
 
     def draw_pitch_notes(self, painter):
-        pen = QPen(QColor(0, 100, 255), 3)
-        painter.setPen(pen)
+        painter.setPen(self.note_pen)
+
+        # 画面内に入る矩形だけを開始時刻の二分探索で取り出す
+        visible_start = self.scroll_offset / self.pixels_per_second
+        visible_end = (self.scroll_offset + self.width()) / self.pixels_per_second
+        first = max(
+            0, int(np.searchsorted(self.rect_starts, visible_start, side="right")) - 1
+        )
+        last = int(np.searchsorted(self.rect_starts, visible_end, side="right"))
 
-        for note in self.pitch_data:
-            start_x = note["start"] * 50 - self.scroll_offset
-            end_x = note["end"] * 50 - self.scroll_offset
-            width = end_x - start_x
+        for start, end, y in zip(
+            self.rect_starts[first:last].tolist(),
+            self.rect_ends[first:last].tolist(),
+            self.rect_ys[first:last].tolist(),
+        ):
+            start_x = start * self.pixels_per_second - self.scroll_offset
+            end_x = end * self.pixels_per_second - self.scroll_offset
 
             # 画面外に出たら描画をスキップ
             if end_x < 0:  # バーの終端が画面左端より左にある場合
                 continue
-            if start_x > self.width():  # バーの始点が画面右端より右にある場合
-                break
 
             # 描画範囲を制限
             if start_x < 0:
                 start_x = 0
             if end_x > self.width():
                 end_x = self.width()
-            width = end_x - start_x
 
-            if note["pitch"] > 0:  # 無音部分はスキップ
-                y = self.note_to_y(note["pitch"])
-                rect = QRectF(start_x, y, width, self.note_height)
-                painter.drawRect(rect)
+            painter.drawRect(QRectF(start_x, y, end_x - start_x, self.note_height))
+
+    def add_sung_pitch(self, time, pitch):
+        # 無声(pitch=0)も線を途切れさせるために残しておく
+        self.sung_pitch.append((time, pitch))
+
+    def clear_sung_pitch(self):
+        self.sung_pitch.clear()
+        self.update()
+
+    def draw_sung_pitch(self, painter):
+        painter.setPen(self.sung_pen)
+        visible_start = self.scroll_offset / self.pixels_per_second
+        previous = None
+        for time, pitch in self.sung_pitch:
+            if time < visible_start or pitch <= 0:
+                previous = None
+                continue
+            point = QPointF(
+                time * self.pixels_per_second - self.scroll_offset,
+                self.note_to_y(pitch) + self.note_height / 2,
+            )
+            if previous is not None:
+                painter.drawLine(previous, point)
+            previous = point
 
     def note_to_y(self, midi_note):
         # MIDIノート番号からY座標を計算
@@ -110,4 +206,5 @@ class PitchBar(QWidget):
     def reset(self):
         self.current_position = 0
         self.scroll_offset = 0
+        self.sung_pitch.clear()
         self.update()
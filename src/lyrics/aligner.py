@@ -0,0 +1,223 @@
+import argparse
+import json
+import os
+import sys
+import unicodedata
+
+import numpy as np
+
+# 正しい歌詞(テキスト)を、小さいモデルで認識した単語の時刻に合わせる
+# 歌詞と認識結果を1文字ずつ比べて編集距離のDPで対応を取り、
+# 対応が取れた文字には認識結果の時刻を、取れなかった文字には前後から補間した時刻を付ける
+
+LYRICS_NAME = "lyrics.txt"  # data/output/<曲名>/lyrics.txt があれば自動で合わせる
+
+# DPの遷移 (斜め: 一致/置換, 上: 歌詞の文字が認識結果に無い, 左: 認識結果の余分な文字)
+DIAGONAL, UP, LEFT = 0, 1, 2
+
+
+def normalize_text(text):
+    # 比べるための文字と、元のテキストでの位置 [(文字, 位置), ...] を返す
+    # 全角/半角・大文字/小文字・カタカナ/ひらがなの違いは無視し、空白や記号は飛ばす
+    chars = []
+    for index, char in enumerate(text):
+        for c in unicodedata.normalize("NFKC", char).lower():
+            if unicodedata.category(c)[0] not in "LN":
+                continue
+            if "ァ" <= c <= "ヶ":
+                c = chr(ord(c) - 0x60)
+            chars.append((c, index))
+    return chars
+
+
+def align_sequences(ref, hyp, substitution_cost=1.0, gap_cost=1.0):
+    # ref の各要素に対応する hyp の位置(無ければ-1)と、編集距離を返す
+    # 1行ずつnumpyで計算する。左からの遷移は D[j] = min_k(B[k] + (j - k) * gap) なので累積最小値で求まる
+    ref = np.asarray(ref)
+    hyp = np.asarray(hyp)
+    n, m = len(ref), len(hyp)
+    offsets = np.arange(m + 1) * gap_cost
+    steps = np.full((n + 1, m + 1), LEFT, dtype=np.uint8)
+    row = offsets.astype(np.float64)
+    for i in range(1, n + 1):
+        best = row + gap_cost
+        step = np.full(m + 1, UP, dtype=np.uint8)
+        diagonal = row[:-1] + np.where(hyp == ref[i - 1], 0.0, substitution_cost)
+        better = diagonal <= best[1:]
+        best[1:][better] = diagonal[better]
+        step[1:][better] = DIAGONAL
+        shifted = np.minimum.accumulate(best - offsets) + offsets
+        steps[i] = np.where(shifted < best, LEFT, step)
+        row = shifted
+
+    # 右下から戻って対応を取る
+    mapping = np.full(n, -1, dtype=np.int64)
+    i, j = n, m
+    while i > 0:
+        step = steps[i, j] if j > 0 else UP
+        if step == DIAGONAL:
+            mapping[i - 1] = j - 1
+            i, j = i - 1, j - 1
+        elif step == UP:
+            i -= 1
+        else:
+            j -= 1
+    return mapping, float(row[-1])
+
+
+def _hypothesis_chars(segments):
+    # 認識結果の単語を1文字ずつに分け、単語の時間を文字数で等分する
+    chars, starts, ends, word_ids = [], [], [], []
+    word_id = 0
+    for segment in segments:
+        words = segment.get("words") or [
+            {"word": segment["text"], "start": segment["start"], "end": segment["end"]}
+        ]
+        for word in words:
+            word_chars = [c for c, _ in normalize_text(word["word"])]
+            if word_chars:
+                edges = np.linspace(word["start"], word["end"], len(word_chars) + 1)
+                chars += word_chars
+                starts += list(edges[:-1])
+                ends += list(edges[1:])
+                word_ids += [word_id] * len(word_chars)
+            word_id += 1
+    return chars, np.array(starts), np.array(ends), np.array(word_ids, dtype=np.int64)
+
+
+def align_text(lyrics_text, segments):
+    # 歌詞の1行を1フレーズとして recognized.json と同じ形式のセグメントを作る
+    # 戻り値: (セグメント, 文字の誤り率)。どの文字も対応が取れなければ (None, 1.0)
+    lines = [line.strip() for line in lyrics_text.splitlines() if line.strip()]
+    ref_chars, ref_lines, ref_indices = [], [], []
+    for line_index, line in enumerate(lines):
+        for char, index in normalize_text(line):
+            ref_chars.append(char)
+            ref_lines.append(line_index)
+            ref_indices.append(index)
+
+    hyp_chars, hyp_starts, hyp_ends, hyp_words = _hypothesis_chars(segments)
+    if not ref_chars or not hyp_chars:
+        return None, 1.0
+
+    mapping, distance = align_sequences(
+        [ord(c) for c in ref_chars], [ord(c) for c in hyp_chars]
+    )
+    aligned = mapping >= 0
+    if not aligned.any():
+        return None, 1.0
+
+    # 対応が取れなかった文字の時刻は前後の文字から線形に補間する
+    positions = np.arange(len(ref_chars))
+    starts = np.interp(positions, positions[aligned], hyp_starts[mapping[aligned]])
+    ends = np.interp(positions, positions[aligned], hyp_ends[mapping[aligned]])
+    ends = np.maximum(ends, starts)
+
+    # 同じ認識結果の単語に対応した文字を1つの単語にまとめる(対応が無い文字は直前の単語に入れる)
+    word_ids = np.where(aligned, hyp_words[np.maximum(mapping, 0)], -1)
+    groups = []  # [(行, 元のテキストでの開始位置, 最初の文字番号, 最後の文字番号)]
+    group_words = []  # グループが対応する認識結果の単語 (-1: まだ無い)
+    for k in range(len(ref_chars)):
+        line_index, index = ref_lines[k], ref_indices[k]
+        begin = 0  # 行の最初の単語は行頭の記号も含める
+        if groups and groups[-1][0] == line_index:
+            previous = groups[-1]
+            gap = lines[line_index][ref_indices[previous[3]] + 1 : index]
+            same_word = -1 in (word_ids[k], group_words[-1]) or (
+                word_ids[k] == group_words[-1]
+            )
+            if same_word and not any(c.isspace() for c in gap):
+                groups[-1] = (line_index, previous[1], previous[2], k)
+                if group_words[-1] == -1:
+                    group_words[-1] = word_ids[k]
+                continue
+            begin = index
+        groups.append((line_index, begin, k, k))
+        group_words.append(word_ids[k])
+
+    result = []
+    for line_index, line in enumerate(lines):
+        line_groups = [group for group in groups if group[0] == line_index]
+        if not line_groups:
+            continue
+        words = []
+        for g, (_, begin, first, last) in enumerate(line_groups):
+            end = line_groups[g + 1][1] if g + 1 < len(line_groups) else len(line)
+            words.append(
+                {
+                    "word": line[begin:end].strip(),
+                    "start": float(starts[first]),
+                    "end": float(ends[first : last + 1].max()),
+                }
+            )
+        # 補間した終了時刻が次の単語にはみ出すと、歌詞のハイライトが重なるので切り詰める
+        for word, next_word in zip(words, words[1:]):
+            word["end"] = max(word["start"], min(word["end"], next_word["start"]))
+        result.append(
+            {
+                "text": line,
+                "start": words[0]["start"],
+                "end": max(word["end"] for word in words),
+                "words": words,
+            }
+        )
+    for segment, next_segment in zip(result, result[1:]):
+        end = max(segment["start"], min(segment["end"], next_segment["start"]))
+        segment["end"] = end
+        for word in segment["words"]:
+            word["start"] = min(word["start"], end)
+            word["end"] = min(word["end"], end)
+    return result, distance / len(ref_chars)
+
+
+def read_lyrics(music_path):
+    # 音源と同じフォルダの lyrics.txt を読む。無ければNone
+    lyrics_path = os.path.join(os.path.dirname(music_path), LYRICS_NAME)
+    if not os.path.exists(lyrics_path):
+        return None
+    with open(lyrics_path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def save_lyrics(music_path, lyrics_text):
+    lyrics_path = os.path.join(os.path.dirname(music_path), LYRICS_NAME)
+    with open(lyrics_path, "w", encoding="utf-8") as f:
+        f.write(lyrics_text)
+    return lyrics_path
+
+
+def main(argv=None):
+    # 使い方: python3 -m src.lyrics.aligner 音源ファイル 歌詞.txt [-o recognized.json]
+    parser = argparse.ArgumentParser(description="正しい歌詞を音声認識の時刻に合わせる")
+    parser.add_argument("audio", help="音源ファイル(data/output/<曲名>/music.*)")
+    parser.add_argument(
+        "lyrics", help="歌詞のテキストファイル(1行を1フレーズとして表示)"
+    )
+    parser.add_argument(
+        "-o", "--output", help="書き出すファイル(省略時は音源の隣の recognized.json)"
+    )
+    parser.add_argument("--model-size", default="base", help="whisperのモデルサイズ")
+    parser.add_argument("--backend", default="whisper", help="音声認識の実装")
+    args = parser.parse_args(argv)
+
+    from src.lyrics.recognizer import Recognizer
+
+    with open(args.lyrics, "r", encoding="utf-8") as f:
+        lyrics_text = f.read()
+    recognizer = Recognizer(model_size=args.model_size, backend=args.backend)
+    segments = recognizer.align_lyrics(args.audio, lyrics_text)
+    if not segments:
+        print("歌詞を合わせられませんでした")
+        return 1
+
+    output_path = args.output or os.path.join(
+        os.path.dirname(args.audio), "recognized.json"
+    )
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(segments, f, ensure_ascii=False, indent=4)
+    print(f"書き出しました: {output_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+# whisper (PyTorch) や faster_whisper は読み込みが重いので、モデルをロードするときにimportする
+
+
+class WhisperBackend:
+    # openai-whisper (PyTorch, CPUではfp32)
+    name = "whisper"
+
+    def __init__(self, model_size="base"):
+        self.model_size = model_size
+        self.model_name = f"whisper:{model_size}"
+
+    def cache_params(self):
+        # 既存のキャッシュをそのまま使えるように、whisperのときは何も足さない
+        return {}
+
+    def load(self):
+        import whisper
+
+        return whisper.load_model(self.model_size)
+
+    def transcribe(self, model, audio, language, initial_prompt=None):
+        # recognized.json に整形する前の whisper と同じ形式のセグメントを返す
+        result = model.transcribe(
+            audio,
+            word_timestamps=True,
+            fp16=False,
+            language=language,
+            initial_prompt=initial_prompt,
+        )
+        return result["segments"]
+
+
+class FasterWhisperBackend:
+    # faster-whisper (CTranslate2)。int8に量子化したモデルをCPUで動かす
+    # cpu_threads: 1つの推論に使うスレッド数(intra-op), num_workers: 同時に動かす推論の数(inter-op)
+    # batch_size > 1 なら無音で区切った複数の区間をまとめてデコードする
+    name = "faster-whisper"
+
+    def __init__(
+        self,
+        model_size="base",
+        compute_type="int8",
+        cpu_threads=0,
+        num_workers=1,
+        batch_size=8,
+        beam_size=5,
+    ):
+        self.model_size = model_size
+        self.compute_type = compute_type
+        self.cpu_threads = cpu_threads
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.beam_size = beam_size
+        # ロードするときのオプションが違えば別のモデルとしてレジストリに登録する
+        self.model_name = (
+            f"faster-whisper:{model_size}:{compute_type}"
+            f":threads={cpu_threads}:workers={num_workers}:batch={batch_size}"
+        )
+
+    def cache_params(self):
+        # スレッド数は結果に影響しないのでキャッシュのキーに含めない
+        return {
+            "backend": self.name,
+            "compute_type": self.compute_type,
+            "batch_size": self.batch_size,
+            "beam_size": self.beam_size,
+        }
+
+    def load(self):
+        from faster_whisper import BatchedInferencePipeline, WhisperModel
+
+        model = WhisperModel(
+            self.model_size,
+            device="cpu",
+            compute_type=self.compute_type,
+            cpu_threads=self.cpu_threads,
+            num_workers=self.num_workers,
+        )
+        if self.batch_size > 1:
+            return BatchedInferencePipeline(model=model)
+        return model
+
+    def transcribe(self, model, audio, language, initial_prompt=None):
+        options = {
+            "language": language,
+            "word_timestamps": True,
+            "beam_size": self.beam_size,
+            "initial_prompt": initial_prompt,
+        }
+        if self.batch_size > 1:
+            options["batch_size"] = self.batch_size
+        segments, _ = model.transcribe(audio, **options)
+        # ジェネレータなので、ここで最後までデコードする
+        return [
+            {
+                "text": segment.text,
+                "start": segment.start,
+                "end": segment.end,
+                "words": [
+                    {"word": word.word, "start": word.start, "end": word.end}
+                    for word in segment.words or []
+                ],
+            }
+            for segment in segments
+        ]
+
+
+BACKENDS = {
+    WhisperBackend.name: WhisperBackend,
+    FasterWhisperBackend.name: FasterWhisperBackend,
+}
+
+
+def create_backend(name="whisper", model_size="base", **options):
+    if name not in BACKENDS:
+        raise ValueError(
+            f"未対応の音声認識バックエンドです: {name} (選択肢: {', '.join(BACKENDS)})"
+        )
+    return BACKENDS[name](model_size, **options)
@@ -1,28 +1,132 @@
-import whisper
 import os
+import hashlib
 import json
 import time
 
+import numpy as np
+
+from src.audio.pcm_cache import pcm_cache
+from src.lyrics.aligner import align_text
+from src.lyrics.backends import create_backend
+from src.cache.artifact_cache import artifact_cache, file_digest, make_key
+from src.models.registry import registry
+from src.tracing.tracer import tracer
+from src.pipeline.scheduler import Cancelled
+from src.pitch.postprocess import frame_rms
+
+CACHE_VERSION = 1
+ALIGN_CACHE_VERSION = 2  # 2: 単語・フレーズの終了時刻が次と重ならないようにした
+
+
+def plan_windows(
+    vocals,
+    sr=16000,
+    max_window=30.0,
+    frame=0.1,
+    min_gap=2.0,
+    padding=0.3,
+    silence_ratio=0.1,
+):
+    # ボーカルの音量から歌っている区間を探し、whisperに渡す区間 [(開始サンプル, 終了サンプル)] を作る
+    # max_window 秒(whisperが一度に処理する長さ)を超える区間は、後ろ1/3の一番静かなところで切る
+    hop = int(sr * frame)
+    rms = frame_rms(vocals, frame_length=hop, hop_length=hop)
+    if len(rms) == 0:
+        return []
+    threshold = silence_ratio * np.percentile(rms, 95)
+    active = np.concatenate(([False], rms > max(threshold, 1e-4), [False]))
+    edges = np.flatnonzero(np.diff(active.astype(np.int8)))
+    starts, ends = edges[0::2], edges[1::2]  # フレーム番号 [start, end)
+    if len(starts) == 0:
+        return []
+
+    # 短い息継ぎは同じ区間にまとめる
+    gap_frames = int(min_gap / frame)
+    keep = np.concatenate(([True], starts[1:] - ends[:-1] > gap_frames))
+    starts = starts[keep]
+    ends = np.append(ends[np.flatnonzero(keep)[1:] - 1], ends[-1])
+
+    pad_frames = int(padding / frame)
+    max_frames = int(max_window / frame)
+    windows = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        start = max(0, start - pad_frames)
+        end = min(len(rms), end + pad_frames)
+        while end - start > max_frames:
+            search_from = start + max_frames * 2 // 3
+            cut = search_from + int(np.argmin(rms[search_from : start + max_frames]))
+            windows.append((start, cut))
+            start = cut
+        windows.append((start, end))
+    return [(start * hop, min(end * hop, len(vocals))) for start, end in windows]
+
+
+def format_segment(segment, offset=0.0):
+    # whisperの結果を recognized.json の形式にする (offset秒ずらす)
+    return {
+        "text": segment["text"].strip(),
+        "start": segment["start"] + offset,
+        "end": segment["end"] + offset,
+        "words": [
+            {
+                "word": word["word"].strip(),
+                "start": word["start"] + offset,
+                "end": word["end"] + offset,
+            }
+            for word in segment.get("words", [])
+        ],
+    }
+
 
 class Recognizer:
-    def __init__(self, model_size="base", language="ja", cache_dir="data/output"):
+    def __init__(
+        self,
+        model_size="base",
+        language="ja",
+        cache_dir="data/output",
+        cache=None,
+        pcm=None,
+        backend="whisper",
+        backend_options=None,
+    ):
         self.model_size = model_size
         self.language = language
-        self.model = whisper.load_model(self.model_size)
+        # 推論の実装 (whisper / faster-whisper) は差し替えられる
+        self.backend = create_backend(backend, model_size, **(backend_options or {}))
+        # モデルはレジストリで共有し、初回利用時に一度だけロードする
+        self.model_name = self.backend.model_name
+        registry.register(self.model_name, self.backend.load)
         self.cache_dir = cache_dir
+        self.cache = cache or artifact_cache
+        self.pcm_cache = pcm or pcm_cache
         # os.makedirs(self.cache_dir, exist_ok=True)
 
-    def _get_cache_file_path(self, audio_path):
-        # ここでは音源ファイルのpathが渡される
-        music_name = os.path.basename(os.path.dirname(audio_path))
-        output_directory = os.path.join("data", "output", music_name)
-        return os.path.join(output_directory, "recognized.json")
+    @property
+    def model(self):
+        return registry.get(self.model_name)
 
-    def recognize_lyrics(self, audio_path):
-        cache_file_path = self._get_cache_file_path(audio_path)
+    def preload(self, callback=None):
+        # バックグラウンドでモデルをロードしておく
+        return registry.preload(self.model_name, callback=callback)
 
-        # キャッシュが存在するか確認
-        if os.path.exists(cache_file_path):
+    def _get_cache_key(self, audio_path, extra_params=None):
+        # ここでは音源ファイルのpathが渡される
+        # 曲名ではなく音源の内容と認識設定でキャッシュを引く
+        source = file_digest(audio_path)
+        params = {
+            "model_size": self.model_size,
+            "language": self.language,
+            "word_timestamps": True,
+        }
+        params.update(self.backend.cache_params())
+        params.update(extra_params or {})
+        tracer.annotate(params=params)
+        return source, params, make_key("recognize", source, params, CACHE_VERSION)
+
+    def _load_cache(self, key):
+        cached = self.cache.lookup("recognize", key)
+        if cached:
+            cache_file_path = cached["recognized.json"]
             print(f"音声認識結果のキャッシュが見つかりました: {cache_file_path}")
             try:
                 with open(cache_file_path, "r", encoding="utf-8") as f:
@@ -32,44 +136,57 @@ class Recognizer:
                     f"音声認識結果キャッシュの読み込みに失敗しました。再実行します: {cache_file_path}"
                 )
                 # キャッシュが壊れている場合は再実行
-                pass
+                self.cache.invalidate("recognize", key)
+        return None
+
+    def _save_cache(self, key, source, params, formatted_result):
+        try:
+            with self.cache.write(
+                "recognize",
+                key,
+                source=source,
+                params=params,
+                version=CACHE_VERSION,
+            ) as tmp_dir:
+                cache_file_path = os.path.join(tmp_dir, "recognized.json")
+                with open(cache_file_path, "w", encoding="utf-8") as f:
+                    json.dump(formatted_result, f, ensure_ascii=False, indent=4)
+            print(
+                f"音声認識結果を保存しました: {self.cache.entry_dir('recognize', key)}"
+            )
+        except Exception as e:
+            print(f"音声認識結果キャッシュの保存に失敗しました: {e}")
+
+    @tracer.traced("recognize")
+    def recognize_lyrics(self, audio_path):
+        try:
+            source, params, key = self._get_cache_key(audio_path)
+        except FileNotFoundError:
+            print(f"音声ファイルが見つかりません: {audio_path}")
+            return None
+
+        # キャッシュが存在するか確認
+        cached = self._load_cache(key)
+        if cached is not None:
+            return cached
 
         try:
             print(f"音声認識を実行します: {audio_path}")
 
             start_time = time.time()
 
+            # whisperが内部でffmpegを呼ぶ代わりに、デコード済みの16kHzモノラルPCMを渡す
+            audio = self.pcm_cache.analysis(audio_path).data
+
             # 音声認識の実行 (単語レベルのタイムスタンプを有効化)
-            result = self.model.transcribe(
-                audio_path, word_timestamps=True, fp16=False, language=self.language
-            )
+            with registry.use(self.model_name) as model:
+                segments = self.backend.transcribe(model, audio, self.language)
 
             # 結果を整形して返す (単語、開始時間、終了時間)
-            formatted_result = []
-            for segment in result["segments"]:
-                formatted_result.append(
-                    {
-                        "text": segment["text"].strip(),
-                        "start": segment["start"],
-                        "end": segment["end"],
-                        "words": [
-                            {
-                                "word": word["word"].strip(),
-                                "start": word["start"],
-                                "end": word["end"],
-                            }
-                            for word in segment["words"]
-                        ],
-                    }
-                )
+            formatted_result = [format_segment(segment) for segment in segments]
 
             # 結果をキャッシュに保存
-            try:
-                with open(cache_file_path, "w", encoding="utf-8") as f:
-                    json.dump(formatted_result, f, ensure_ascii=False, indent=4)
-                print(f"音声認識結果を保存しました: {cache_file_path}")
-            except Exception as e:
-                print(f"音声認識結果キャッシュの保存に失敗しました: {e}")
+            self._save_cache(key, source, params, formatted_result)
 
             end_time = time.time()
             elapsed_time = end_time - start_time
@@ -82,4 +199,153 @@ class Recognizer:
             return None
         except Exception as e:
             print(f"音声認識エラー: {e}")
+            tracer.fail(e)
             return None
+
+    @tracer.traced("recognize")
+    def recognize_progressive(
+        self,
+        audio_path,
+        vocals_path,
+        on_segment=None,
+        on_progress=None,
+        check_cancelled=None,
+        max_window=30.0,
+    ):
+        # 歌っている区間ごとに認識し、できたフレーズから on_segment(segment) で渡す
+        # 区間の結果は途中経過としてキャッシュに追記し、中断しても続きから再開する
+        try:
+            source, params, key = self._get_cache_key(
+                audio_path, {"windowed": True, "max_window": max_window}
+            )
+        except FileNotFoundError:
+            print(f"音声ファイルが見つかりません: {audio_path}")
+            return None
+
+        cached = self._load_cache(key)
+        if cached is not None:
+            for segment in cached:
+                if on_segment:
+                    on_segment(segment)
+            return cached
+
+        try:
+            print(f"音声認識を区間ごとに実行します: {audio_path}")
+            start_time = time.time()
+
+            sr = 16000
+            audio = self.pcm_cache.analysis(audio_path).data
+            vocals = self.pcm_cache.analysis(vocals_path).data
+            windows = plan_windows(vocals, sr, max_window=max_window)
+            total = sum(end - start for start, end in windows) or 1
+            print(
+                f"無音を除いた認識区間: {len(windows)}個, {total / sr:.1f}秒 / {len(audio) / sr:.1f}秒"
+            )
+
+            # 前回途中まで認識していれば、その区間の結果を使う
+            done = {
+                (record["start"], record["end"]): record["segments"]
+                for record in self.cache.read_partial("recognize", key)
+            }
+
+            formatted_result = []
+            processed = 0
+            for start, end in windows:
+                if check_cancelled:
+                    check_cancelled()
+                segments = done.get((start, end))
+                if segments is None:
+                    # 直前の歌詞をヒントにして、区間の切れ目で文脈が途切れにくくする
+                    prompt = formatted_result[-1]["text"] if formatted_result else None
+                    with registry.use(self.model_name) as model:
+                        segments = self.backend.transcribe(
+                            model,
+                            np.array(audio[start:end], dtype=np.float32),
+                            self.language,
+                            initial_prompt=prompt,
+                        )
+                    segments = [
+                        format_segment(segment, offset=start / sr)
+                        for segment in segments
+                        if segment["text"].strip()
+                    ]
+                    self.cache.append_partial(
+                        "recognize",
+                        key,
+                        {"start": start, "end": end, "segments": segments},
+                    )
+
+                for segment in segments:
+                    formatted_result.append(segment)
+                    if on_segment:
+                        on_segment(segment)
+                processed += end - start
+                if on_progress:
+                    on_progress(processed / total)
+
+            self._save_cache(key, source, params, formatted_result)
+            self.cache.clear_partial("recognize", key)
+
+            elapsed_time = time.time() - start_time
+            print(f"音声認識処理時間: {elapsed_time:.2f}秒")
+            return formatted_result
+
+        except Cancelled:
+            raise
+        except FileNotFoundError:
+            print(f"音声ファイルが見つかりません: {audio_path}")
+            return None
+        except Exception as e:
+            print(f"音声認識エラー: {e}")
+            tracer.fail(e)
+            return None
+
+    @tracer.traced("align")
+    def align_lyrics(self, audio_path, lyrics_text, recognized=None):
+        # 正しい歌詞を、このモデルで認識した単語の時刻に合わせる(大きいモデルを使わずに歌詞を正確にする)
+        # recognized を渡さなければ recognize_lyrics の結果(キャッシュ)を使う
+        if recognized is None:
+            recognized = self.recognize_lyrics(audio_path)
+        if not recognized:
+            return None
+        try:
+            source = file_digest(audio_path)
+        except FileNotFoundError:
+            print(f"音声ファイルが見つかりません: {audio_path}")
+            return None
+
+        params = {
+            "lyrics": hashlib.sha256(lyrics_text.encode("utf-8")).hexdigest(),
+            "recognized": hashlib.sha256(
+                json.dumps(recognized, ensure_ascii=False, sort_keys=True).encode(
+                    "utf-8"
+                )
+            ).hexdigest(),
+        }
+        key = make_key("align", source, params, ALIGN_CACHE_VERSION)
+        cached = self.cache.lookup("align", key)
+        if cached:
+            try:
+                with open(cached["recognized.json"], "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except json.JSONDecodeError:
+                self.cache.invalidate("align", key)
+
+        segments, error_rate = align_text(lyrics_text, recognized)
+        if not segments:
+            print("歌詞と音声認識の結果が全く一致しないため、合わせられませんでした")
+            return None
+        print(
+            f"歌詞を合わせました (認識結果との文字の不一致率: {error_rate * 100:.1f}%)"
+        )
+        try:
+            with self.cache.write(
+                "align", key, source=source, params=params, version=ALIGN_CACHE_VERSION
+            ) as tmp_dir:
+                with open(
+                    os.path.join(tmp_dir, "recognized.json"), "w", encoding="utf-8"
+                ) as f:
+                    json.dump(segments, f, ensure_ascii=False, indent=4)
+        except Exception as e:
+            print(f"歌詞を合わせた結果の保存に失敗しました: {e}")
+        return segments
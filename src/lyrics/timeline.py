@@ -0,0 +1,101 @@
+import html
+from bisect import bisect_right
+from collections import namedtuple
+
+# ある時刻の表示状態
+# segment: 表示するフレーズ(なければNone), word: 色付け中の単語(なければ-1)
+# fraction: 色付け中の単語の進み具合(0.0-1.0), highlight_length: 色付けする文字数
+LyricsState = namedtuple(
+    "LyricsState", ["segment", "word", "fraction", "highlight_length"]
+)
+
+EMPTY_STATE = LyricsState(None, -1, 0.0, 0)
+
+
+class LyricsTimeline:
+    # recognized.json の歌詞から、時刻 -> (フレーズ, 単語, 進み具合) を二分探索で引く
+    # 再生位置が前後に飛んでも、毎回その時刻から直接求めるのでずれない
+    def __init__(self, segments):
+        self.segments = segments
+        self.segment_starts = []
+        self.segment_ends = []  # 単調増加にしておく(二分探索のため)
+        self.word_starts = []
+        self.word_ends = []
+        self.word_texts = []
+        last_end = float("-inf")
+        for segment in segments:
+            last_end = max(last_end, round(segment["end"], 2))
+            self.segment_starts.append(round(segment["start"], 2))
+            self.segment_ends.append(last_end)
+            words = segment.get("words", [])
+            self.word_starts.append([word["start"] for word in words])
+            self.word_ends.append([word["end"] for word in words])
+            self.word_texts.append([word["word"] for word in words])
+
+        # 表示用のHTML片を先に作っておく
+        self._sung_html = [
+            [f"<span style='color: red;'>{html.escape(w)}</span>" for w in words]
+            for words in self.word_texts
+        ]
+        self._plain_html = [
+            [html.escape(w) for w in words] for words in self.word_texts
+        ]
+        self._next_html = [
+            (
+                "<br><br><span style='font-size: 10px;'>"
+                + html.escape(segments[i + 1]["text"])
+                + "</span>"
+                if i + 1 < len(segments)
+                else ""
+            )
+            for i in range(len(segments))
+        ]
+
+    def __len__(self):
+        return len(self.segments)
+
+    @property
+    def end_time(self):
+        return self.segment_ends[-1] if self.segment_ends else 0.0
+
+    def segment_at(self, current_time):
+        # 終了時刻を過ぎていない最初のフレーズ(開始前なら次に歌うフレーズ)
+        index = bisect_right(self.segment_ends, current_time)
+        return index if index < len(self.segments) else None
+
+    def state_at(self, current_time):
+        index = self.segment_at(current_time)
+        if index is None:
+            return EMPTY_STATE
+        if current_time < self.segment_starts[index]:
+            # まだフレーズの開始時間になっていない
+            return LyricsState(index, -1, 0.0, 0)
+
+        starts = self.word_starts[index]
+        word = bisect_right(starts, current_time) - 1
+        if word < 0:
+            return LyricsState(index, -1, 0.0, 0)
+        duration = self.word_ends[index][word] - starts[word]
+        fraction = (current_time - starts[word]) / duration if duration > 0 else 1.0
+        fraction = min(max(fraction, 0.0), 1.0)
+        highlight_length = int(len(self.word_texts[index][word]) * fraction)
+        return LyricsState(index, word, fraction, highlight_length)
+
+    def render_html(self, state):
+        # 歌い終わった単語は赤、歌っている単語は途中まで赤、これからの単語はそのまま
+        if state.segment is None:
+            return ""
+        index = state.segment
+        sung = self._sung_html[index]
+        plain = self._plain_html[index]
+        parts = sung[: max(state.word, 0)]
+        if state.word >= 0:
+            text = self.word_texts[index][state.word]
+            parts.append(
+                f"<span style='color: red; font-size: 20px;'>{html.escape(text[: state.highlight_length])}</span>"
+                f"{html.escape(text[state.highlight_length :])}"
+            )
+            parts.extend(plain[state.word + 1 :])
+        else:
+            parts.extend(plain)
+        return " " + " ".join(parts) + self._next_html[index]
@@ -1,9 +1,64 @@
+import argparse
 import sys
-from PyQt6.QtWidgets import QApplication
-from src.gui.main_window import MainWindow
+import time
 
-if __name__ == "__main__":
-    app = QApplication(sys.argv)
-    main_window = MainWindow()
+from src.tracing.tracer import tracer
+
+
+def main(argv=None):
+    start_time = time.perf_counter()
+    parser = argparse.ArgumentParser(description="なんでもカラオケ")
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="起動にかかった時間をモジュールごとに表示して終了する",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=None,
+        help="--profile-startup でウィンドウ表示までの上限(秒)。超えたら終了コード1",
+    )
+    args, qt_args = parser.parse_known_args(argv)
+
+    # 起動時間を測れるように、GUIのimportもspanで囲む
+    with tracer.span("startup.import", module="PyQt6"):
+        from PyQt6.QtCore import QTimer
+        from PyQt6.QtWidgets import QApplication
+    with tracer.span("startup.import", module="src.gui.main_window"):
+        from src.gui.main_window import MainWindow
+
+    with tracer.span("startup.qapplication"):
+        app = QApplication([sys.argv[0]] + qt_args)
+    with tracer.span("startup.main_window"):
+        main_window = MainWindow()
     main_window.show()
-    sys.exit(app.exec())
+
+    if not args.profile_startup:
+        sys.exit(app.exec())
+
+    # イベントループが一周した(最初の描画が終わった)ところで終了する
+    ready = []
+
+    def on_ready():
+        ready.append(time.perf_counter() - start_time)
+        app.quit()
+
+    QTimer.singleShot(0, on_ready)
+    app.exec()
+
+    from src.tracing.startup import format_report, measure_imports
+
+    # バックグラウンドのモデルのロードも待って、かかった時間を表示する
+    main_window.wait_warmup()
+    try:
+        imports = measure_imports("src.gui.main_window")
+    except Exception as e:
+        print(f"importの計測に失敗しました: {e}")
+        imports = None
+    print(format_report(list(tracer.recent), ready[0], imports, args.budget))
+    sys.exit(1 if args.budget is not None and ready[0] > args.budget else 0)
+
+
+if __name__ == "__main__":
+    main()
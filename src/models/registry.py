@@ -0,0 +1,148 @@
+import gc
+import threading
+import time
+from contextlib import contextmanager
+
+from src.tracing.tracer import tracer
+
+
+class _Entry:
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self.model = None
+        self.load_lock = threading.Lock()  # ロードの多重実行を防ぐ
+        self.use_lock = threading.RLock()  # 推論中の同時利用を防ぐ
+        self.in_use = 0
+        self.last_used = 0.0
+        self.preload_thread = None
+
+
+class ModelRegistry:
+    # WhisperやSpleeterのモデルをプロセス内で共有するためのレジストリ
+    # モデルは初回利用時に一度だけロードし、同じインスタンスを返す
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def register(self, name, loader):
+        # 同じ名前で登録済みならローダーは上書きしない(ロード済みモデルを保持するため)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                entry = _Entry(name, loader)
+                self._entries[name] = entry
+            elif loader is not None and entry.loader is None:
+                entry.loader = loader
+            return entry
+
+    def _get_entry(self, name, loader=None):
+        entry = self.register(name, loader)
+        if entry.loader is None:
+            raise KeyError(f"モデルが登録されていません: {name}")
+        return entry
+
+    def _load(self, entry):
+        if entry.model is not None:
+            return entry.model
+        with entry.load_lock:
+            if entry.model is None:
+                print(f"モデルをロードします: {entry.name}")
+                start_time = time.time()
+                with tracer.span("model.load", model=entry.name):
+                    entry.model = entry.loader()
+                print(
+                    f"モデルのロードが完了しました: {entry.name} ({time.time() - start_time:.2f}秒)"
+                )
+            entry.last_used = time.time()
+            return entry.model
+
+    def get(self, name, loader=None):
+        entry = self._get_entry(name, loader)
+        model = self._load(entry)
+        entry.last_used = time.time()
+        return model
+
+    @contextmanager
+    def use(self, name, loader=None):
+        # 推論中はモデルを排他的に使う(whisperのword_timestampsはフックを差し込むため並行実行できない)
+        entry = self._get_entry(name, loader)
+        with entry.use_lock:
+            entry.in_use += 1
+            try:
+                yield self._load(entry)
+            finally:
+                entry.in_use -= 1
+                entry.last_used = time.time()
+
+    def preload(self, name, loader=None, callback=None):
+        # バックグラウンドでモデルをロードする(ロード済み/ロード中なら何もしない)
+        entry = self._get_entry(name, loader)
+        with self._lock:
+            if entry.model is not None or (
+                entry.preload_thread is not None and entry.preload_thread.is_alive()
+            ):
+                return entry.preload_thread
+
+            def run():
+                error = None
+                try:
+                    self._load(entry)
+                except Exception as e:
+                    error = e
+                    print(f"モデルのプリロードに失敗しました: {name}: {e}")
+                if callback:
+                    callback(name, error)
+
+            entry.preload_thread = threading.Thread(
+                target=run, name=f"preload-{name}", daemon=True
+            )
+            entry.preload_thread.start()
+            return entry.preload_thread
+
+    def is_loaded(self, name):
+        entry = self._entries.get(name)
+        return entry is not None and entry.model is not None
+
+    def loaded_models(self):
+        with self._lock:
+            return [name for name, entry in self._entries.items() if entry.model]
+
+    def evict(self, name):
+        entry = self._entries.get(name)
+        if entry is None or entry.model is None:
+            return False
+        # 推論中のモデルは解放しない
+        if not entry.use_lock.acquire(blocking=False):
+            return False
+        try:
+            if entry.in_use:
+                return False
+            with entry.load_lock:
+                entry.model = None
+        finally:
+            entry.use_lock.release()
+        gc.collect()
+        print(f"モデルを解放しました: {name}")
+        return True
+
+    def evict_idle(self, max_idle_seconds=300):
+        # 一定時間使われていないモデルを解放する(メモリが厳しいときに呼ぶ)
+        now = time.time()
+        with self._lock:
+            names = [
+                name
+                for name, entry in self._entries.items()
+                if entry.model is not None and now - entry.last_used >= max_idle_seconds
+            ]
+        return [name for name in names if self.evict(name)]
+
+    def clear(self):
+        with self._lock:
+            names = list(self._entries)
+        return [name for name in names if self.evict(name)]
+
+
+# プロセス全体で共有するレジストリ
+registry = ModelRegistry()
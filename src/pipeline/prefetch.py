@@ -0,0 +1,91 @@
+import multiprocessing
+import os
+
+# 予約された曲の前処理(ダウンロード・分離・音声認識・ピッチ解析)を別のプロセスで進めておく
+# 結果はキャッシュに残るので、順番が来たときにGUIで処理し直してもすぐ終わる
+# 再生中の音声やGUIを邪魔しないよう、プロセスの優先度を下げ、計算のスレッド数を絞る
+
+# numpy/PyTorch/TensorFlowなどのスレッド数を決める環境変数(importする前に設定する)
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "TF_NUM_INTRAOP_THREADS",
+    "TF_NUM_INTEROP_THREADS",
+)
+
+
+def _init_background_worker(niceness, threads, worker_args):
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(threads)
+    if niceness and hasattr(os, "nice"):
+        try:
+            os.nice(niceness)  # ffmpegなどの子プロセスにも引き継がれる
+        except OSError as e:
+            print(f"優先度を下げられませんでした: {e}")
+
+    from src.batch import _init_worker
+
+    _init_worker(*worker_args, threads=threads)
+
+
+def _process(kind, value):
+    from src.batch import _process_item
+
+    return _process_item(kind, value)
+
+
+class Prefetcher:
+    def __init__(
+        self,
+        max_workers=1,
+        niceness=10,
+        threads=1,
+        model_size="base",
+        language="ja",
+        backend="whisper",
+        separator_backend="spleeter",
+        download_codec=None,
+        progressive=False,
+    ):
+        self.max_workers = max_workers
+        self.niceness = niceness
+        self.threads = threads
+        self.worker_args = (
+            model_size,
+            language,
+            backend,
+            separator_backend,
+            download_codec,
+            progressive,
+        )
+        self.pool = None
+
+    def _get_pool(self):
+        # 最初に予約されたときにワーカーを起動する(モデルはワーカーごとに一度だけロードする)
+        if self.pool is None:
+            # TensorFlowはforkと相性が悪いのでspawnで起動する
+            self.pool = multiprocessing.get_context("spawn").Pool(
+                processes=self.max_workers,
+                initializer=_init_background_worker,
+                initargs=(self.niceness, self.threads, self.worker_args),
+            )
+        return self.pool
+
+    def submit(self, kind, value, callback=None):
+        # kind は "path" か "query"。callback(record, error) はプールのスレッドから呼ばれる
+        # record は batch と同じ形式 ({"status", "timings", "music_path", ...})
+        return self._get_pool().apply_async(
+            _process,
+            (kind, value),
+            callback=(lambda record: callback(record, None)) if callback else None,
+            error_callback=(lambda error: callback(None, error)) if callback else None,
+        )
+
+    def shutdown(self):
+        # 終了時は前処理の途中でも止める(キャッシュには書き終わったものしか公開されない)
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
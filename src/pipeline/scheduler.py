@@ -0,0 +1,261 @@
+import itertools
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from src.tracing.tracer import tracer
+
+# ステージの状態
+PENDING = "pending"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+SKIPPED = "skipped"  # 依存するステージが失敗した
+CANCELLED = "cancelled"
+
+# listenerに渡すイベント
+# kind: started / progress / finished / failed / skipped / cancelled / done
+PipelineEvent = namedtuple(
+    "PipelineEvent", ["kind", "job", "stage", "progress", "value"]
+)
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        # 長い処理の途中で呼んで、キャンセルされていたら中断する
+        if self._event.is_set():
+            raise Cancelled()
+
+
+class Stage:
+    def __init__(self, name, func, deps=()):
+        # funcは JobContext を受け取り、結果を返す
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+
+
+class JobContext:
+    # ステージ関数に渡す。依存ステージの結果、進捗報告、キャンセル確認ができる
+    def __init__(self, job, stage):
+        self.job = job
+        self.stage = stage
+        self.results = {dep: job.results[dep] for dep in stage.deps}
+        self.params = job.params
+
+    @property
+    def cancel_token(self):
+        return self.job.cancel_token
+
+    @property
+    def cancelled(self):
+        return self.job.cancel_token.cancelled
+
+    def check_cancelled(self):
+        self.job.cancel_token.check()
+
+    def progress(self, fraction, message=None):
+        self.job._set_progress(self.stage.name, fraction, message)
+
+    def emit(self, kind, value=None):
+        # ステージ固有のイベント(途中結果など)を通知する
+        self.job._emit(kind, self.stage.name, value=value)
+
+
+class Job:
+    _ids = itertools.count(1)
+
+    def __init__(self, scheduler, stages, name=None, params=None, listener=None):
+        self.id = next(self._ids)
+        self.name = name or f"job-{self.id}"
+        self.scheduler = scheduler
+        self.stages = {stage.name: stage for stage in stages}
+        self.params = params or {}
+        self.listener = listener
+        self.cancel_token = CancelToken()
+
+        self.states = {name: PENDING for name in self.stages}
+        self.progress = {name: 0.0 for name in self.stages}
+        self.results = {}
+        self.errors = {}
+        self.timings = {}  # ステージ名 -> 経過時間(秒)
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._validate()
+
+    def _validate(self):
+        for stage in self.stages.values():
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise ValueError(f"未定義のステージに依存しています: {dep}")
+        # 循環がないか確認
+        visiting, visited = set(), set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f"ステージの依存関係が循環しています: {name}")
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep)
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def _emit(self, kind, stage=None, progress=None, value=None):
+        if self.listener:
+            try:
+                self.listener(PipelineEvent(kind, self, stage, progress, value))
+            except Exception as e:
+                print(f"パイプラインのイベント処理でエラー: {e}")
+
+    def _set_progress(self, name, fraction, message=None):
+        self.progress[name] = min(max(float(fraction), 0.0), 1.0)
+        self._emit("progress", name, self.progress[name], message)
+
+    def _start(self):
+        self._schedule()
+
+    def _schedule(self):
+        # 依存が揃ったステージを実行に回し、実行できなくなったステージを確定させる
+        ready, settled = [], []
+        with self._lock:
+            changed = True
+            while changed:
+                changed = False
+                for name, stage in self.stages.items():
+                    if self.states[name] != PENDING:
+                        continue
+                    dep_states = [self.states[dep] for dep in stage.deps]
+                    if self.cancel_token.cancelled:
+                        self.states[name] = CANCELLED
+                    elif any(s in (FAILED, SKIPPED, CANCELLED) for s in dep_states):
+                        self.states[name] = SKIPPED
+                    elif all(s == FINISHED for s in dep_states):
+                        self.states[name] = RUNNING
+                        ready.append(stage)
+                        continue
+                    else:
+                        continue
+                    self.timings[name] = 0.0
+                    settled.append(name)
+                    changed = True
+            finished = not self._done.is_set() and all(
+                state not in (PENDING, RUNNING) for state in self.states.values()
+            )
+            if finished:
+                self._done.set()
+
+        for name in settled:
+            self._emit(self.states[name], name)
+        for stage in ready:
+            self.scheduler._executor.submit(self._run_stage, stage)
+        if finished:
+            self._emit("done")
+
+    def _run_stage(self, stage):
+        start_time = time.perf_counter()
+        # ステージの中の処理(分離・認識など)のトレースは、この曲のものとして記録される
+        with tracer.span(f"stage.{stage.name}", song=self.name, job=self.id) as span:
+            try:
+                self.cancel_token.check()
+                self._emit("started", stage.name, 0.0)
+                result = stage.func(JobContext(self, stage))
+                self.cancel_token.check()
+            except Cancelled:
+                state, value = CANCELLED, None
+                span.status = "cancelled"
+            except Exception as e:
+                state, value = FAILED, e
+                span.status, span.error = "error", str(e)
+                print(f"ステージ '{stage.name}' でエラーが発生しました: {e}")
+            else:
+                state, value = FINISHED, result
+
+        with self._lock:
+            self.timings[stage.name] = time.perf_counter() - start_time
+            self.states[stage.name] = state
+            if state == FINISHED:
+                self.results[stage.name] = value
+                self.progress[stage.name] = 1.0
+            elif state == FAILED:
+                self.errors[stage.name] = value
+
+        if state == FINISHED:
+            self._emit("finished", stage.name, 1.0, value)
+        elif state == FAILED:
+            self._emit("failed", stage.name, value=value)
+        else:
+            self._emit("cancelled", stage.name)
+        self._schedule()
+
+    def cancel(self):
+        # 実行中のステージは区切りでキャンセルを確認し、未着手のステージは実行しない
+        self.cancel_token.cancel()
+        self._schedule()
+
+    @property
+    def cancelled(self):
+        return self.cancel_token.cancelled
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def succeeded(self):
+        return self.done and all(s == FINISHED for s in self.states.values())
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+
+class Scheduler:
+    # ステージの依存関係(DAG)に従って、上限付きのスレッドプールでジョブを実行する
+    def __init__(self, max_workers=2):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="pipeline"
+        )
+        self.jobs = []  # 終わっていないジョブ(終了時にまとめてキャンセルする)
+
+    def submit(self, stages, name=None, params=None, listener=None):
+        job = Job(self, stages, name=name, params=params, listener=listener)
+        self.jobs = [j for j in self.jobs if not j.done] + [job]
+        job._start()
+        return job
+
+    def run(self, stages, name=None, params=None, listener=None, timeout=None):
+        # GUIを使わずに同期的に実行する
+        job = self.submit(stages, name=name, params=params, listener=listener)
+        job.wait(timeout)
+        return job
+
+    def cancel_all(self):
+        for job in self.jobs:
+            if not job.done:
+                job.cancel()
+
+    def shutdown(self, wait=True, cancel=False):
+        # cancel=True なら実行中のジョブをキャンセルし、まだ始まっていないステージは捨てる
+        if cancel:
+            self.cancel_all()
+        self._executor.shutdown(wait=wait, cancel_futures=cancel)
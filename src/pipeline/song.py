@@ -0,0 +1,105 @@
+from src.audio.copy import Copy
+from src.audio.download import Downloader
+from src.audio.separator import Separator
+from src.lyrics.aligner import read_lyrics
+from src.lyrics.recognizer import Recognizer
+from src.pipeline.scheduler import Scheduler, Stage
+from src.pitch.extractor import PitchExtractor
+
+
+def build_song_stages(
+    path=None,
+    query=None,
+    copy=None,
+    downloader=None,
+    separator=None,
+    recognizer=None,
+    pitch_extractor=None,
+    progressive=False,
+    download_queue=None,
+):
+    # 1曲分の処理を ingest -> separate -> pitch, ingest -> recognize のDAGにする
+    # 音声認識は分離前の音源の方が精度が高いので、ingestの結果に対して分離と並行して実行する
+    # progressive=True なら分離したボーカルで無音を飛ばしながら区間ごとに認識し、
+    # できたフレーズから "segment" イベントで通知する(分離の完了を待ってから始める)
+    # download_queue を渡すと、ダウンロードはキューに並べて同時に走る数を抑える
+    if (path is None) == (query is None):
+        raise ValueError("path か query のどちらか一方を指定してください")
+
+    def ingest(ctx):
+        if path is not None:
+            music_path = (copy or Copy()).copy_music(path)
+        elif download_queue is not None:
+            task = download_queue.submit(query, on_progress=ctx.progress)
+            while not task.wait(0.1):
+                if ctx.cancelled:
+                    task.cancel()
+            ctx.check_cancelled()
+            music_path = task.result
+        else:
+            music_path = (downloader or Downloader()).download_music(
+                query, on_progress=ctx.progress, check_cancelled=ctx.check_cancelled
+            )
+        if not music_path:
+            raise RuntimeError(f"音源を取得できませんでした: {path or query}")
+        return music_path
+
+    def separate(ctx):
+        return (separator or Separator()).separate(
+            ctx.results["ingest"],
+            on_progress=ctx.progress,
+            check_cancelled=ctx.check_cancelled,
+        )
+
+    def recognize(ctx):
+        module = recognizer or Recognizer()
+        if progressive:
+            lyrics_data = module.recognize_progressive(
+                ctx.results["ingest"],
+                ctx.results["separate"]["vocals"],
+                on_segment=lambda segment: ctx.emit("segment", segment),
+                on_progress=ctx.progress,
+                check_cancelled=ctx.check_cancelled,
+            )
+        else:
+            lyrics_data = module.recognize_lyrics(ctx.results["ingest"])
+        if not lyrics_data:
+            raise RuntimeError("音声認識に失敗しました。")
+
+        # 正しい歌詞 (data/output/<曲名>/lyrics.txt) があれば、認識した時刻に合わせて差し替える
+        lyrics_text = read_lyrics(ctx.results["ingest"])
+        if lyrics_text:
+            aligned = module.align_lyrics(
+                ctx.results["ingest"], lyrics_text, recognized=lyrics_data
+            )
+            lyrics_data = aligned or lyrics_data
+        return lyrics_data
+
+    def pitch(ctx):
+        vocals_path = ctx.results["separate"].get("vocals")
+        if not vocals_path:
+            raise RuntimeError("ボーカルファイルが見つかりませんでした。")
+        return (pitch_extractor or PitchExtractor()).extract_pitch_track(vocals_path)
+
+    return [
+        Stage("ingest", ingest),
+        Stage("separate", separate, deps=("ingest",)),
+        Stage(
+            "recognize",
+            recognize,
+            deps=("ingest", "separate") if progressive else ("ingest",),
+        ),
+        Stage("pitch", pitch, deps=("separate",)),
+    ]
+
+
+def process_song(path=None, query=None, scheduler=None, listener=None, **modules):
+    # GUIなしで1曲を処理する。結果はjob.resultsに入る
+    own_scheduler = scheduler is None
+    scheduler = scheduler or Scheduler()
+    stages = build_song_stages(path=path, query=query, **modules)
+    try:
+        return scheduler.run(stages, name=path or query, listener=listener)
+    finally:
+        if own_scheduler:
+            scheduler.shutdown()
@@ -1,5 +1,183 @@
+import numpy as np
+
+from src.pitch.track import PitchTrack
+
+
+def pitch_error(sung, target, octave_tolerant=True):
+    # 歌ったピッチとお手本のピッチの差(半音, 絶対値)
+    # octave_tolerant ならオクターブ違いは同じ音とみなす(男女でキーが違っても歌えるように)
+    difference = np.asarray(sung, dtype=np.float64) - target
+    if octave_tolerant:
+        difference = (difference + 6) % 12 - 6
+    return np.abs(difference)
+
+
+def frame_points(error, tolerance=1.0, falloff=3.0):
+    # tolerance 半音以内なら満点、falloff 半音で0点になるように直線で減らす
+    return np.clip((falloff - error) / (falloff - tolerance), 0.0, 1.0)
+
+
+def _advance(values, index, limit, side):
+    # values の中で limit を超える(side="right")/limit 以上になる(side="left")最初の位置
+    # 時刻が進むだけなら前回の位置から少し進めるだけで済む(戻ったときは二分探索)
+    n = len(values)
+    if index > 0 and (
+        values[index - 1] > limit or (side == "left" and values[index - 1] >= limit)
+    ):
+        return int(np.searchsorted(values, limit, side=side))
+    if side == "right":
+        while index < n and values[index] <= limit:
+            index += 1
+    else:
+        while index < n and values[index] < limit:
+            index += 1
+    return index
+
+
 class Analyzer:
+    # お手本のピッチ(PitchExtractorの結果)と歌声のピッチを比べて採点する
+    # 歌声のフレームごとに、前後 timing_window 秒のお手本で一番近い音との差を点数にする
+    # お手本が鳴っているのに歌っていないフレームは0点、お手本が無音のフレームは数えない
+    def __init__(
+        self,
+        tolerance=1.0,
+        falloff=3.0,
+        timing_window=0.15,
+        octave_tolerant=True,
+    ):
+        self.tolerance = tolerance
+        self.falloff = falloff
+        self.timing_window = timing_window
+        self.octave_tolerant = octave_tolerant
+        self.phrase_starts = np.zeros(0)
+        self.phrase_ends = np.zeros(0)
+        self.set_target(PitchTrack.empty())
+
+    def set_target(self, target_pitch_data, segments=None):
+        if not isinstance(target_pitch_data, PitchTrack):
+            target_pitch_data = PitchTrack.from_records(target_pitch_data)
+        pitch = np.asarray(target_pitch_data.pitch, dtype=np.float64)
+        voiced = pitch > 0
+        self.target_start = np.asarray(target_pitch_data.start, dtype=np.float64)[
+            voiced
+        ]
+        self.target_end = np.asarray(target_pitch_data.end, dtype=np.float64)[voiced]
+        self.target_pitch = pitch[voiced]
+        if segments is not None:
+            self.set_segments(segments)
+        self.reset()
+
+    def set_segments(self, segments):
+        # recognized.json のフレーズごとに小計を出す
+        self.phrase_starts = np.array([s["start"] for s in segments], dtype=np.float64)
+        self.phrase_ends = np.array([s["end"] for s in segments], dtype=np.float64)
+        # 歌詞が少しずつ届く場合もあるので、これまでに採点したフレームからフレーズの小計を出し直す
+        self._assign_phrases()
+
+    def reset(self):
+        self.points = 0.0
+        self.frames = 0
+        # 時刻が進むにつれて進めていく位置(お手本の窓の先頭/末尾)
+        self._window_first = 0
+        self._window_last = 0
+        # 採点したフレームの時刻と点数(フレーズが後から変わっても小計を出し直せるように)
+        self._scored_times = []
+        self._scored_points = []
+        self._assign_phrases()
+
+    def _assign_phrases(self):
+        times = np.asarray(self._scored_times, dtype=np.float64)
+        points = np.asarray(self._scored_points, dtype=np.float64)
+        phrase = np.searchsorted(self.phrase_starts, times, "right") - 1
+        in_phrase = phrase >= 0
+        in_phrase[in_phrase] = times[in_phrase] < self.phrase_ends[phrase[in_phrase]]
+        n_phrases = len(self.phrase_starts)
+        self.phrase_points = np.bincount(
+            phrase[in_phrase], weights=points[in_phrase], minlength=n_phrases
+        ).astype(np.float64)
+        self.phrase_frames = np.bincount(phrase[in_phrase], minlength=n_phrases)
+        self._phrase = (
+            int(np.searchsorted(self.phrase_starts, times[-1], "right"))
+            if len(times)
+            else 0
+        )
+
+    def add_frame(self, time, pitch):
+        # 歌声の1フレームを加える。時刻が単調に進む限り、1フレームあたり窓の大きさ分の計算で済む
+        self._window_first = _advance(
+            self.target_end, self._window_first, time - self.timing_window, "left"
+        )
+        self._window_last = _advance(
+            self.target_start, self._window_last, time + self.timing_window, "right"
+        )
+        if self._window_first >= self._window_last:
+            return self.score()  # お手本が無音
+
+        points = 0.0
+        if pitch > 0:
+            window = self.target_pitch[self._window_first : self._window_last]
+            error = pitch_error(pitch, window, self.octave_tolerant).min()
+            points = float(frame_points(error, self.tolerance, self.falloff))
+        self.points += points
+        self.frames += 1
+        self._scored_times.append(time)
+        self._scored_points.append(points)
+
+        self._phrase = _advance(self.phrase_starts, self._phrase, time, "right")
+        phrase = self._phrase - 1
+        if phrase >= 0 and time < self.phrase_ends[phrase]:
+            self.phrase_points[phrase] += points
+            self.phrase_frames[phrase] += 1
+        return self.score()
+
+    def score(self):
+        # 0-100点
+        return 100.0 * self.points / self.frames if self.frames else 0.0
+
+    def phrase_scores(self):
+        # フレーズごとの点数(採点対象のフレームが無いフレーズはNone)
+        return [
+            100.0 * points / frames if frames else None
+            for points, frames in zip(
+                self.phrase_points.tolist(), self.phrase_frames.tolist()
+            )
+        ]
+
+    def score_take(self, times, pitches):
+        # 録音した1テイク分をまとめて採点する(add_frameを順に呼んだのと同じ結果)
+        self.reset()
+        times = np.asarray(times, dtype=np.float64)
+        pitches = np.asarray(pitches, dtype=np.float64)
+
+        first = np.searchsorted(self.target_end, times - self.timing_window, "left")
+        last = np.searchsorted(self.target_start, times + self.timing_window, "right")
+        scored = first < last
+        times, pitches = times[scored], pitches[scored]
+        first, last = first[scored], last[scored]
+
+        points = np.zeros(len(times))
+        sung = pitches > 0
+        if sung.any():
+            # 窓の長さを揃えた2次元の添字で、窓内の最小誤差を一度に求める
+            first_sung, length = first[sung], (last - first)[sung]
+            offsets = np.arange(length.max())
+            index = first_sung[:, None] + offsets
+            inside = offsets < length[:, None]
+            index = np.where(inside, index, first_sung[:, None])
+            error = pitch_error(
+                pitches[sung, None], self.target_pitch[index], self.octave_tolerant
+            )
+            error = np.where(inside, error, np.inf).min(axis=1)
+            points[sung] = frame_points(error, self.tolerance, self.falloff)
+
+        self.points = float(points.sum())
+        self.frames = len(points)
+        self._scored_times = times.tolist()
+        self._scored_points = points.tolist()
+        self._assign_phrases()
+        return self.score()
+
     def calculate_score(self, target_pitch_data, input_pitch_data):
-        # 採点処理を実装
-        score = 0
-        return score
\ No newline at end of file
+        # input_pitch_data: "time" と "pitch" を持つ配列(Recorder.get_recorded_data の形式)
+        self.set_target(target_pitch_data)
+        return self.score_take(input_pitch_data["time"], input_pitch_data["pitch"])
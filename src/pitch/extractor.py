@@ -1,144 +1,236 @@
-import librosa
-import numpy as np
 import os
-import json
+
+import numpy as np
+
+from src.audio.pcm_cache import ANALYSIS, pcm_cache
+from src.cache.artifact_cache import artifact_cache, file_digest, make_key
+from src.pitch.postprocess import (
+    correct_octaves,
+    frame_rms,
+    frame_signal,
+    postprocess_pitch,
+    segment_notes,
+)
+from src.pitch.track import PitchTrack
+from src.pitch.yin import yin
+from src.tracing.tracer import tracer
+
+CACHE_VERSION = (
+    3  # 2: pitch.jsonからpitch.binに変更, 3: 信頼度つきYIN・オクターブ補正・音符単位
+)
+
+# 以前の pitch.json を作ったときのパラメータ (librosa.yin, 元のサンプリングレートのまま)
+LEGACY_PARAMS = {
+    "sr": None,
+    "hop_length": 2048,
+    "frame_length": 2048,
+    "fmin": 100,
+    "fmax": 1000,
+}
+
+YIN_BATCH = 1024  # 一度にYINに渡すフレーム数(メモリ使用量を抑える)
 
 
 class PitchExtractor:
-    def __init__(self, cache_dir="data/output"):
+    def __init__(self, cache_dir="data/output", cache=None, pcm=None):
         self.cache_dir = cache_dir
+        self.cache = cache or artifact_cache
+        self.pcm_cache = pcm or pcm_cache
         self.volume_threshold = 0.02  # 音量の閾値
-
-    def _get_cache_file_path(self, audio_path):
+        self.outlier_threshold = 20  # 外れ値とみなす前後フレームとの差(半音)
+        self.octave_window = (
+            11  # オクターブ補正で基準にする中央値の幅(フレーム, 約0.5秒)
+        )
+        self.min_note_duration = 0.1  # これより短い音符は捨てる(秒)
+
+    def default_params(self):
+        # extract_pitch_track の既定の引数に対応するキャッシュのパラメータ
+        return self._cache_params(
+            {
+                "sr": ANALYSIS["samplerate"],
+                "hop_length": 736,
+                "frame_length": 736,
+                "fmin": 100,
+                "fmax": 1000,
+                "notes": True,
+            }
+        )
+
+    def _cache_params(self, params):
+        params = dict(
+            params,
+            volume_threshold=self.volume_threshold,
+            outlier_threshold=self.outlier_threshold,
+            octave_window=self.octave_window,
+        )
+        if params.get("notes"):
+            params["min_note_duration"] = self.min_note_duration
+        return params
+
+    def _get_cache_key(self, audio_path, params):
         # ここでは分離後のpathが渡される
-        parent_dir = os.path.dirname(audio_path)
-        return os.path.join(parent_dir, "pitch.json")
+        # ボーカルの内容と解析パラメータでキャッシュを引く(パラメータが変われば再解析)
+        source = file_digest(audio_path)
+        params = self._cache_params(params)
+        tracer.annotate(params=params)
+        return source, params, make_key("pitch", source, params, CACHE_VERSION)
+
+    def _legacy_key(self, source):
+        params = self._cache_params(dict(LEGACY_PARAMS, notes=True))
+        return make_key("pitch", source, params, CACHE_VERSION)
+
+    def import_frames(self, records, source, params=LEGACY_PARAMS):
+        # 以前のフレーム単位の結果 [{start, end, pitch}, ...] を、オクターブ補正して音符にまとめて登録する
+        # params は records を作ったときの解析パラメータ(音量・外れ値の閾値は今と同じ)
+        params = self._cache_params(dict(params, notes=True))
+        key = make_key("pitch", source, params, CACHE_VERSION)
+        if self.cache.lookup("pitch", key):
+            return False
+
+        track = PitchTrack.from_records(records).to_array()
+        track = track[track["pitch"] > 0]
+        track = correct_octaves(track, window=self.octave_window)
+        hop = float(np.median(track["end"] - track["start"])) if len(track) else 0.0
+        notes = segment_notes(
+            track, min_duration=self.min_note_duration, max_gap=hop * 1.5
+        )
+        with self.cache.write(
+            "pitch",
+            key,
+            source=source,
+            params=params,
+            version=CACHE_VERSION,
+            meta={"migrated_from": "json"},
+        ) as tmp_dir:
+            PitchTrack.from_array(notes).save(
+                os.path.join(tmp_dir, "pitch.bin"), pitch_dtype="uint8"
+            )
+        return True
 
-    def extract_pitch(
+    def extract_pitch(self, audio_path, **kwargs):
+        # 出力は {start: 開始時間, end: 終了時間, pitch: MIDIノート番号} の辞書のリスト
+        # (互換形式。GUIでは extract_pitch_track の PitchTrack を使う)
+        return self.extract_pitch_track(audio_path, **kwargs).to_records()
+
+    def extract_pitch_array(self, audio_path, **kwargs):
+        # 出力は PITCH_DTYPE (start, end, pitch) の構造化配列
+        return self.extract_pitch_track(audio_path, **kwargs).to_array()
+
+    @tracer.traced("pitch")
+    def extract_pitch_track(
         self,
         audio_path,
-        sr=None,  # サンプリングレート(Noneだとlibrosaが自動で判断)
-        hop_length=2048,  # 分析フレーム間のホップ長(大きいと時間分解能が低くなる)
-        frame_length=2048,  # フレーム長(大きいと周波数分解能が低くなる)
+        sr=ANALYSIS[
+            "samplerate"
+        ],  # サンプリングレート(音声認識と同じ16kHzのデコード結果を使う)
+        hop_length=736,  # 分析フレーム間のホップ長(大きいと時間分解能が低くなる, 16kHzで約46ms)
+        frame_length=736,  # フレーム長(大きいと周波数分解能が低くなる)
         fmin=100,  # 検出する最小周波数
         fmax=1000,  # 検出する最大周波数
+        notes=True,  # Trueなら音符単位、Falseならフレーム単位で返す
     ):
+        # 出力は列ごとの配列を持つ PitchTrack (キャッシュからはmmapで読み込む)
+        # 音符単位のときは (開始, 終了, 整数の音程, 平均信頼度) で、フレームより1-2桁少ない
 
-        # 出力は {start: 開始時間, end: 終了時間, pitch: MIDIノート番号} の辞書？
-
-        cache_file_path = self._get_cache_file_path(audio_path)
+        try:
+            source, params, key = self._get_cache_key(
+                audio_path,
+                {
+                    "sr": sr,
+                    "hop_length": hop_length,
+                    "frame_length": frame_length,
+                    "fmin": fmin,
+                    "fmax": fmax,
+                    "notes": notes,
+                },
+            )
+        except FileNotFoundError:
+            print(f"音声ファイルが見つかりません: {audio_path}")
+            return PitchTrack.empty()
 
         # キャッシュが存在するか確認
-        if os.path.exists(cache_file_path):
+        cached = self.cache.lookup("pitch", key)
+        if not cached and params == self.default_params():
+            # 以前の pitch.json から変換した結果があれば、再解析せずにそれを使う
+            legacy_key = self._legacy_key(source)
+            cached = self.cache.lookup("pitch", legacy_key)
+            if cached:
+                tracer.annotate(cache="hit")
+                key = legacy_key
+        if cached:
+            cache_file_path = cached["pitch.bin"]
             print(f"ピッチ解析結果のキャッシュが見つかりました: {cache_file_path}")
             try:
-                with open(cache_file_path, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
+                return PitchTrack.load(cache_file_path)
+            except (OSError, ValueError):
                 print(
                     f"ピッチ解析結果キャッシュの読み込みに失敗しました。再実行します: {cache_file_path}"
                 )
                 # キャッシュが壊れている場合は再実行
-                pass
+                self.cache.invalidate("pitch", key)
 
         try:
-            # 音声ファイルを読み込む
-            y, sr = librosa.load(audio_path, sr=sr)
-
-            # 短時間フーリエ変換 (STFT) を計算
-            stft = np.abs(librosa.stft(y, hop_length=hop_length, n_fft=frame_length))
+            # デコード済みのモノラルPCMを使う(同じファイルを何度もデコードしない)
+            if sr == ANALYSIS["samplerate"]:
+                pcm = self.pcm_cache.analysis(audio_path)
+                y = pcm.data
+            else:
+                pcm = self.pcm_cache.get(audio_path, samplerate=sr)
+                y = pcm.data[:, 0]
+            sr = pcm.samplerate
 
             # RMS (Root Mean Square) エネルギーを計算
-            rms = librosa.feature.rms(
-                S=stft, frame_length=frame_length, hop_length=hop_length
-            )[0]
-
-            # YINアルゴリズムでピッチを推定
-            f0 = librosa.yin(
-                y,
-                fmin=fmin,
-                fmax=fmax,
-                sr=sr,
-                hop_length=hop_length,
-                frame_length=frame_length,
-            )
+            # STFTの振幅から求めるのと同じ値を、FFTなしで窓掛けフレームから直接求める
+            rms = frame_rms(y, frame_length=frame_length, hop_length=hop_length)
+
+            # YINアルゴリズムでピッチと信頼度を推定 (librosa.yin と同じ中心合わせのフレーム)
+            frames = frame_signal(y, frame_length=frame_length, hop_length=hop_length)
+            f0 = np.zeros(len(frames))
+            confidence = np.zeros(len(frames))
+            for i in range(0, len(frames), YIN_BATCH):
+                f0[i : i + YIN_BATCH], confidence[i : i + YIN_BATCH] = yin(
+                    frames[i : i + YIN_BATCH], sr, fmin=fmin, fmax=fmax
+                )
 
             # 時間軸を作成
-            times = librosa.times_like(f0, sr=sr, hop_length=hop_length)
-
-            # MIDIノート番号に変換
-            pitch_midi = [librosa.hz_to_midi(p) if p > 0 else 0 for p in f0]
-
-            # 音量とピッチデータをフィルタリング
-            pitch_data = []
-            for i in range(len(times) - 1):
-                if rms[i] > self.volume_threshold:  # 音量が閾値を超える場合のみ
-                    pitch_data.append(
-                        {
-                            "start": times[i],
-                            "end": times[i + 1],
-                            "pitch": pitch_midi[i],
-                        }
-                    )
-
-            # 単音化処理
-            filtered_pitch_data = []
-            if pitch_data:
-                current_time = pitch_data[0]["start"]
-                current_pitches = []
-                for note in pitch_data:
-                    if note["start"] == current_time:
-                        current_pitches.append(note)
-                    else:
-                        if current_pitches:
-                            # 最も音量が大きいピッチを選択
-                            loudest_pitch = max(
-                                current_pitches,
-                                key=lambda x: rms[
-                                    np.argmin(np.abs(times - x["start"]))
-                                ],  # 対応する時刻のRMS値を取得
-                            )
-                            filtered_pitch_data.append(loudest_pitch)
-                        current_time = note["start"]
-                        current_pitches = [note]
-                if current_pitches:
-                    loudest_pitch = max(
-                        current_pitches,
-                        key=lambda x: rms[np.argmin(np.abs(times - x["start"]))],
-                    )
-                    filtered_pitch_data.append(loudest_pitch)
-            
-            # ここでオクターブ系の処理をしたい
-            # 前後一定期間を見た時に、オクターブ(もしくはハモリ)で並行してそうなのを検知したら、片方に移動させる
-            # オクターブを行き来する音程の場合特別したい。。
-
-            # 局所的な外れ値を削除する
-            filtered_pitch_data2 = []
-            if filtered_pitch_data:
-                for i in range(1, len(filtered_pitch_data) - 1):
-                    distance = (
-                        filtered_pitch_data[i + 1]["pitch"]
-                        - filtered_pitch_data[i]["pitch"]
-                    )
-                    distance += (
-                        filtered_pitch_data[i - 1]["pitch"]
-                        - filtered_pitch_data[i]["pitch"]
-                    )
-                    if abs(distance) > 20:
-                        pass
-                    else:
-                        filtered_pitch_data2.append(filtered_pitch_data[i])
+            times = np.arange(len(frames)) * hop_length / sr
+
+            # MIDIノート番号への変換、音量によるフィルタリング、
+            # オクターブ誤りの補正(前後の中央値とつながりを見てビタビで選ぶ)、局所的な外れ値の削除
+            pitch_track = postprocess_pitch(
+                f0,
+                rms,
+                times,
+                volume_threshold=self.volume_threshold,
+                outlier_threshold=self.outlier_threshold,
+                confidence=confidence,
+                octave_window=self.octave_window,
+            )
+            if notes:
+                pitch_track = segment_notes(
+                    pitch_track,
+                    min_duration=self.min_note_duration,
+                    max_gap=hop_length / sr * 1.5,
+                )
 
-            # 結果をキャッシュに保存
+            # 結果をキャッシュに保存(音符の音程は整数なのでuint8で持つ)
             try:
-                with open(cache_file_path, "w", encoding="utf-8") as f:
-                    json.dump(filtered_pitch_data2, f, ensure_ascii=False, indent=4)
-                print(f"ピッチ解析結果をキャッシュに保存しました: {cache_file_path}")
+                with self.cache.write(
+                    "pitch", key, source=source, params=params, version=CACHE_VERSION
+                ) as tmp_dir:
+                    PitchTrack.from_array(pitch_track).save(
+                        os.path.join(tmp_dir, "pitch.bin"),
+                        pitch_dtype="uint8" if notes else "float32",
+                    )
+                print(
+                    f"ピッチ解析結果をキャッシュに保存しました: {self.cache.entry_dir('pitch', key)}"
+                )
             except Exception as e:
                 print(f"ピッチ解析結果キャッシュの保存に失敗しました: {e}")
 
-            return filtered_pitch_data2
+            return PitchTrack.from_array(pitch_track)
 
         except Exception as e:
             print(f"ピッチ解析エラー: {e}")
-            return []
+            tracer.fail(e)
+            return PitchTrack.empty()
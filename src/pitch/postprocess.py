@@ -0,0 +1,161 @@
+import numpy as np
+
+# ピッチデータの配列形式 (1フレーム1行)
+PITCH_DTYPE = np.dtype([("start", "f8"), ("end", "f8"), ("pitch", "f8")])
+# 信頼度(0.0-1.0)つき。音符にまとめたデータもこの形式
+NOTE_DTYPE = np.dtype(
+    [("start", "f8"), ("end", "f8"), ("pitch", "f8"), ("confidence", "f8")]
+)
+
+
+def frame_signal(y, frame_length=2048, hop_length=2048):
+    # 中心合わせ(前後を0埋め)したフレームの (フレーム数, frame_length) のビュー
+    # librosa の center=True と同じフレームの切り方
+    y = np.asarray(y)
+    padded = np.pad(y, frame_length // 2, mode="constant")
+    n_frames = max(0, 1 + (len(padded) - frame_length) // hop_length)
+    return np.lib.stride_tricks.as_strided(
+        padded,
+        shape=(n_frames, frame_length),
+        strides=(padded.strides[0] * hop_length, padded.strides[0]),
+        writeable=False,
+    )
+
+
+def frame_rms(y, frame_length=2048, hop_length=2048):
+    # 窓掛けしたフレームのRMS
+    # librosa.stft の振幅から librosa.feature.rms(S=...) で求めた値と同じになる(パーセバルの定理)
+    frames = frame_signal(y, frame_length, hop_length)
+    if len(frames) == 0:
+        return np.zeros(0, dtype=frames.dtype)
+    # 周期的なハン窓(librosaの既定の窓)
+    window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(frame_length) / frame_length)
+    power = np.einsum("ji,ji,i->j", frames, frames, window**2) / frame_length
+    return np.sqrt(power)
+
+
+def hz_to_midi(f0):
+    # 0以下(無声)は0にする
+    f0 = np.asarray(f0, dtype=np.float64)
+    midi = np.zeros_like(f0)
+    voiced = f0 > 0
+    midi[voiced] = 12 * np.log2(f0[voiced] / 440.0) + 69
+    return midi
+
+
+def select_frames(times, pitch_midi, rms, volume_threshold, confidence=None):
+    # 音量が閾値を超える有声のフレームだけを残す(最後のフレームは終了時刻がないので使わない)
+    dtype = PITCH_DTYPE if confidence is None else NOTE_DTYPE
+    n = min(len(times) - 1, len(pitch_midi), len(rms))
+    if n <= 0:
+        return np.zeros(0, dtype=dtype)
+    index = np.flatnonzero((rms[:n] > volume_threshold) & (pitch_midi[:n] > 0))
+    track = np.empty(len(index), dtype=dtype)
+    track["start"] = times[index]
+    track["end"] = times[index + 1]
+    track["pitch"] = pitch_midi[index]
+    if confidence is not None:
+        track["confidence"] = confidence[index]
+    return track
+
+
+def rolling_median(values, window):
+    # 前後 window//2 フレームの中央値(端は端の値で埋める)
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0 or window <= 1:
+        return values.copy()
+    half = window // 2
+    padded = np.pad(values, half, mode="edge")
+    return np.median(
+        np.lib.stride_tricks.sliding_window_view(padded, 2 * half + 1), axis=1
+    )
+
+
+def correct_octaves(track, window=11, octave_penalty=2.0, max_gap=0.1):
+    # オクターブ誤り(倍音・半分の周期を拾ったフレーム)を直す
+    # 各フレームで「そのまま / 1オクターブ上 / 1オクターブ下」の候補から、
+    # 周りの中央値に近く、前のフレームから大きく跳ばない並びをビタビで選ぶ
+    if len(track) < 2:
+        return track
+    pitch = track["pitch"]
+    shifts = np.array([0.0, 12.0, -12.0])
+    candidates = pitch[:, None] + shifts  # (フレーム数, 候補)
+
+    # 出力コスト: 周りの中央値からの距離 + オクターブ移動のペナルティ
+    reference = rolling_median(pitch, window)
+    emission = np.abs(candidates - reference[:, None]) + octave_penalty * (shifts != 0)
+    # 遷移コスト: 前のフレームとの音程差(半音)。間が空いたら新しいフレーズとして0
+    transition = np.abs(candidates[1:, None, :] - candidates[:-1, :, None])
+    transition[track["start"][1:] - track["end"][:-1] > max_gap] = 0.0
+
+    n, k = candidates.shape
+    backpointer = np.zeros((n, k), dtype=np.int64)
+    cost = emission[0]
+    states = np.arange(k)
+    for t in range(1, n):
+        total = cost[:, None] + transition[t - 1]
+        backpointer[t] = total.argmin(axis=0)
+        cost = total[backpointer[t], states] + emission[t]
+
+    path = np.empty(n, dtype=np.int64)
+    path[-1] = cost.argmin()
+    for t in range(n - 1, 0, -1):
+        path[t - 1] = backpointer[t, path[t]]
+
+    corrected = track.copy()
+    corrected["pitch"] = candidates[np.arange(n), path]
+    return corrected
+
+
+def segment_notes(track, min_duration=0.1, max_gap=0.1, smoothing=5):
+    # 同じ音程が続くフレームを1つの音符 (開始, 終了, 音程(整数), 平均信頼度) にまとめる
+    notes = np.zeros(0, dtype=NOTE_DTYPE)
+    if len(track) == 0:
+        return notes
+    start, end = track["start"], track["end"]
+    # ビブラートや音程の揺れで音符が細切れにならないよう、中央値でならしてから丸める
+    quantized = np.rint(rolling_median(track["pitch"], smoothing))
+    if "confidence" in track.dtype.names:
+        confidence = track["confidence"]
+    else:
+        confidence = np.ones(len(track))
+
+    boundary = np.ones(len(track), dtype=bool)
+    boundary[1:] = (quantized[1:] != quantized[:-1]) | (start[1:] - end[:-1] > max_gap)
+    first = np.flatnonzero(boundary)
+    last = np.append(first[1:] - 1, len(track) - 1)
+
+    notes = np.empty(len(first), dtype=NOTE_DTYPE)
+    notes["start"] = start[first]
+    notes["end"] = end[last]
+    notes["pitch"] = quantized[first]
+    notes["confidence"] = np.add.reduceat(confidence, first) / (last - first + 1)
+    return notes[notes["end"] - notes["start"] >= min_duration]
+
+
+def remove_outliers(track, threshold=20):
+    # 前後のフレームとの差の合計が大きいフレームを局所的な外れ値として削除する
+    # (先頭と末尾は前後が揃わないので削除)
+    if len(track) < 3:
+        return track[:0]
+    pitch = track["pitch"]
+    distance = pitch[2:] + pitch[:-2] - 2 * pitch[1:-1]
+    keep = np.flatnonzero(np.abs(distance) <= threshold) + 1
+    return track[keep]
+
+
+def postprocess_pitch(
+    f0,
+    rms,
+    times,
+    volume_threshold,
+    outlier_threshold=20,
+    confidence=None,
+    octave_window=None,
+):
+    # octave_window を指定すると、外れ値を消す前にオクターブ誤りを直す
+    pitch_midi = hz_to_midi(f0)
+    track = select_frames(times, pitch_midi, rms, volume_threshold, confidence)
+    if octave_window:
+        track = correct_octaves(track, window=octave_window)
+    return remove_outliers(track, outlier_threshold)
@@ -0,0 +1,277 @@
+import argparse
+import json
+import os
+import struct
+import sys
+import tempfile
+
+import numpy as np
+
+from src.pitch.postprocess import PITCH_DTYPE
+
+# ピッチデータのバイナリ形式 (pitch.bin)
+# ヘッダ(64バイト)のあと、列ごとに連続した配列を64バイト境界に並べる
+#   start: float32[n], end: float32[n], pitch: float32[n] または uint8[n]
+#   confidence: uint8[n] (0-255を0.0-1.0に対応させる, 任意)
+# 列ごとにmmapできるので、開いた時点では何も読み込まない
+MAGIC = b"NKPITCH\0"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sIIQ")  # magic, version, flags, count
+HEADER_SIZE = 64
+ALIGNMENT = 64
+FLAG_CONFIDENCE = 1
+FLAG_PITCH_UINT8 = 2
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _layout(count, flags):
+    # (列名, dtype, オフセット) の一覧
+    columns = [("start", np.float32), ("end", np.float32)]
+    columns.append(("pitch", np.uint8 if flags & FLAG_PITCH_UINT8 else np.float32))
+    if flags & FLAG_CONFIDENCE:
+        columns.append(("confidence", np.uint8))
+    layout = []
+    offset = HEADER_SIZE
+    for name, dtype in columns:
+        layout.append((name, np.dtype(dtype), offset))
+        offset = _aligned(offset + np.dtype(dtype).itemsize * count)
+    return layout
+
+
+class PitchTrack:
+    # 時刻順に並んだピッチデータを列ごとに保持する
+    def __init__(self, start, end, pitch, confidence=None):
+        self.start = np.asarray(start)
+        self.end = np.asarray(end)
+        self.pitch = np.asarray(pitch)
+        # confidenceは0.0-1.0 (ファイル上ではuint8)
+        self.confidence = None if confidence is None else np.asarray(confidence)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0, np.float32), np.zeros(0, np.float32), np.zeros(0))
+
+    @classmethod
+    def from_array(cls, track):
+        confidence = (
+            track["confidence"] if "confidence" in (track.dtype.names or ()) else None
+        )
+        return cls(track["start"], track["end"], track["pitch"], confidence)
+
+    @classmethod
+    def from_records(cls, records):
+        start = np.array([r["start"] for r in records], dtype=np.float64)
+        end = np.array([r["end"] for r in records], dtype=np.float64)
+        pitch = np.array([r["pitch"] for r in records], dtype=np.float64)
+        confidence = None
+        if records and all("confidence" in r for r in records):
+            confidence = np.array([r["confidence"] for r in records])
+        return cls(start, end, pitch, confidence)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(path, "rb") as f:
+            magic, version, flags, count = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"ピッチデータの形式が違います: {path}")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"未対応のピッチデータのバージョンです: {version}")
+
+        columns = {}
+        if count:
+            raw = (
+                np.memmap(path, dtype=np.uint8, mode="r")
+                if mmap
+                else np.fromfile(path, dtype=np.uint8)
+            )
+            for name, dtype, offset in _layout(count, flags):
+                columns[name] = raw[offset : offset + dtype.itemsize * count].view(
+                    dtype
+                )
+        else:
+            for name, dtype, _ in _layout(0, flags):
+                columns[name] = np.zeros(0, dtype=dtype)
+
+        confidence = columns.get("confidence")
+        if confidence is not None:
+            # 使うときに初めて実数に変換する
+            confidence = _LazyConfidence(confidence)
+        track = cls(columns["start"], columns["end"], columns["pitch"])
+        track._confidence = confidence
+        return track
+
+    @property
+    def confidence(self):
+        if isinstance(self._confidence, _LazyConfidence):
+            self._confidence = self._confidence.decode()
+        return self._confidence
+
+    @confidence.setter
+    def confidence(self, value):
+        self._confidence = value
+
+    def save(self, path, pitch_dtype="float32"):
+        # pitch_dtype="uint8" は量子化済みの音符データ向け(0-255のMIDIノート番号)
+        count = len(self)
+        flags = 0
+        if self.confidence is not None:
+            flags |= FLAG_CONFIDENCE
+        if np.dtype(pitch_dtype) == np.uint8:
+            flags |= FLAG_PITCH_UINT8
+
+        columns = {
+            "start": self.start,
+            "end": self.end,
+            "pitch": (
+                np.clip(np.rint(self.pitch), 0, 255)
+                if flags & FLAG_PITCH_UINT8
+                else self.pitch
+            ),
+        }
+        if self.confidence is not None:
+            columns["confidence"] = np.rint(np.clip(self.confidence, 0.0, 1.0) * 255)
+
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(
+                    HEADER.pack(MAGIC, FORMAT_VERSION, flags, count).ljust(
+                        HEADER_SIZE, b"\0"
+                    )
+                )
+                for name, dtype, offset in _layout(count, flags):
+                    f.write(b"\0" * (offset - f.tell()))
+                    f.write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+    def __len__(self):
+        return len(self.start)
+
+    def to_array(self):
+        track = np.empty(len(self), dtype=PITCH_DTYPE)
+        track["start"] = self.start
+        track["end"] = self.end
+        track["pitch"] = self.pitch
+        return track
+
+    def to_records(self):
+        # デバッグ用・互換用の [{start, end, pitch(, confidence)}, ...] 形式
+        columns = [self.start.tolist(), self.end.tolist(), self.pitch.tolist()]
+        if self.confidence is None:
+            return [
+                {"start": start, "end": end, "pitch": pitch}
+                for start, end, pitch in zip(*columns)
+            ]
+        return [
+            {"start": start, "end": end, "pitch": pitch, "confidence": confidence}
+            for start, end, pitch, confidence in zip(*columns, self.confidence.tolist())
+        ]
+
+    def export_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_records(), f, ensure_ascii=False, indent=4)
+        return path
+
+
+class _LazyConfidence:
+    def __init__(self, raw):
+        self.raw = raw
+
+    def decode(self):
+        return self.raw.astype(np.float32) / 255.0
+
+
+def migrate_json_caches(cache=None, output_root=os.path.join("data", "output")):
+    # 既存のpitch.jsonを、今のキャッシュ(オクターブ補正・音符単位のpitch.bin)に一括で変換する
+    # - キャッシュ(data/cache/pitch)のJSON形式のエントリ (元のエントリは残す)
+    # - キャッシュ導入前の data/output/<曲名>/pitch.json (隣のvocals.mp3から以前のパラメータで登録)
+    #   同じフォルダの music.mp3 と分離結果も分離のキャッシュに登録するので、
+    #   その music.mp3 を開くと分離もピッチ解析もやり直さずに済む
+    # 既定のパラメータで解析するときに見つからなければ、変換した結果を使う
+    from src.audio.copy import find_music
+    from src.audio.separator import STEMS, Separator
+    from src.cache.artifact_cache import artifact_cache, file_digest
+    from src.pitch.extractor import LEGACY_PARAMS, PitchExtractor
+
+    cache = cache or artifact_cache
+    extractor = PitchExtractor(cache=cache)
+    separator = Separator(cache=cache)
+    migrated = 0
+
+    def load_records(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"変換できませんでした: {path}: {e}")
+            return None
+
+    for _, _, stage, key in cache.entries():
+        if stage != "pitch":
+            continue
+        manifest = cache.get_manifest(stage, key)
+        if not manifest or "pitch.json" not in manifest.get("files", {}):
+            continue
+        paths = cache.lookup(stage, key)
+        if not paths:
+            continue
+        records = load_records(paths["pitch.json"])
+        if records is None:
+            continue
+        params = {
+            name: manifest["params"].get(name, value)
+            for name, value in LEGACY_PARAMS.items()
+        }
+        migrated += extractor.import_frames(records, manifest["source"], params)
+
+    if os.path.isdir(output_root):
+        for name in sorted(os.listdir(output_root)):
+            song_dir = os.path.join(output_root, name)
+            if not os.path.isdir(song_dir):
+                continue
+            json_path = os.path.join(song_dir, "pitch.json")
+            stem_paths = {stem: os.path.join(song_dir, f"{stem}.mp3") for stem in STEMS}
+            if not (os.path.exists(json_path) and os.path.exists(stem_paths["vocals"])):
+                continue
+            music = find_music(os.listdir(song_dir))
+            if music and all(os.path.exists(path) for path in stem_paths.values()):
+                separator.import_stems(os.path.join(song_dir, music), stem_paths)
+            vocals_path = stem_paths["vocals"]
+            records = load_records(json_path)
+            if records is None:
+                continue
+            migrated += extractor.import_frames(records, file_digest(vocals_path))
+
+    print(f"ピッチ解析結果を{migrated}件変換しました")
+    return migrated
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ピッチデータ(pitch.bin)の変換")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("migrate", help="既存のpitch.jsonをpitch.binに変換する")
+    export_parser = subparsers.add_parser("export", help="pitch.binをJSONに書き出す")
+    export_parser.add_argument("input")
+    export_parser.add_argument("output")
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        migrate_json_caches()
+    elif args.command == "export":
+        PitchTrack.load(args.input).export_json(args.output)
+        print(f"JSONに書き出しました: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
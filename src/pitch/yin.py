@@ -0,0 +1,76 @@
+import numpy as np
+
+
+def yin(frames, sr, fmin=100, fmax=1000, threshold=0.15):
+    # YINで各フレームの基本周波数を推定する
+    # frames: (フレーム数, フレーム長) または (フレーム長,)
+    # 戻り値: (f0[Hz], confidence[0-1]) 。無声のフレームはf0=0
+    frames = np.asarray(frames, dtype=np.float64)
+    single = frames.ndim == 1
+    if single:
+        frames = frames[np.newaxis, :]
+
+    frame_length = frames.shape[1]
+    tau_min = max(2, int(sr // fmax))
+    tau_max = min(int(np.ceil(sr / fmin)), frame_length // 2)
+    if tau_max <= tau_min:
+        raise ValueError(
+            "フレーム長が短すぎます(fminを上げるかフレーム長を伸ばしてください)"
+        )
+    window = frame_length - tau_max
+
+    # 差分関数 d(τ) = Σ(x_j - x_{j+τ})^2 をFFTの相互相関とエネルギーの累積和で求める
+    n_fft = 1 << int(np.ceil(np.log2(frame_length + window)))
+    spectrum = np.fft.rfft(frames, n_fft, axis=1)
+    head_spectrum = np.fft.rfft(frames[:, :window], n_fft, axis=1)
+    correlation = np.fft.irfft(spectrum * np.conj(head_spectrum), n_fft, axis=1)[
+        :, : tau_max + 1
+    ]
+    energy = np.cumsum(np.pad(frames**2, ((0, 0), (1, 0))), axis=1)
+    head_energy = energy[:, window][:, np.newaxis]
+    taus = np.arange(tau_max + 1)
+    shifted_energy = energy[:, taus + window] - energy[:, taus]
+    difference = np.maximum(head_energy + shifted_energy - 2 * correlation, 0.0)
+
+    # 累積平均正規化差分関数 d'(τ)
+    cumulative = np.cumsum(difference[:, 1:], axis=1)
+    cmnd = np.ones_like(difference)
+    # 無音や直流(差分がほぼ0)のフレームは周期的とみなさない
+    # FFTの丸め誤差はフレームのエネルギーに比例して残るので、閾値もエネルギーに比例させる
+    floor = np.maximum(1e-9 * head_energy, 1e-12) * taus[1:]
+    cmnd[:, 1:] = np.where(
+        cumulative > floor,
+        difference[:, 1:] * taus[1:] / np.maximum(cumulative, 1e-12),
+        1.0,
+    )
+
+    # 閾値を下回る最初の谷を探す(なければ範囲内の最小値)
+    search = cmnd[:, tau_min : tau_max + 1]
+    below = search < threshold
+    local_min = np.zeros_like(below)
+    local_min[:, 1:-1] = (search[:, 1:-1] <= search[:, :-2]) & (
+        search[:, 1:-1] <= search[:, 2:]
+    )
+    candidates = below & local_min
+    has_candidate = candidates.any(axis=1)
+    best = (
+        np.where(has_candidate, candidates.argmax(axis=1), search.argmin(axis=1))
+        + tau_min
+    )
+
+    # 放物線補間で周期を細かく求める
+    rows = np.arange(len(frames))
+    left = cmnd[rows, np.maximum(best - 1, 0)]
+    center = cmnd[rows, best]
+    right = cmnd[rows, np.minimum(best + 1, tau_max)]
+    denominator = left - 2 * center + right
+    safe = np.abs(denominator) > 1e-12
+    shift = np.zeros_like(denominator)
+    shift[safe] = 0.5 * (left - right)[safe] / denominator[safe]
+    period = best + np.clip(shift, -1, 1)
+
+    confidence = np.clip(1.0 - center, 0.0, 1.0)
+    f0 = np.where(has_candidate, sr / period, 0.0)
+    if single:
+        return f0[0], confidence[0]
+    return f0, confidence
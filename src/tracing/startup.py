@@ -0,0 +1,66 @@
+import re
+import subprocess
+import sys
+
+# 起動時間の計測 (python3 -m src.main --profile-startup)
+# ウィンドウを表示するまでの各段階は tracer の "startup.*" のspanで測り、
+# importの内訳は別プロセスで -X importtime を使って調べる
+
+IMPORT_TIME_PATTERN = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (.*)$")
+
+
+def measure_imports(module, python=sys.executable):
+    # module を import したときの各モジュールの時間(マイクロ秒)を [(名前, 自身, 累積), ...] で返す
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        lines = result.stderr.strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else f"import {module} に失敗しました")
+    entries = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match:
+            entries.append(
+                (match.group(3).strip(), int(match.group(1)), int(match.group(2)))
+            )
+    return entries
+
+
+def group_imports(entries):
+    # 外部ライブラリはパッケージごと、このリポジトリ(src.*)はモジュールごとに自身の時間を合計する
+    totals = {}
+    for name, self_time, _ in entries:
+        key = name if name.startswith("src.") else name.split(".")[0]
+        totals[key] = totals.get(key, 0) + self_time
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+
+def format_report(records, ready, imports=None, budget=None, top=15):
+    lines = [f"ウィンドウ表示まで: {ready:.2f}秒"]
+    if budget is not None:
+        result = "OK" if ready <= budget else "超過"
+        lines[0] += f" (上限 {budget:.2f}秒: {result})"
+
+    lines.append("起動処理の内訳:")
+    for record in records:
+        if not record["name"].startswith("startup."):
+            continue
+        name = record["name"][len("startup.") :]
+        if record.get("module"):
+            name += f" {record['module']}"
+        lines.append(f"  {name:<40} {record['wall']:7.3f}秒")
+
+    loads = [record for record in records if record["name"] == "model.load"]
+    if loads:
+        lines.append("モデルのロード(バックグラウンド):")
+        for record in loads:
+            lines.append(f"  {record['model']:<40} {record['wall']:7.3f}秒")
+
+    if imports:
+        lines.append(f"importの内訳(上位{top}件, -X importtime):")
+        for name, self_time in group_imports(imports)[:top]:
+            lines.append(f"  {name:<40} {self_time / 1e6:7.3f}秒")
+    return "\n".join(lines)
@@ -0,0 +1,186 @@
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TRACE_PATH = os.path.join("data", "logs", "trace.jsonl")
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class Span:
+    # 1つの処理の計測結果。with の中で annotate したものは fields に入る
+    def __init__(self, name, song=None, parent=None, fields=None):
+        self.name = name
+        self.song = song if song is not None else (parent.song if parent else None)
+        self.parent = parent
+        self.fields = dict(fields or {})
+        self.status = "ok"
+        self.error = None
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.thread_time()
+        self._start_process_cpu = time.process_time()
+        self._start_peak = _peak_rss_mb()
+        self.started = time.time()
+
+    def finish(self):
+        peak = _peak_rss_mb()
+        record = {
+            "time": self.started,
+            "name": self.name,
+            "song": self.song,
+            "parent": self.parent.name if self.parent else None,
+            "status": self.status,
+            "wall": time.perf_counter() - self._start_wall,
+            # cpu: このスレッドのCPU時間, process_cpu: プロセス全体(ほかのスレッドも含む)
+            "cpu": time.thread_time() - self._start_cpu,
+            "process_cpu": time.process_time() - self._start_process_cpu,
+            "peak_rss_mb": peak,
+            "peak_rss_growth_mb": peak - self._start_peak,
+        }
+        if self.error:
+            record["error"] = self.error
+        record.update(self.fields)
+        return record
+
+
+class Tracer:
+    # 各処理の時間・メモリ・キャッシュの当たり外れを JSON Lines に記録する
+    # ファイルは max_bytes を超えたら trace.jsonl.1, .2 ... にずらして backup_count 個まで残す
+    def __init__(self, path=TRACE_PATH, max_bytes=5 * 1024 * 1024, backup_count=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.listeners = []
+        self.recent = deque(maxlen=500)  # 直近の記録(GUIの集計用)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._logger = None
+
+    def _get_logger(self):
+        # 最初に記録するときにファイルを開く
+        with self._lock:
+            if self._logger is None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                logger = logging.getLogger(f"nandemo.trace.{id(self)}")
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+                handler = logging.handlers.RotatingFileHandler(
+                    self.path,
+                    maxBytes=self.max_bytes,
+                    backupCount=self.backup_count,
+                    encoding="utf-8",
+                )
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                logger.addHandler(handler)
+                self._logger = logger
+            return self._logger
+
+    def add_listener(self, callback):
+        # callback(record) は記録したスレッドから呼ばれる
+        self.listeners.append(callback)
+
+    def current(self):
+        stack = getattr(self._local, "stack", None)
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, name, song=None, **fields):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        span = Span(name, song=song, parent=self.current(), fields=fields)
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "cancelled" if type(e).__name__ == "Cancelled" else "error"
+            span.error = span.error or str(e)
+            raise
+        finally:
+            stack.pop()
+            # キャッシュの当たり外れは外側のspan(ステージ)にも伝える
+            if span.parent is not None and "cache" in span.fields:
+                span.parent.fields.setdefault("cache", span.fields["cache"])
+            self.record(span.finish())
+
+    def annotate(self, **fields):
+        # 実行中のspanに情報(キャッシュの当たり外れ、パラメータなど)を足す
+        span = self.current()
+        if span is not None:
+            span.fields.update(fields)
+
+    def annotate_first(self, **fields):
+        # まだ記録されていない項目だけを足す(最初のキャッシュ参照の結果を残す)
+        span = self.current()
+        if span is not None:
+            for key, value in fields.items():
+                span.fields.setdefault(key, value)
+
+    def fail(self, error):
+        # 例外を握りつぶして None を返す処理で、失敗したことを記録する
+        span = self.current()
+        if span is not None:
+            span.status = "error"
+            span.error = str(error)
+
+    def record(self, record):
+        self.recent.append(record)
+        try:
+            self._get_logger().info(json.dumps(record, ensure_ascii=False, default=str))
+        except OSError as e:
+            print(f"トレースを書き込めませんでした: {e}")
+        for callback in self.listeners:
+            try:
+                callback(record)
+            except Exception as e:
+                print(f"トレースの通知でエラー: {e}")
+
+    def traced(self, name):
+        # メソッドを丸ごとspanで囲むデコレータ。最初の引数(パスなど)を input として記録する
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(instance, *args, **kwargs):
+                with self.span(name, input=args[0] if args else None):
+                    return func(instance, *args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def summary(self, song):
+        # 曲ごとの記録を処理名ごとにまとめる {処理名: {"wall", "cpu", "count", "cache_hits"}}
+        result = {}
+        for record in list(self.recent):
+            if record.get("song") != song:
+                continue
+            item = result.setdefault(
+                record["name"], {"wall": 0.0, "cpu": 0.0, "count": 0, "cache_hits": 0}
+            )
+            item["wall"] += record["wall"]
+            item["cpu"] += record["cpu"]
+            item["count"] += 1
+            if record.get("cache") in ("hit", "memory"):
+                item["cache_hits"] += 1
+        return result
+
+
+# プロセス全体で共有するトレーサ
+tracer = Tracer()
@@ -0,0 +1,327 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+# 合成した音源で前処理の各ステージの時間とメモリを測る(実際の曲やネットワークは使わない)
+# 使い方: python3 tests/benchmark.py --durations 30 120 --output bench.json
+#         python3 tests/benchmark.py --baseline 前回のbench.json  (遅くなったステージを表示)
+# 各ステージは作業用ディレクトリで別プロセスとして動かす(キャッシュとメモリ使用量を分けるため)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SR = 44100
+STAGES = ["copy", "pitch", "separate", "recognize"]
+
+MELODY = [60, 62, 64, 65, 67, 69, 67, 65, 64, 62, 60, 72]  # MIDIノート番号
+NOTE_SECONDS = 0.5
+REST_EVERY = 4  # 4音ごとに1音分休む
+
+
+def midi_to_hz(midi):
+    return 440.0 * 2 ** ((np.asarray(midi, dtype=np.float64) - 69) / 12)
+
+
+def melody_notes(duration):
+    # 正解の音符 [(開始, 終了, MIDIノート番号)]
+    notes = []
+    t, i = 0.5, 0
+    while t + NOTE_SECONDS <= duration:
+        if i % (REST_EVERY + 1) != REST_EVERY:
+            notes.append((t, t + NOTE_SECONDS, MELODY[i % len(MELODY)]))
+        t += NOTE_SECONDS
+        i += 1
+    return notes
+
+
+def envelope(n, sr, attack=0.02, release=0.05):
+    env = np.ones(n)
+    a, r = min(n, int(attack * sr)), min(n, int(release * sr))
+    env[:a] = np.linspace(0, 1, a)
+    env[n - r :] = np.minimum(env[n - r :], np.linspace(1, 0, r))
+    return env
+
+
+def synth_vocals(notes, duration, sr=SR):
+    # 倍音つきの音にビブラートをかけた歌声の代わり
+    y = np.zeros(int(duration * sr))
+    for start, end, midi in notes:
+        i, j = int(start * sr), int(end * sr)
+        t = np.arange(j - i) / sr
+        f0 = midi_to_hz(midi) * 2 ** (0.2 / 12 * np.sin(2 * np.pi * 5.5 * t))
+        phase = 2 * np.pi * np.cumsum(f0) / sr
+        tone = sum(np.sin(k * phase) / k**1.5 for k in range(1, 6))
+        y[i:j] += 0.25 * tone * envelope(j - i, sr)
+    return y
+
+
+def synth_backing(duration, sr=SR, seed=0):
+    # ベース、和音、ノイズのドラムからなる伴奏
+    rng = np.random.default_rng(seed)
+    n = int(duration * sr)
+    t = np.arange(n) / sr
+    roots = np.where((t // 2).astype(int) % 2 == 0, 36, 43)  # 2秒ごとに C2 / G2
+    bass = 0.2 * np.sin(2 * np.pi * np.cumsum(midi_to_hz(roots)) / sr)
+    chord = sum(
+        0.05 * np.sin(2 * np.pi * np.cumsum(midi_to_hz(roots + 24 + step)) / sr)
+        for step in (0, 4, 7)
+    )
+    drums = np.zeros(n)
+    hit = int(0.05 * sr)
+    for i in range(0, n - hit, int(0.5 * sr)):
+        drums[i : i + hit] += (
+            0.3 * rng.standard_normal(hit) * np.exp(-np.arange(hit) / (0.01 * sr))
+        )
+    return bass + chord + drums
+
+
+def synth_speech(duration, sr=SR, seed=0):
+    # 母音のフォルマントを持つ声の代わり(0.2秒の音節と短い休みのくり返し)
+    rng = np.random.default_rng(seed)
+    vowels = [(730, 1090), (270, 2290), (300, 870), (530, 1840), (570, 840)]
+    y = np.zeros(int(duration * sr))
+    t0 = 0.3
+    while t0 + 0.2 < duration:
+        i, j = int(t0 * sr), int((t0 + 0.2) * sr)
+        t = np.arange(j - i) / sr
+        f0 = rng.uniform(100, 140) * (1 - 0.1 * t / 0.2)  # 少し下がる抑揚
+        phase = 2 * np.pi * np.cumsum(f0) / sr
+        f1, f2 = vowels[rng.integers(len(vowels))]
+        syllable = np.zeros(j - i)
+        for k in range(1, int(4000 / f0.max())):
+            freq = k * f0.mean()
+            gain = np.exp(-(((freq - f1) / 120) ** 2)) + 0.5 * np.exp(
+                -(((freq - f2) / 150) ** 2)
+            )
+            syllable += gain * np.sin(k * phase)
+        y[i:j] += 0.2 * syllable * envelope(j - i, sr)
+        t0 += 0.2 + (0.4 if rng.random() < 0.2 else 0.05)
+    return y
+
+
+def write_wav(path, audio, sr=SR):
+    audio = np.clip(audio / max(1.0, np.abs(audio).max() / 0.9), -1, 1)
+    stereo = np.repeat((audio * 32767).astype("<i2")[:, None], 2, axis=1)
+    with wave.open(path, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(sr)
+        f.writeframes(stereo.tobytes())
+    return path
+
+
+def make_corpus(directory, duration):
+    # song: 歌+伴奏, vocals: 歌だけ(ピッチ解析用), speech: 声だけ(音声認識用)
+    notes = melody_notes(duration)
+    vocals = synth_vocals(notes, duration)
+    paths = {
+        "song": write_wav(
+            os.path.join(directory, f"song_{duration}s.wav"),
+            vocals + synth_backing(duration),
+        ),
+        "vocals": write_wav(os.path.join(directory, f"vocals_{duration}s.wav"), vocals),
+        "speech": write_wav(
+            os.path.join(directory, f"speech_{duration}s.wav"), synth_speech(duration)
+        ),
+    }
+    truth_path = os.path.join(directory, f"truth_{duration}s.json")
+    with open(truth_path, "w") as f:
+        json.dump({"notes": notes}, f)
+    return paths, truth_path
+
+
+def pitch_accuracy(records, truth_notes, step=0.01):
+    # 正解の音符が鳴っている時間のうち、同じ音程(半音以内)が出ている割合
+    times = np.arange(0, truth_notes[-1][1], step)
+    truth = np.zeros(len(times))
+    for start, end, midi in truth_notes:
+        truth[(times >= start) & (times < end)] = midi
+    detected = np.zeros(len(times))
+    for record in records:
+        detected[(times >= record["start"]) & (times < record["end"])] = record["pitch"]
+    voiced = truth > 0
+    correct = np.abs(detected[voiced] - truth[voiced]) < 0.5
+    return float(correct.mean()) if voiced.any() else 0.0
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_stage(stage, paths, truth_path):
+    # 子プロセスの中で1つのステージを2回(キャッシュなし/あり)実行する
+    result = {"stage": stage}
+    start = time.perf_counter()
+    if stage == "copy":
+        from src.audio.copy import Copy
+
+        module, call, source = Copy(), "copy_music", paths["song"]
+    elif stage == "pitch":
+        from src.pitch.extractor import PitchExtractor
+
+        module, call, source = PitchExtractor(), "extract_pitch", paths["vocals"]
+    elif stage == "separate":
+        from src.audio.separator import Separator
+
+        module, call, source = Separator(), "separate", paths["song"]
+    elif stage == "recognize":
+        from src.lyrics.recognizer import Recognizer
+
+        module, call, source = Recognizer(), "recognize_lyrics", paths["speech"]
+    result["import_seconds"] = time.perf_counter() - start
+
+    for label in ("seconds", "cached_seconds"):
+        start = time.perf_counter()
+        output = getattr(module, call)(source)
+        result[label] = time.perf_counter() - start
+    if not output:
+        raise RuntimeError(f"{stage} が結果を返しませんでした")
+
+    if stage == "pitch":
+        with open(truth_path) as f:
+            truth_notes = json.load(f)["notes"]
+        result["accuracy"] = pitch_accuracy(output, truth_notes)
+        result["records"] = len(output)
+    elif stage == "recognize":
+        result["segments"] = len(output)
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    # 前回の結果より threshold 倍以上遅い(またはメモリが多い)ものを表示する
+    with open(baseline_path) as f:
+        baseline = {
+            (r["stage"], r["duration"]): r
+            for r in json.load(f)["results"]
+            if "error" not in r
+        }
+    regressions = []
+    for result in results:
+        before = baseline.get((result["stage"], result["duration"]))
+        if not before or "error" in result:
+            continue
+        for metric in ("seconds", "peak_rss_mb"):
+            if result[metric] > before[metric] * threshold:
+                regressions.append(
+                    f"{result['stage']} ({result['duration']}秒の曲): "
+                    f"{metric} {before[metric]:.2f} -> {result[metric]:.2f}"
+                )
+        if result.get("accuracy", 1.0) < before.get("accuracy", 0.0) - 0.02:
+            regressions.append(
+                f"{result['stage']} ({result['duration']}秒の曲): "
+                f"accuracy {before['accuracy']:.3f} -> {result['accuracy']:.3f}"
+            )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="合成音源による前処理のベンチマーク")
+    parser.add_argument("--durations", type=int, nargs="+", default=[30, 120, 300])
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--output", default="benchmark.json", help="結果のJSON")
+    parser.add_argument("--baseline", help="比べる前回の結果のJSON")
+    parser.add_argument(
+        "--threshold", type=float, default=1.2, help="何倍遅くなったら知らせるか"
+    )
+    parser.add_argument("--run-stage", nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_stage:
+        # 子プロセス: ステージ名, 入力のJSON, 正解のJSON, 結果の出力先
+        stage, paths_json, truth_path, output_path = args.run_stage
+        result = run_stage(stage, json.loads(paths_json), truth_path)
+        with open(output_path, "w") as f:
+            json.dump(result, f)
+        return 0
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="nandemo-bench-") as workdir:
+        env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+        for duration in args.durations:
+            paths, truth_path = make_corpus(workdir, duration)
+            for stage in args.stages:
+                # ステージごとに別の作業ディレクトリ(=空のdata/cache)で実行する
+                stage_dir = tempfile.mkdtemp(prefix=f"{stage}-", dir=workdir)
+                output_path = os.path.join(stage_dir, "result.json")
+                process = subprocess.run(
+                    [
+                        sys.executable,
+                        os.path.abspath(__file__),
+                        "--run-stage",
+                        stage,
+                        json.dumps(paths),
+                        truth_path,
+                        output_path,
+                    ],
+                    cwd=stage_dir,
+                    env=env,
+                    capture_output=True,
+                    text=True,
+                )
+                if process.returncode == 0 and os.path.exists(output_path):
+                    with open(output_path) as f:
+                        result = json.load(f)
+                    print(
+                        f"{stage:>9} {duration:>4}秒: {result['seconds']:.2f}秒 "
+                        f"(キャッシュ {result['cached_seconds']:.3f}秒), "
+                        f"最大メモリ {result['peak_rss_mb']:.0f}MB"
+                        + (
+                            f", 正解率 {result['accuracy'] * 100:.1f}%"
+                            if "accuracy" in result
+                            else ""
+                        )
+                    )
+                else:
+                    error = (process.stderr.strip().splitlines() or ["不明なエラー"])[
+                        -1
+                    ]
+                    result = {"stage": stage, "error": error}
+                    print(f"{stage:>9} {duration:>4}秒: 失敗 ({error})")
+                result["duration"] = duration
+                results.append(result)
+
+    report = {
+        "revision": git_revision(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果を保存しました: {args.output}")
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.threshold)
+        for line in regressions:
+            print(f"遅くなりました: {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,47 @@
+import os
+import sys
+import tempfile
+import time
+
+from src.audio.download import Downloader, DownloadQueue, LocalExtractor
+from src.cache.artifact_cache import ArtifactCache
+
+# ネットワークを使わずに、ローカルのファイルを配信する代わりの extractor でダウンロードキューを試す
+# 使い方: PYTHONPATH=. python3 tests/download-queue.py [音源のディレクトリ] [同時実行数]
+
+source_dir = sys.argv[1] if len(sys.argv) > 1 else None
+max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+work_dir = tempfile.mkdtemp(prefix="download-queue-")
+if source_dir is None:
+    # 2MBのダミーファイルを5つ作る
+    source_dir = os.path.join(work_dir, "source")
+    os.makedirs(source_dir)
+    for i in range(5):
+        with open(os.path.join(source_dir, f"song {i}.webm"), "wb") as f:
+            f.write(os.urandom(2 * 1024 * 1024))
+
+queries = [os.path.splitext(name)[0] for name in sorted(os.listdir(source_dir))]
+os.chdir(work_dir)  # data/output はここに作る
+
+downloader = Downloader(
+    cache=ArtifactCache(os.path.join(work_dir, "cache")),
+    # 10MB/秒の回線を真似る
+    extractor=LocalExtractor(source_dir, bytes_per_second=10 * 1024 * 1024),
+)
+queue = DownloadQueue(downloader, max_workers=max_workers)
+
+start_time = time.perf_counter()
+tasks = [queue.submit(query) for query in queries]
+tasks[-1].cancel()  # 最後の1曲は順番待ちの間にキャンセルする
+for task in tasks:
+    task.wait()
+    print(f"{task.state:<10} {task.progress * 100:5.1f}% {task.query}: {task.result}")
+print(f"{len(tasks)}件 (同時{max_workers}件): {time.perf_counter() - start_time:.2f}秒")
+
+# 2回目はキャッシュから
+start_time = time.perf_counter()
+for task in [queue.submit(query) for query in queries[:-1]]:
+    task.wait()
+print(f"キャッシュから: {time.perf_counter() - start_time:.2f}秒")
+queue.shutdown()
@@ -0,0 +1,68 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from src.audio.copy import Copy
+from src.audio.separator import Separator
+from src.cache.artifact_cache import ArtifactCache
+from src.pipeline.scheduler import Scheduler
+from src.pipeline.song import build_song_stages
+from src.pitch.extractor import PitchExtractor
+from src.pitch.track import migrate_json_caches
+from src.tracing.tracer import tracer
+
+# 以前の data/output/<曲名>/ (music.mp3, vocals.mp3, accompaniment.mp3, pitch.json) を変換し、
+# その曲を開いたときに分離もピッチ解析もやり直さない(キャッシュから読む)ことを確かめる
+# 音源の中身はダミーなので、解析が走ればデコードに失敗してピッチが空になる
+# 使い方: PYTHONPATH=. python3 tests/pitch-migrate.py
+
+work_dir = tempfile.mkdtemp(prefix="pitch-migrate-")
+os.chdir(work_dir)
+song_dir = os.path.join("data", "output", "song")
+os.makedirs(song_dir)
+for name in ("music.mp3", "vocals.mp3", "accompaniment.mp3"):
+    with open(os.path.join(song_dir, name), "wb") as f:
+        f.write(os.urandom(4096))
+
+# 以前の形式: 44.1kHz, hop 2048 のフレーム単位。途中に1つオクターブ誤りがある
+hop = 2048 / 44100
+records = []
+for i in range(200):
+    pitch = 60 if i < 100 else 64
+    if i == 50:
+        pitch = 72
+    records.append({"start": i * hop, "end": (i + 1) * hop, "pitch": pitch + 0.1})
+with open(os.path.join(song_dir, "pitch.json"), "w", encoding="utf-8") as f:
+    json.dump(records, f)
+
+cache = ArtifactCache(os.path.join("data", "cache"))
+migrate_json_caches(cache)
+
+music_path = os.path.join(song_dir, "music.mp3")
+stages = build_song_stages(
+    path=music_path,
+    copy=Copy(cache=cache),
+    separator=Separator(cache=cache),
+    pitch_extractor=PitchExtractor(cache=cache),
+)
+scheduler = Scheduler()
+job = scheduler.run(
+    [stage for stage in stages if stage.name != "recognize"], name=music_path
+)
+scheduler.shutdown()
+
+summary = tracer.summary(music_path)
+for stage in ("ingest", "separate", "pitch"):
+    hits = summary.get(f"stage.{stage}", {}).get("cache_hits", 0)
+    print(f"{stage:<10} {job.states[stage]:<10} {'hit' if hits else 'miss'}")
+    assert job.states[stage] == "finished", job.errors
+    if stage != "ingest":  # 取り込みはリンクするだけなので、初回は外れでよい
+        assert hits, f"{stage} がキャッシュから読まれていません"
+
+notes = job.results["pitch"].to_records()
+print(notes)
+assert [note["pitch"] for note in notes] == [60, 64]
+assert np.isclose(notes[-1]["end"], 200 * hop)
+print("OK")
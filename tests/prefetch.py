@@ -0,0 +1,35 @@
+import sys
+import time
+
+from src.lyrics.recognizer import Recognizer
+from src.pipeline.prefetch import Prefetcher
+from src.pipeline.song import process_song
+from src.tracing.tracer import tracer
+
+# 予約した曲を裏で前処理したあと、GUIと同じ方法で処理し直してキャッシュが使われるか確かめる
+# 使い方: PYTHONPATH=. python3 tests/prefetch.py 音源ファイル
+
+if __name__ == "__main__":
+    path = sys.argv[1]
+
+    prefetcher = Prefetcher(progressive=True)
+    start_time = time.perf_counter()
+    record = prefetcher.submit("path", path).get()
+    prefetcher.shutdown()
+    print(f"前処理: {record['status']} ({time.perf_counter() - start_time:.1f}秒)")
+    print(record["timings"])
+
+    # 順番が来たときにGUIがするのと同じ処理 (progressive=True)
+    job = process_song(
+        path=path,
+        recognizer=Recognizer(),
+        progressive=True,
+    )
+    print(job.timings)
+    summary = tracer.summary(path)
+    for stage in ("ingest", "separate", "recognize", "pitch"):
+        hits = summary.get(f"stage.{stage}", {}).get("cache_hits", 0)
+        print(f"{stage:<10} {'hit' if hits else 'miss'}")
+    assert summary["stage.recognize"][
+        "cache_hits"
+    ], "音声認識のキャッシュが使われていません"
@@ -0,0 +1,82 @@
+import sys
+import time
+from difflib import SequenceMatcher
+
+import numpy as np
+
+from src.audio.pcm_cache import pcm_cache
+from src.lyrics.backends import create_backend
+from src.lyrics.recognizer import format_segment
+
+# whisper (fp32) と faster-whisper (int8) で同じ音源を認識し、速度と単語の時刻のずれを比べる
+# 使い方: PYTHONPATH=. python3 tests/recognizer-compare.py 音源ファイル [モデルサイズ] [スレッド数]
+
+audio_file = sys.argv[1] if len(sys.argv) > 1 else "tests/output/勘ぐれい/vocals.wav"
+model_size = sys.argv[2] if len(sys.argv) > 2 else "base"
+cpu_threads = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+language = "ja"
+
+audio = np.array(pcm_cache.analysis(audio_file).data, dtype=np.float32)
+duration = len(audio) / 16000
+
+backends = [
+    create_backend("whisper", model_size),
+    create_backend(
+        "faster-whisper", model_size, compute_type="int8", cpu_threads=cpu_threads
+    ),
+    create_backend(
+        "faster-whisper",
+        model_size,
+        compute_type="int8",
+        cpu_threads=cpu_threads,
+        batch_size=1,
+    ),
+]
+
+results = {}
+for backend in backends:
+    label = backend.model_name
+    load_start = time.perf_counter()
+    model = backend.load()
+    load_time = time.perf_counter() - load_start
+
+    start = time.perf_counter()
+    segments = [format_segment(s) for s in backend.transcribe(model, audio, language)]
+    elapsed = time.perf_counter() - start
+    results[label] = segments
+    print(
+        f"{label}: ロード {load_time:.1f}秒, 認識 {elapsed:.1f}秒 (実時間の{elapsed / duration:.2f}倍)"
+    )
+
+# 最初のバックエンド(whisper)を基準に、同じ単語どうしの開始・終了時刻のずれを測る
+reference_label = next(iter(results))
+reference = [w for s in results[reference_label] for w in s["words"]]
+for label, segments in results.items():
+    if label == reference_label:
+        continue
+    words = [w for s in segments for w in s["words"]]
+    matcher = SequenceMatcher(
+        None, [w["word"] for w in reference], [w["word"] for w in words]
+    )
+    start_errors, end_errors = [], []
+    for block in matcher.get_matching_blocks():
+        for i in range(block.size):
+            ref, word = reference[block.a + i], words[block.b + i]
+            start_errors.append(abs(ref["start"] - word["start"]))
+            end_errors.append(abs(ref["end"] - word["end"]))
+
+    text_ratio = SequenceMatcher(
+        None,
+        "".join(s["text"] for s in results[reference_label]),
+        "".join(s["text"] for s in segments),
+    ).ratio()
+    print(f"{label} と {reference_label} の比較:")
+    print(f"  テキストの一致率: {text_ratio * 100:.1f}%")
+    print(f"  一致した単語: {len(start_errors)} / {len(reference)}")
+    if start_errors:
+        print(
+            f"  開始時刻のずれ: 平均 {np.mean(start_errors) * 1000:.0f}ms, 最大 {np.max(start_errors) * 1000:.0f}ms"
+        )
+        print(
+            f"  終了時刻のずれ: 平均 {np.mean(end_errors) * 1000:.0f}ms, 最大 {np.max(end_errors) * 1000:.0f}ms"
+        )
@@ -0,0 +1,76 @@
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+# Spleeter(TensorFlow) と ONNX Runtime (fp32 / int8) で同じ音源を分離し、
+# 読み込み時間・分離時間・最大メモリ使用量・結果の差を比べる
+# 使い方: PYTHONPATH=. python3 tests/separator-compare.py 音源ファイル [秒数]
+# (事前に python -m src.audio.onnx_separator export --quantize が必要)
+
+BACKENDS = {
+    "spleeter": {"backend": "spleeter"},
+    "onnx": {"backend": "onnx"},
+    "onnx-int8": {"backend": "onnx", "backend_options": {"quantized": True}},
+}
+
+
+def run_backend(name, audio_file, seconds, output_path):
+    # メモリ使用量を比べるため、バックエンドごとに別プロセスで実行する
+    start = time.perf_counter()
+    from src.audio.pcm_cache import pcm_cache
+    from src.audio.separator import Separator
+    from src.tracing.tracer import _peak_rss_mb
+
+    separator = Separator(**BACKENDS[name])
+    model = separator.spleeter_separator
+    load_time = time.perf_counter() - start
+
+    pcm = pcm_cache.separation(audio_file)
+    waveform = np.array(pcm.data[: int(seconds * pcm.samplerate)], dtype=np.float32)
+    start = time.perf_counter()
+    prediction = model.separate(waveform)
+    elapsed = time.perf_counter() - start
+
+    np.save(output_path, prediction["vocals"])
+    peak_mb = _peak_rss_mb()  # ru_maxrssの単位はOSで違う
+    print(
+        f"{name}: 読み込み {load_time:.1f}秒, 分離 {elapsed:.1f}秒 "
+        f"(実時間の{elapsed / seconds:.2f}倍), 最大メモリ {peak_mb:.0f}MB"
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3 and sys.argv[1] == "--run":
+        run_backend(sys.argv[2], sys.argv[3], float(sys.argv[4]), sys.argv[5])
+        sys.exit(0)
+
+    audio_file = sys.argv[1] if len(sys.argv) > 1 else "tests/input/test.mp3"
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 60.0
+    outputs = {}
+    for name in BACKENDS:
+        output_path = f"/tmp/separator-compare-{name}.npy"
+        result = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--run",
+                name,
+                audio_file,
+                str(seconds),
+                output_path,
+            ]
+        )
+        if result.returncode == 0:
+            outputs[name] = np.load(output_path)
+
+    # Spleeterの結果との差 (SNR, dB)
+    reference = outputs.get("spleeter")
+    for name, vocals in outputs.items():
+        if reference is None or name == "spleeter":
+            continue
+        n = min(len(reference), len(vocals))
+        noise = np.sum((reference[:n] - vocals[:n]) ** 2) + 1e-12
+        snr = 10 * np.log10(np.sum(reference[:n] ** 2) / noise)
+        print(f"{name} と spleeter のボーカルの差: SNR {snr:.1f}dB")